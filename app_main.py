@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Main Interface Window and Application Launch"""
 
+import multiprocessing
 import sys
 import wx
 
@@ -25,9 +26,14 @@ class WindowFrame(wx.Frame):
         self.pane_main = pane.PaneMain(self)
         self.szr_main.Add(self.pane_main, proportion=1, flag=wx.EXPAND)
 
-        # Define lower status bar
-        self.status = self.CreateStatusBar(1)
+        # Define lower status bar, with a field for background activity such as running searches
+        self.status = self.CreateStatusBar(2)
+        self.status.SetStatusWidths([-1, 400])
         self.status.SetStatusText("Written by Ancient Abysswalker")
+        self.status.Bind(wx.EVT_LEFT_DCLICK, self.evt_retry_documents)
+
+        # Stop the background workers on closing
+        self.Bind(wx.EVT_CLOSE, self.evt_close)
 
         # Set icon
         self.SetIcon(wx.Icon(fn_path.concat_gui('icon.png')))
@@ -37,10 +43,66 @@ class WindowFrame(wx.Frame):
         self.SetSizer(self.szr_main)
         self.Show()
 
+    def set_activity(self, text):
+        """Show the state of background work in the status bar
+
+            Args:
+                text (str): The text to display
+        """
+
+        self.status.SetStatusText(text, 1)
+
+    def evt_retry_documents(self, event):
+        """Retry adding any documents that failed to be added, on double-clicking the status bar
+
+            Args:
+                event: A mouse event passed from the status bar
+        """
+
+        if self.pane_main.retry_documents():
+            self.set_activity("Retrying documents that failed to be added...")
+        event.Skip()
+
+    def evt_close(self, event):
+        """Stop the background workers, then close the window - asking first if documents are still being added
+
+            Args:
+                event: A close event passed from the frame
+        """
+
+        if event.CanVeto() and self.pane_main.ingest_queue.is_busy():
+            _answer = wx.MessageBox("Documents are still being added to the library. Close once they are added?\n\n"
+                                    "Choosing No closes now, and the documents not yet added are lost.",
+                                    "Closing", wx.YES_NO | wx.CANCEL | wx.ICON_QUESTION, self)
+            if _answer == wx.CANCEL:
+                event.Veto()
+                return
+            if _answer == wx.YES:
+                event.Veto()
+                self.set_activity("Closing once documents are added...")
+                self.close_when_added()
+                return
+
+        self.pane_main.shutdown()
+        event.Skip()
+
+    def close_when_added(self):
+        """Close the window once the ingest queue has no work left, checking again shortly until then - the queue
+        needs the GUI thread to report back, so is not waited on here"""
+
+        if self.pane_main.ingest_queue.is_busy():
+            wx.CallLater(250, self.close_when_added)
+        else:
+            self.Close()
+
 
 if __name__ == '__main__':
     """Launch the application."""
 
+    # In a frozen build the content indexer's worker processes start this executable, which must run the worker rather
+    # than launch the application
+    multiprocessing.freeze_support()
+
     # Set build number to display
     build = "1.0.0"
 
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""This module contains the copy engine that writes files into the archive
+
+    Files are copied in the kernel where the platform allows (os.copy_file_range, then os.sendfile) and otherwise in a
+    large-buffer loop, reporting progress as they go. Each copy is written to a temporary file beside its destination,
+    verified against the source's size and, where known, content hash, and only then renamed into place."""
+
+import errno
+import os
+import shutil
+import tempfile
+
+import fn_hash
+
+# Bytes copied per step, between progress reports
+copy_chunk_size = 8 << 20
+
+# Errors meaning a kernel copy method is unavailable for these files, so the next method should be tried
+fallback_errnos = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.EPERM,
+                   getattr(errno, 'EOPNOTSUPP', errno.EINVAL), getattr(errno, 'ENOTSUP', errno.EINVAL)}
+
+
+class CopyError(OSError):
+    """Raised when a copy does not match its source"""
+    pass
+
+
+def _copy_file_range(fd_src, fd_dst, offset, count):
+    """Copy part of a file within the kernel, without reading it into user space"""
+
+    return os.copy_file_range(fd_src, fd_dst, count, offset, offset)
+
+
+def _sendfile(fd_src, fd_dst, offset, count):
+    """Copy part of a file with sendfile, which writes at the destination's current position"""
+
+    os.lseek(fd_dst, offset, os.SEEK_SET)
+    return os.sendfile(fd_dst, fd_src, offset, count)
+
+
+def _read_write(fd_src, fd_dst, offset, count):
+    """Copy part of a file through a buffer, available on every platform"""
+
+    os.lseek(fd_src, offset, os.SEEK_SET)
+    os.lseek(fd_dst, offset, os.SEEK_SET)
+    _data = os.read(fd_src, count)
+    _view = memoryview(_data)
+    while _view:
+        _view = _view[os.write(fd_dst, _view):]
+
+    return len(_data)
+
+
+def copy_methods():
+    """List the copy methods available on this platform, fastest first
+
+        Returns:
+            (list: callable): Functions copying count bytes at offset between two file descriptors, returning the number
+                              of bytes copied
+    """
+
+    ls_method = []
+    if hasattr(os, 'copy_file_range'):
+        ls_method.append(_copy_file_range)
+    if hasattr(os, 'sendfile') and os.name == 'posix' and os.uname().sysname == 'Linux':
+        ls_method.append(_sendfile)
+    ls_method.append(_read_write)
+
+    return ls_method
+
+
+def copy_file(src, dst, expected_hash=None, fn_progress=None):
+    """Copy a file with its metadata, writing a temporary file and renaming it into place once verified
+
+        Args:
+            src (str): Path to the file to copy
+            dst (str): Path to copy the file to - replaced if it exists
+            expected_hash (str): SHA-256 hex digest the copy must have, or None to verify the size alone
+            fn_progress (callable): Function called with (bytes copied, total bytes) as the copy proceeds, or None
+
+        Returns:
+            (int): Number of bytes copied
+    """
+
+    _fd_tmp, _tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), prefix=".", suffix=".tmp")
+    try:
+        with open(src, 'rb', buffering=0) as file_src:
+            _fd_src = file_src.fileno()
+            _total = os.fstat(_fd_src).st_size
+            _done = 0
+
+            # Use the fastest method that works for these files, falling back part way if need be
+            ls_method = copy_methods()
+            while _done < _total:
+                try:
+                    _count = ls_method[0](_fd_src, _fd_tmp, _done, min(copy_chunk_size, _total - _done))
+                except OSError as error:
+                    if error.errno not in fallback_errnos or len(ls_method) == 1:
+                        raise
+                    ls_method.pop(0)
+                    continue
+                if _count == 0:
+                    break
+                _done += _count
+                if fn_progress is not None:
+                    fn_progress(_done, _total)
+
+        # Verify the copy before it can be seen at its destination
+        if os.fstat(_fd_tmp).st_size != _total or _done != _total:
+            raise CopyError("Copy of %s is %d bytes, expected %d" % (src, os.fstat(_fd_tmp).st_size, _total))
+        os.close(_fd_tmp)
+        _fd_tmp = None
+        if expected_hash is not None and fn_hash.hash_file(_tmp_path) != expected_hash:
+            raise CopyError("Copy of %s does not match its content hash" % src)
+
+        shutil.copystat(src, _tmp_path)
+        os.replace(_tmp_path, dst)
+    except BaseException:
+        if _fd_tmp is not None:
+            os.close(_fd_tmp)
+        if os.path.exists(_tmp_path):
+            os.remove(_tmp_path)
+        raise
+
+    return _total
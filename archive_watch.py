@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""Watcher service cataloguing files placed straight into the document archive
+
+    Usage:
+        python archive_watch.py [--db PATH] [--archive PATH] [--poll] [--interval SECONDS] [--settle SECONDS]
+                                [--user NAME] [--once]
+
+    Files found under the archive's category/discipline/level3 layout and not yet in the library are added to it, their
+    category, discipline and level3 taken from the folders they sit in and their title from the file name. Any level3
+    not yet in the library is added. Files are left where they are.
+
+    On Linux the archive is watched with inotify, so the watcher sleeps until something changes. Elsewhere, or with
+    --poll, the folders are polled - only the modification time of each folder is read, and a folder is listed again
+    only when that changes. New files are gathered until they have been left alone for the settle time, so a file still
+    being copied in is not catalogued part way, and are then added together in one transaction."""
+
+import argparse
+import ctypes
+import ctypes.util
+import getpass
+import os
+import select
+import sqlite3
+import struct
+import sys
+import time
+
+import database
+import ingest
+import lookup
+import schema
+
+import config
+import mode
+
+# Seconds between polls of the folders when inotify is unavailable, unless given on the command line
+default_interval = 30.0
+
+# Seconds a new file must be left unchanged before it is catalogued, unless given on the command line
+default_settle = 5.0
+
+# Most files added in one transaction
+max_batch = 500
+
+# Events watched for on each folder, and the flags of the events read back
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# Layout of the fixed part of an inotify event - watch descriptor, mask, cookie and name length
+event_header = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Minimal inotify binding through the C library, watching folders for new files
+
+        Raises:
+            OSError: If inotify is unavailable on this platform
+    """
+
+    def __init__(self):
+        """Constructor"""
+
+        _libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or _libc_name is None:
+            raise OSError("inotify is unavailable on this platform")
+
+        self.libc = ctypes.CDLL(_libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.wd_to_dir = {}
+
+    def add_watch(self, path):
+        """Watch a folder for new files and subfolders
+
+            Args:
+                path (str): Path to the folder
+
+            Returns:
+                (bool): True if the folder is now watched
+        """
+
+        _wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if _wd < 0:
+            print("Cannot watch %s: %s" % (path, os.strerror(ctypes.get_errno())), file=sys.stderr)
+            return False
+
+        self.wd_to_dir[_wd] = path
+        return True
+
+    def read(self, timeout):
+        """Wait for events and read them
+
+            Args:
+                timeout (float): Most seconds to wait, or None to wait until an event arrives
+
+            Returns:
+                (list: tuple): List of (folder path, mask, name) tuples - the folder is None if the queue overflowed
+        """
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        _data = os.read(self.fd, 1 << 16)
+        ls_event = []
+        _offset = 0
+        while _offset < len(_data):
+            _wd, _mask, _cookie, _length = event_header.unpack_from(_data, _offset)
+            _offset += event_header.size
+            _name = os.fsdecode(_data[_offset:_offset + _length].rstrip(b"\0"))
+            _offset += _length
+
+            if _mask & IN_IGNORED:
+                self.wd_to_dir.pop(_wd, None)
+            elif _mask & IN_Q_OVERFLOW:
+                ls_event.append((None, _mask, _name))
+            elif _wd in self.wd_to_dir:
+                ls_event.append((self.wd_to_dir[_wd], _mask, _name))
+
+        return ls_event
+
+    def close(self):
+        """Stop watching"""
+
+        os.close(self.fd)
+
+
+class ArchiveWatcher(object):
+    """Service finding new files in the document archive and adding them to the library
+
+        Args:
+            settle (float): Seconds a new file must be left unchanged before it is catalogued
+            interval (float): Seconds between polls of the folders when not using inotify
+            user (str): User to record as having added the documents, the current user if None
+
+        Attributes:
+            root (str): Root of the document archive
+            lookup_cache (lookup.LookupCache): Cache of the lookup tables, to resolve folder names
+            dir_to_mtime (dict): Mapping of each folder known to its modification time when last listed
+            dir_to_names (dict): Mapping of each folder known to the set of entry names it held when last listed
+            path_to_seen (dict): Mapping of each new file waiting to settle to when it was last seen to change
+            set_skipped (set: str): Files that could not be catalogued, left alone until the lookups change
+            inotify (Inotify): The inotify binding, or None when polling
+    """
+
+    def __init__(self, settle=default_settle, interval=default_interval, user=None):
+        """Constructor"""
+
+        self.root = config.cfg['document_archive']
+        self.settle = settle
+        self.interval = interval
+        self.user = user or getpass.getuser()
+
+        self.lookup_cache = lookup.LookupCache()
+        self.dir_to_mtime = {}
+        self.dir_to_names = {}
+        self.path_to_seen = {}
+        self.set_skipped = set()
+        self.inotify = None
+
+    def list_dir(self, path):
+        """List a folder, remembering its entries, and queue any new files found - new subfolders are listed in turn
+
+            Args:
+                path (str): Path to the folder
+        """
+
+        ls_dir = [path]
+        while ls_dir:
+            _dir = ls_dir.pop()
+            try:
+                _mtime = os.stat(_dir).st_mtime_ns
+                with os.scandir(_dir) as it_entry:
+                    ls_entry = [entry for entry in it_entry if not entry.name.startswith(".")]
+            except OSError:
+                self.forget_dir(_dir)
+                continue
+
+            # A new folder is watched before it is listed, so no file added in between is missed
+            if _dir not in self.dir_to_mtime and self.inotify is not None:
+                self.inotify.add_watch(_dir)
+
+            set_known = self.dir_to_names.get(_dir, set())
+            for entry in ls_entry:
+                if entry.name in set_known:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    ls_dir.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(ingest.partial_suffix):
+                    self.path_to_seen[entry.path] = time.monotonic()
+
+            self.dir_to_mtime[_dir] = _mtime
+            self.dir_to_names[_dir] = set(entry.name for entry in ls_entry)
+
+    def forget_dir(self, path):
+        """Forget a folder that has gone, along with everything under it
+
+            Args:
+                path (str): Path to the folder
+        """
+
+        for _dir in [_dir for _dir in self.dir_to_mtime if _dir == path or _dir.startswith(path + os.sep)]:
+            self.dir_to_mtime.pop(_dir, None)
+            self.dir_to_names.pop(_dir, None)
+
+    def start(self):
+        """List the whole archive, queueing only the files not already in the library"""
+
+        self.list_dir(self.root)
+
+        set_catalogued = set(ingest.catalogued_documents(database.connect()))
+        self.path_to_seen = dict((path, seen) for path, seen in self.path_to_seen.items()
+                                 if ingest.relative_path(path) not in set_catalogued)
+
+    def poll(self):
+        """List again every folder whose modification time has changed, queueing any new files found"""
+
+        for _dir, _mtime in list(self.dir_to_mtime.items()):
+            try:
+                if os.stat(_dir).st_mtime_ns == _mtime:
+                    continue
+            except OSError:
+                self.forget_dir(_dir)
+                continue
+            self.list_dir(_dir)
+
+    def handle(self, ls_event):
+        """Queue the new files named by inotify events, listing any new folders
+
+            Args:
+                ls_event (list: tuple): List of (folder path, mask, name) tuples read from inotify
+        """
+
+        for (_dir, _mask, _name) in ls_event:
+            # Events were lost, so list the whole archive again
+            if _dir is None:
+                self.dir_to_names.clear()
+                self.start()
+                continue
+
+            if _mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.forget_dir(_dir)
+            elif not _name or _name.startswith("."):
+                continue
+            elif _mask & IN_ISDIR:
+                self.list_dir(os.path.join(_dir, _name))
+            elif not _name.endswith(ingest.partial_suffix):
+                self.path_to_seen[os.path.join(_dir, _name)] = time.monotonic()
+                self.dir_to_names.setdefault(_dir, set()).add(_name)
+
+    def take_settled(self):
+        """Take the queued files left unchanged for the settle time, up to max_batch
+
+            Returns:
+                (list: str): Paths to the files taken
+        """
+
+        _now = time.monotonic()
+        ls_path = []
+        for _path, _seen in list(self.path_to_seen.items()):
+            if _now - _seen < self.settle:
+                continue
+
+            # A file still being written keeps changing, so wait on it again
+            try:
+                _age = time.time() - os.stat(_path).st_mtime
+            except OSError:
+                del self.path_to_seen[_path]
+                continue
+            if _age < self.settle:
+                self.path_to_seen[_path] = _now
+                continue
+
+            del self.path_to_seen[_path]
+            if _path not in self.set_skipped:
+                ls_path.append(_path)
+            if len(ls_path) == max_batch:
+                break
+
+        return ls_path
+
+    def catalogue(self, ls_path):
+        """Add files already in the archive to the library, inferring their details from the folders they sit in
+
+            Args:
+                ls_path (list: str): Paths to files in the document archive
+
+            Returns:
+                (int): Number of documents added
+        """
+
+        # Lookups added since files were skipped may now resolve them
+        if self.lookup_cache.refresh():
+            self.set_skipped.clear()
+        category_to_id = dict((category, ident) for (ident, category) in self.lookup_cache.rows['Categories'])
+        discipline_to_id = dict((discipline, ident) for (ident, discipline) in self.lookup_cache.rows['Disciplines'])
+
+        # Files sit at category/discipline/file or category/discipline/level3/file
+        ls_entry = []
+        for _path in ls_path:
+            ls_part = ingest.relative_path(_path).split("/")
+            if len(ls_part) not in (3, 4) or ls_part[0] not in category_to_id or ls_part[1] not in discipline_to_id:
+                print("Not catalogued, as not under a known category and discipline: %s" % _path, file=sys.stderr)
+                self.set_skipped.add(_path)
+                continue
+            ls_entry.append(dict(path=_path, category=ls_part[0], discipline=ls_part[1],
+                                 level3=ls_part[2] if len(ls_part) == 4 else ""))
+        if not ls_entry:
+            return 0
+        key_to_level3 = lookup.resolve_level3(self.lookup_cache, ls_entry, category_to_id, discipline_to_id)
+
+        ls_pending = []
+        for entry in ls_entry:
+            _category_id = category_to_id[entry['category']]
+            _discipline_id = discipline_to_id[entry['discipline']]
+            _level3_id = key_to_level3[(_category_id, _discipline_id, entry['level3'])] if entry['level3'] else None
+            ls_pending.append(ingest.make_pending(entry['path'], os.path.splitext(os.path.basename(entry['path']))[0],
+                                                  _category_id, _discipline_id, _level3_id,
+                                                  entry['category'], entry['discipline'], entry['level3'],
+                                                  [], self.user))
+        ls_pending = ingest.fill_hashes(ls_pending)
+
+        # Leave out any document added meanwhile, such as through the application, then write the rest
+        with database.transaction(immediate=True) as conn:
+            ls_pending = [pending for pending in ls_pending if
+                          conn.execute("SELECT 1 FROM Documents "
+                                       "WHERE file_name=(?) AND category=(?) AND discipline=(?) AND level3 IS (?);",
+                                       (pending.file_name, pending.category_id, pending.discipline_id,
+                                        pending.level3_id)).fetchone() is None]
+            if ls_pending:
+                ingest.write_documents(conn, ls_pending)
+
+        for pending in ls_pending:
+            print("Catalogued %s" % pending.source_path)
+
+        return len(ls_pending)
+
+    def flush(self):
+        """Catalogue every settled file, in batches
+
+            Returns:
+                (int): Number of documents added
+        """
+
+        _count = 0
+        ls_path = self.take_settled()
+        while ls_path:
+            try:
+                _count += self.catalogue(ls_path)
+            except (OSError, sqlite3.Error) as error:
+                # Try the batch again after the settle time
+                print("Cataloguing %d files failed: %s" % (len(ls_path), error), file=sys.stderr)
+                self.path_to_seen.update((_path, time.monotonic()) for _path in ls_path)
+                break
+            ls_path = self.take_settled()
+
+        return _count
+
+    def run(self, is_poll=False):
+        """Watch the archive until interrupted
+
+            Args:
+                is_poll (bool): Whether to poll the folders even if inotify is available
+        """
+
+        if not is_poll:
+            try:
+                self.inotify = Inotify()
+            except OSError as error:
+                print("Polling every %.0f s, as %s" % (self.interval, error), file=sys.stderr)
+
+        self.start()
+        try:
+            while True:
+                # Sleep until something changes, or the next queued file is due to settle
+                _timeout = self.settle if self.path_to_seen else None
+                if self.inotify is not None:
+                    self.handle(self.inotify.read(_timeout))
+                else:
+                    time.sleep(self.interval if _timeout is None else min(_timeout, self.interval))
+                    self.poll()
+                self.flush()
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+            database.close()
+
+
+def main(argv=None):
+    """Parse the command line and run the watcher
+
+        Args:
+            argv (list: str): Command line arguments, sys.argv[1:] if None
+
+        Returns:
+            (int): Exit status
+    """
+
+    parser = argparse.ArgumentParser(description="Add files placed straight into the document archive to the library")
+    parser.add_argument('--db', help="library database, instead of the configured one")
+    parser.add_argument('--archive', help="document archive, instead of the configured one")
+    parser.add_argument('--poll', action='store_true', help="poll the folders even where inotify is available")
+    parser.add_argument('--interval', type=float, default=default_interval, help="seconds between polls")
+    parser.add_argument('--settle', type=float, default=default_settle,
+                        help="seconds a new file must be left unchanged before it is catalogued")
+    parser.add_argument('--user', help="user recorded as adding the documents")
+    parser.add_argument('--once', action='store_true', help="catalogue the files already waiting, then exit")
+    args = parser.parse_args(argv)
+
+    # Load the configuration as the application does, then apply any overrides
+    if not (args.db and args.archive):
+        import wx
+        mode.set_mode(getattr(sys, 'frozen', False))
+        config.load_config(wx.App(False))
+    if args.db:
+        config.cfg['db_location'] = args.db
+    if args.archive:
+        config.cfg['document_archive'] = args.archive
+
+    schema.migrate(database.connect())
+    watcher = ArchiveWatcher(args.settle, args.interval, args.user)
+
+    if args.once:
+        watcher.settle = 0.0
+        watcher.start()
+        print("Catalogued %d files" % watcher.flush())
+        return 0
+
+    try:
+        watcher.run(args.poll)
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the archive copy engine against shutil.copy2, for many small files and a few large ones
+
+    Usage:
+        python benchmarks/bench_copy.py [--dir PATH] [--small-size BYTES] [--small-count N] [--large-size BYTES]
+                                        [--large-count N] [--repeat N]
+
+    Source files of random content are written under --dir, a temporary directory by default - point it at the file
+    system the archive lives on, such as a network share, for figures that reflect it. Each set of files is then copied
+    with archive_copy.copy_file, with copy_file also verifying the content hash as the ingest pipeline does, and with
+    shutil.copy2. The median time of each over the runs is printed with its throughput. Sources are read once before
+    timing, so every method reads them from the page cache."""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_copy
+import fn_hash
+
+# Bytes of random content written per step when making a source file
+write_chunk_size = 1 << 20
+
+
+def make_sources(directory, size, count):
+    """Write source files of random content
+
+        Args:
+            directory (str): Directory to write the files in
+            size (int): Bytes per file
+            count (int): Number of files
+
+        Returns:
+            (list: tuple): List of (path, content hash) tuples
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    ls_source = []
+    for i in range(count):
+        _path = os.path.join(directory, "source-%d.bin" % i)
+        with open(_path, 'wb') as file:
+            _left = size
+            while _left > 0:
+                file.write(os.urandom(min(write_chunk_size, _left)))
+                _left -= write_chunk_size
+        ls_source.append((_path, fn_hash.hash_file(_path)))
+
+    return ls_source
+
+
+def time_copies(fn_copy, ls_source, directory, repeat):
+    """Time copying every source file, emptying the destination between runs
+
+        Args:
+            fn_copy (callable): Function called with (source path, destination path, content hash)
+            ls_source (list: tuple): List of (path, content hash) tuples
+            directory (str): Directory to copy the files into
+            repeat (int): Number of runs
+
+        Returns:
+            (float): Median seconds per run
+    """
+
+    ls_time = []
+    for _ in range(repeat):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        _start = time.perf_counter()
+        for (_path, content_hash) in ls_source:
+            fn_copy(_path, os.path.join(directory, os.path.basename(_path)), content_hash)
+        ls_time.append(time.perf_counter() - _start)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    return statistics.median(ls_time)
+
+
+def run(directory, label, size, count, repeat):
+    """Benchmark one set of files, printing a line per method
+
+        Args:
+            directory (str): Directory to write the sources and copies under
+            label (str): Name of the set of files
+            size (int): Bytes per file
+            count (int): Number of files
+            repeat (int): Runs per method
+    """
+
+    ls_source = make_sources(os.path.join(directory, label), size, count)
+    _copies = os.path.join(directory, label + "-copies")
+
+    ls_method = [("copy_file", lambda src, dst, content_hash: archive_copy.copy_file(src, dst)),
+                 ("copy_file+hash", lambda src, dst, content_hash: archive_copy.copy_file(src, dst, content_hash)),
+                 ("shutil.copy2", lambda src, dst, content_hash: shutil.copy2(src, dst))]
+
+    print("%s - %d files of %d bytes" % (label, count, size))
+    print("    %-16s %10s %10s %10s" % ("method", "total ms", "files/s", "MB/s"))
+    for (name, fn_copy) in ls_method:
+        _seconds = time_copies(fn_copy, ls_source, _copies, repeat)
+        print("    %-16s %10.1f %10.1f %10.1f" % (name, _seconds * 1000, count / max(_seconds, 1e-9),
+                                                 size * count / max(_seconds, 1e-9) / (1 << 20)))
+
+    shutil.rmtree(os.path.join(directory, label), ignore_errors=True)
+
+
+def main(argv=None):
+    """Parse the command line and run the benchmark
+
+        Args:
+            argv (list: str): Command line arguments, sys.argv[1:] if None
+
+        Returns:
+            (int): Exit status
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark the archive copy engine against shutil.copy2")
+    parser.add_argument('--dir', help="directory to copy within, a temporary directory if not given")
+    parser.add_argument('--small-size', type=int, default=64 << 10, help="bytes per small file")
+    parser.add_argument('--small-count', type=int, default=500, help="number of small files")
+    parser.add_argument('--large-size', type=int, default=256 << 20, help="bytes per large file")
+    parser.add_argument('--large-count', type=int, default=2, help="number of large files")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per method, the median is reported")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        run(directory, "small", args.small_size, args.small_count, args.repeat)
+        run(directory, "large", args.large_size, args.large_count, args.repeat)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the in-memory trigram index against linear scans of the same documents
+
+    Usage:
+        python benchmarks/bench_trigram.py [--sizes 10000 100000 1000000] [--repeat N] [--seed N]
+
+    For each library size, synthetic file names and titles are generated, then a set of queries from common to absent
+    is timed through index.TrigramIndex.search, through a Python scan of the normalized texts, and through the instr()
+    scan SQLite runs over the normalized columns when no index can answer. The time to build the index and the median
+    time of each query are printed, and each method is checked to return the same documents."""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fn_text
+import index
+
+# Words titles are built from, some accented so normalization is exercised
+title_words = ["Pump", "Valve", "Motor", "Café", "Crème", "Spec", "Manual", "Drawing", "Schematic", "Élévation",
+               "Bearing", "Seal", "Gearbox", "Compressor", "Heat", "Exchanger", "Piping", "Layout", "Datasheet"]
+
+# Queries from matching many documents to matching none
+default_queries = ["pump", "cafe", "creme spec", "gearbox 12", "qzxk", "drawing 4242"]
+
+
+def make_documents(size, seed):
+    """Generate synthetic documents
+
+        Args:
+            size (int): Number of documents
+            seed (int): Seed of the random generator, so runs are comparable
+
+        Returns:
+            (list: tuple): List of (id, file name, title) tuples
+    """
+
+    rnd = random.Random(seed)
+    ls_doc = []
+    for ident in range(1, size + 1):
+        _file_name = "".join(rnd.choice(string.ascii_lowercase) for _ in range(8)) + "-%d.pdf" % ident
+        _title = " ".join(rnd.sample(title_words, 3)) + " %d" % rnd.randrange(10000)
+        ls_doc.append((ident, _file_name, _title))
+
+    return ls_doc
+
+
+def time_median(fn, repeat):
+    """Time a function
+
+        Args:
+            fn (callable): The function to time
+            repeat (int): Number of runs
+
+        Returns:
+            (float): Median seconds per run
+            The result of the last run
+    """
+
+    ls_time = []
+    for _ in range(repeat):
+        _start = time.perf_counter()
+        result = fn()
+        ls_time.append(time.perf_counter() - _start)
+
+    return statistics.median(ls_time), result
+
+
+def run(size, queries, repeat, seed):
+    """Benchmark one library size, printing a line per query
+
+        Args:
+            size (int): Number of documents
+            queries (list: str): Queries to time
+            repeat (int): Runs per query and method
+            seed (int): Seed of the random generator
+    """
+
+    ls_doc = make_documents(size, seed)
+
+    # Build the index as PaneMain does, through add() so normalization is included in the build time
+    text_index = index.TrigramIndex()
+    _start = time.perf_counter()
+    for (ident, file_name, title) in ls_doc:
+        text_index.add(ident, file_name, title)
+    _build = time.perf_counter() - _start
+
+    # The SQL fallback scans the persisted normalized columns
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE Documents (id INTEGER PRIMARY KEY, file_name_norm TEXT, title_norm TEXT);")
+    conn.executemany("INSERT INTO Documents VALUES ((?), (?), (?));",
+                     [(ident, fn_text.normalize(file_name), fn_text.normalize(title))
+                      for (ident, file_name, title) in ls_doc])
+    conn.commit()
+
+    print("%d documents - index built in %.2f s" % (size, _build))
+    print("    %-14s %8s %12s %12s %12s %9s" % ("query", "matches", "index ms", "scan ms", "sql ms", "speedup"))
+    for query in queries:
+        _query_norm = fn_text.normalize(query)
+
+        _index, ls_index = time_median(lambda: text_index.search(query, [True, True]), repeat)
+        _scan, ls_scan = time_median(lambda: [ident for ident, texts in sorted(text_index.texts.items())
+                                              if _query_norm in texts[0] or _query_norm in texts[1]], repeat)
+        _sql, ls_sql = time_median(lambda: [row[0] for row in
+                                            conn.execute("SELECT id FROM Documents "
+                                                         "WHERE instr(file_name_norm, (?)) > 0 "
+                                                         "OR instr(title_norm, (?)) > 0 "
+                                                         "ORDER BY id;",
+                                                         (_query_norm, _query_norm))], repeat)
+
+        if not ls_index == ls_scan == ls_sql:
+            print("    %-14s results differ between methods" % query)
+        print("    %-14s %8d %12.3f %12.3f %12.3f %8.0fx" % (query, len(ls_index), _index * 1000, _scan * 1000,
+                                                           _sql * 1000, min(_scan, _sql) / max(_index, 1e-9)))
+
+    conn.close()
+
+
+def main(argv=None):
+    """Parse the command line and run the benchmark
+
+        Args:
+            argv (list: str): Command line arguments, sys.argv[1:] if None
+
+        Returns:
+            (int): Exit status
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark the trigram index against linear scans")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help="library sizes")
+    parser.add_argument('--queries', nargs='+', default=default_queries, help="queries to time")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per query and method, the median is reported")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the document generator")
+    args = parser.parse_args(argv)
+
+    for size in args.sizes:
+        run(size, args.queries, args.repeat, args.seed)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Stress test of concurrent readers and writers sharing one library database, each in its own process
+
+    Usage:
+        python benchmarks/stress_db.py [--readers N] [--writers N] [--seconds S] [--documents N]
+                                       [--journal-mode delete|wal] [--db PATH]
+
+    A library of synthetic documents is built, then reader processes run restricted searches while writer processes
+    add documents one short transaction at a time, all through the database module as the application uses it. The
+    throughput, median, 99th percentile and largest latency of each role are printed, with the number of operations
+    that failed because the database stayed locked. Run once per journal mode to compare them - a WAL database keeps
+    its journal mode, so a fresh library is built unless --db is given."""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import database
+import schema
+import search
+
+# Numbers of categories and disciplines documents are spread over
+n_categories = 5
+n_disciplines = 4
+
+# Words titles are built from
+title_words = ["Pump", "Valve", "Motor", "Spec", "Manual", "Drawing", "Schematic", "Bearing", "Seal", "Gearbox"]
+
+
+def build_library(path, documents, journal_mode):
+    """Create a library of synthetic documents with the current schema
+
+        Args:
+            path (str): Path to create the database at
+            documents (int): Number of documents
+            journal_mode (str): Journal mode to configure, or None to leave SQLite's default
+    """
+
+    conn = sqlite3.connect(path)
+    conn.executescript(schema.base_tables)
+    conn.executemany("INSERT INTO Categories (category) VALUES (?);",
+                     [("Category %d" % i,) for i in range(n_categories)])
+    conn.executemany("INSERT INTO Disciplines (discipline) VALUES (?);",
+                     [("Discipline %d" % i,) for i in range(n_disciplines)])
+
+    rnd = random.Random(1)
+    conn.executemany("INSERT INTO Documents (file_name, title, category, discipline, user, time_added) "
+                     "VALUES ((?), (?), (?), (?), 'stress', (?));",
+                     [("doc-%d.pdf" % i, " ".join(rnd.sample(title_words, 3)), rnd.randint(1, n_categories),
+                       rnd.randint(1, n_disciplines), str(time.time())) for i in range(documents)])
+    conn.commit()
+
+    # Migrating fills in the normalized columns of the documents, which the full-text index is then built from
+    schema.migrate(conn)
+    schema.ensure_fts(conn)
+    if journal_mode:
+        conn.execute("PRAGMA journal_mode=%s;" % journal_mode)
+    conn.close()
+
+
+def read_once(rnd):
+    """Run one restricted search, as the pane does
+
+        Args:
+            rnd (random.Random): The process's random generator
+    """
+
+    with database.transaction() as conn:
+        search.search_documents(conn, rnd.choice(title_words), [True, True],
+                                [rnd.randint(1, n_categories)], [rnd.randint(1, n_disciplines)])
+
+
+def write_once(rnd):
+    """Add one document in a short write transaction, as the ingest queue does
+
+        Args:
+            rnd (random.Random): The process's random generator
+    """
+
+    with database.transaction(immediate=True) as conn:
+        conn.execute("INSERT INTO Documents (file_name, title, category, discipline, user, time_added, "
+                     "file_name_norm, title_norm) "
+                     "VALUES ((?), (?), (?), (?), 'stress', (?), (?), (?));",
+                     ("new-%d.pdf" % rnd.getrandbits(32), "Stress Test", rnd.randint(1, n_categories),
+                      rnd.randint(1, n_disciplines), str(time.time()), "new.pdf", "stress test"))
+
+
+def worker(role, path, journal_mode, seconds, seed, results):
+    """Repeat one role's operation until time is up, then report its latencies - runs in its own process
+
+        Args:
+            role (str): 'reader' or 'writer'
+            path (str): Path to the library database
+            journal_mode (str): Journal mode to configure, or None to leave the database's own
+            seconds (float): Seconds to run for
+            seed (int): Seed of the process's random generator
+            results (multiprocessing.Queue): Queue to put the (role, latencies, failures) tuple on
+    """
+
+    config.cfg['db_location'] = path
+    if journal_mode:
+        config.cfg['journal_mode'] = journal_mode
+
+    rnd = random.Random(seed)
+    fn_operation = read_once if role == 'reader' else write_once
+    ls_latency = []
+    _failures = 0
+    _end = time.perf_counter() + seconds
+    while time.perf_counter() < _end:
+        _start = time.perf_counter()
+        try:
+            fn_operation(rnd)
+        except sqlite3.OperationalError as error:
+            if not database.is_busy(error):
+                raise
+            _failures += 1
+            continue
+        ls_latency.append(time.perf_counter() - _start)
+
+    database.close()
+    results.put((role, ls_latency, _failures))
+
+
+def percentile(ls_value, fraction):
+    """Get a percentile of a list of values, by the nearest rank
+
+        Args:
+            ls_value (list: float): The values
+            fraction (float): The percentile as a fraction, such as 0.99
+
+        Returns:
+            (float): The value at that percentile, zero if there are none
+    """
+
+    if not ls_value:
+        return 0.0
+
+    ls_value = sorted(ls_value)
+    return ls_value[min(len(ls_value) - 1, int(fraction * len(ls_value)))]
+
+
+def main(argv=None):
+    """Parse the command line, run the readers and writers, and report their throughput and latency
+
+        Args:
+            argv (list: str): Command line arguments, sys.argv[1:] if None
+
+        Returns:
+            (int): Exit status
+    """
+
+    parser = argparse.ArgumentParser(description="Stress the library database with concurrent readers and writers")
+    parser.add_argument('--readers', type=int, default=4, help="reader processes")
+    parser.add_argument('--writers', type=int, default=2, help="writer processes")
+    parser.add_argument('--seconds', type=float, default=10.0, help="seconds to run for")
+    parser.add_argument('--documents', type=int, default=100000, help="documents in a freshly built library")
+    parser.add_argument('--journal-mode', choices=['delete', 'wal'], help="journal mode to configure")
+    parser.add_argument('--db', help="existing library to run against, instead of building one")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        _path = args.db
+        if _path is None:
+            _path = os.path.join(directory, "stress.sqlite")
+            build_library(_path, args.documents, args.journal_mode)
+
+        results = multiprocessing.Queue()
+        ls_process = [multiprocessing.Process(target=worker, args=(role, _path, args.journal_mode, args.seconds,
+                                                                   i, results))
+                      for i, role in enumerate(['reader'] * args.readers + ['writer'] * args.writers)]
+        for process in ls_process:
+            process.start()
+        ls_result = [results.get() for _ in ls_process]
+        for process in ls_process:
+            process.join()
+
+        _conn = sqlite3.connect(_path)
+        _journal_mode = _conn.execute("PRAGMA journal_mode;").fetchone()[0]
+        _conn.close()
+
+    print("%d readers, %d writers for %.0f s, journal mode %s" % (args.readers, args.writers, args.seconds,
+                                                                  _journal_mode))
+    print("    %-8s %8s %10s %10s %10s %10s %8s" % ("role", "ops", "ops/s", "p50 ms", "p99 ms", "max ms", "failed"))
+    for role in ['reader', 'writer']:
+        ls_latency = [latency for (_role, ls_role, _failures) in ls_result if _role == role for latency in ls_role]
+        _failures = sum(_failures for (_role, ls_role, _failures) in ls_result if _role == role)
+        print("    %-8s %8d %10.1f %10.2f %10.2f %10.2f %8d" % (
+            role, len(ls_latency), len(ls_latency) / args.seconds,
+            statistics.median(ls_latency) * 1000 if ls_latency else 0.0, percentile(ls_latency, 0.99) * 1000,
+            max(ls_latency, default=0.0) * 1000, _failures))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
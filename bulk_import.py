@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Command-line bulk importer adding whole directory trees of documents to the library
+
+    Usage:
+        python bulk_import.py DIRECTORY MAPPING [--db PATH] [--archive PATH] [--batch N] [--workers N] [--user NAME]
+                              [--link-duplicates]
+
+    The mapping file gives, for each document to import, its path relative to DIRECTORY along with its category,
+    discipline, level3, title and tags. It is either a CSV file with the header path,category,discipline,level3,title,tags
+    (tags separated by semicolons), or a JSON list of objects with those keys (tags as a list or semicolon separated).
+    Files are copied into the archive in a thread pool, and rows are written in one transaction per batch. Documents
+    already in the library are skipped, so an interrupted import is resumed by running it again."""
+
+import argparse
+import concurrent.futures
+import csv
+import getpass
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import database
+import ingest
+import lookup
+import schema
+
+import config
+import mode
+
+# Keys of each mapping entry
+mapping_keys = ['path', 'category', 'discipline', 'level3', 'title', 'tags']
+
+# Documents per transaction, and threads copying files, unless given on the command line
+default_batch_size = 500
+default_workers = 8
+
+
+def read_mapping(mapping_path):
+    """Read the mapping file describing the documents to import
+
+        Args:
+            mapping_path (str): Path to a CSV or JSON mapping file
+
+        Returns:
+            (list: dict): List of entries, each with every key in mapping_keys and tags as a list
+    """
+
+    with open(mapping_path, 'r', encoding='utf-8-sig', newline='') as file:
+        if mapping_path.lower().endswith('.json'):
+            ls_entry = json.load(file)
+        else:
+            ls_entry = list(csv.DictReader(file))
+
+    for entry in ls_entry:
+        for key in mapping_keys:
+            entry[key] = entry.get(key) or ""
+        # Tags are given as a semicolon separated string in CSV, and as either that or a list in JSON
+        _tags = entry['tags'].split(";") if isinstance(entry['tags'], str) else entry['tags']
+        entry['tags'] = [str(tag).strip().lower() for tag in _tags if str(tag).strip()]
+
+    return ls_entry
+
+
+def import_tree(directory, mapping_path, batch_size=default_batch_size, workers=default_workers, user=None,
+                link_duplicates=False):
+    """Import the documents of a directory tree described by a mapping file, reporting progress as it goes
+
+        Args:
+            directory (str): Root of the directory tree to import
+            mapping_path (str): Path to the CSV or JSON mapping file
+            batch_size (int): Number of documents written per transaction
+            workers (int): Number of threads copying files into the archive
+            user (str): User to record as having added the documents, the current user if None
+            link_duplicates (bool): Whether to hard-link files whose content is already archived instead of copying
+
+        Returns:
+            (dict): Counts of documents 'imported', 'skipped' as already in the library, and 'failed'
+    """
+
+    user = user or getpass.getuser()
+    conn = database.connect()
+    schema.migrate(conn)
+
+    # Resolve names in the mapping to ids, adding any missing level3's
+    lookup_cache = lookup.LookupCache()
+    lookup_cache.refresh()
+    category_to_id = dict((category, ident) for (ident, category) in lookup_cache.rows['Categories'])
+    discipline_to_id = dict((discipline, ident) for (ident, discipline) in lookup_cache.rows['Disciplines'])
+    ls_entry = read_mapping(mapping_path)
+    key_to_level3 = lookup.resolve_level3(lookup_cache, ls_entry, category_to_id, discipline_to_id)
+
+    # Build the pending documents, skipping those already imported by an earlier run
+    set_existing = ingest.existing_documents()
+    counts = dict(imported=0, skipped=0, failed=0)
+    ls_pending = []
+    for entry in ls_entry:
+        _source = os.path.join(directory, entry['path'])
+        if entry['category'] not in category_to_id or entry['discipline'] not in discipline_to_id:
+            print("Unknown category or discipline for %s" % entry['path'], file=sys.stderr)
+            counts['failed'] += 1
+            continue
+        if not os.path.isfile(_source):
+            print("Missing file %s" % _source, file=sys.stderr)
+            counts['failed'] += 1
+            continue
+
+        _category_id = category_to_id[entry['category']]
+        _discipline_id = discipline_to_id[entry['discipline']]
+        _level3_id = key_to_level3[(_category_id, _discipline_id, entry['level3'])] if entry['level3'] else None
+        pending = ingest.make_pending(_source, entry['title'] or os.path.splitext(os.path.basename(_source))[0],
+                                      _category_id, _discipline_id, _level3_id,
+                                      entry['category'], entry['discipline'], entry['level3'],
+                                      entry['tags'], user)
+
+        # Committed by an earlier run - only the rename into the archive may be outstanding
+        if (pending.file_name, _category_id, _discipline_id, _level3_id) in set_existing:
+            ingest.finish_staged(pending)
+            counts['skipped'] += 1
+            continue
+
+        set_existing.add((pending.file_name, _category_id, _discipline_id, _level3_id))
+        ls_pending.append(pending)
+
+    # Copy and commit in batches, reporting throughput after each
+    _time_start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(ls_pending), batch_size):
+            ls_batch = ls_pending[i:i + batch_size]
+            try:
+                # Hard-link files whose content is already archived or earlier in the batch, if asked to
+                if link_duplicates:
+                    ls_batch = ingest.fill_hashes(ls_batch, executor)
+                    hash_to_path = ingest.find_duplicates(conn, [pending.content_hash for pending in ls_batch])
+                    ls_batch = ingest.link_batch_duplicates([pending._replace(
+                        link_path=hash_to_path.get(pending.content_hash)) for pending in ls_batch])
+                _ls_doc_id, _tag_to_id, ls_unmoved = ingest.commit_documents(ls_batch, executor)
+                counts['imported'] += len(ls_batch)
+                for (_part_path, _path) in ls_unmoved:
+                    print("Cannot move %s into place, run again to finish" % _part_path, file=sys.stderr)
+            except (OSError, sqlite3.Error) as error:
+                print("Batch of %d failed: %s" % (len(ls_batch), error), file=sys.stderr)
+                counts['failed'] += len(ls_batch)
+
+            _elapsed = time.perf_counter() - _time_start
+            print("%d/%d files, %.1f files/s" % (i + len(ls_batch), len(ls_pending),
+                                                 counts['imported'] / _elapsed if _elapsed else 0.0))
+
+    return counts
+
+
+def main(argv=None):
+    """Parse the command line and run the import
+
+        Args:
+            argv (list: str): Command line arguments, sys.argv[1:] if None
+
+        Returns:
+            (int): Exit status - zero if every document was imported or already present
+    """
+
+    parser = argparse.ArgumentParser(description="Import a directory tree of documents into the library")
+    parser.add_argument('directory', help="root of the directory tree to import")
+    parser.add_argument('mapping', help="CSV or JSON file mapping each file to its category, discipline, level3, "
+                                        "title and tags")
+    parser.add_argument('--db', help="library database, instead of the configured one")
+    parser.add_argument('--archive', help="document archive, instead of the configured one")
+    parser.add_argument('--batch', type=int, default=default_batch_size, help="documents per transaction")
+    parser.add_argument('--workers', type=int, default=default_workers, help="threads copying files")
+    parser.add_argument('--user', help="user recorded as adding the documents")
+    parser.add_argument('--link-duplicates', action='store_true',
+                        help="hard-link files whose content is already archived instead of copying them")
+    args = parser.parse_args(argv)
+
+    # Load the configuration as the application does, then apply any overrides
+    if not (args.db and args.archive):
+        import wx
+        mode.set_mode(getattr(sys, 'frozen', False))
+        config.load_config(wx.App(False))
+    if args.db:
+        config.cfg['db_location'] = args.db
+    if args.archive:
+        config.cfg['document_archive'] = args.archive
+
+    _time_start = time.perf_counter()
+    counts = import_tree(args.directory, args.mapping, args.batch, args.workers, args.user, args.link_duplicates)
+    _elapsed = time.perf_counter() - _time_start
+
+    print("Imported %d, skipped %d already in the library, %d failed in %.1f s (%.1f files/s)" %
+          (counts['imported'], counts['skipped'], counts['failed'], _elapsed,
+           counts['imported'] / _elapsed if _elapsed else 0.0))
+
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""This module contains the background indexer that extracts the text of archived documents for full-text search"""
+
+import concurrent.futures
+import concurrent.futures.process
+import os
+import re
+import sys
+import threading
+import time
+import zipfile
+
+import config
+import database
+import fn_path
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# Most characters of extracted text kept per document
+max_content_length = 5000000
+
+# Extensions read directly as plain text
+plain_extensions = {'.txt', '.csv', '.md', '.log', '.xml', '.htm', '.html'}
+
+# Seconds before a document that was missing or failed to extract is tried again, by status - a missing file may be
+# one committed but not yet moved into place
+retry_delays = {'missing': 300.0,
+                'error': 86400.0}
+
+# Members of Office Open XML packages that hold the document text, by extension
+office_members = {'.docx': re.compile(r'word/document\.xml$'),
+                  '.xlsx': re.compile(r'xl/sharedStrings\.xml$'),
+                  '.pptx': re.compile(r'ppt/slides/slide\d+\.xml$')}
+
+
+def extract_text(path):
+    """Extract the text of a document - runs in a worker process, so must be a picklable top-level function
+
+        Args:
+            path (str): Path to the archived document
+
+        Returns:
+            (str): Status of the extraction - 'indexed', 'unsupported', 'missing' or 'error'
+            (str): The extracted text, empty unless indexed
+    """
+
+    _extension = os.path.splitext(path)[1].lower()
+
+    if not os.path.isfile(path):
+        return 'missing', ""
+
+    try:
+        if _extension in plain_extensions:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as file:
+                return 'indexed', file.read(max_content_length)
+
+        if _extension in office_members:
+            with zipfile.ZipFile(path) as package:
+                ls_xml = [package.read(name).decode('utf-8', errors='ignore') for name in package.namelist()
+                          if office_members[_extension].search(name)]
+            return 'indexed', re.sub(r'<[^>]+>', ' ', " ".join(ls_xml))[:max_content_length]
+
+        if _extension == '.pdf' and pypdf is not None:
+            ls_text = []
+            for page in pypdf.PdfReader(path).pages:
+                ls_text.append(page.extract_text() or "")
+                if sum(len(text) for text in ls_text) > max_content_length:
+                    break
+            return 'indexed', "\n".join(ls_text)[:max_content_length]
+    except Exception:
+        return 'error', ""
+
+    return 'unsupported', ""
+
+
+def fts_expression(search_string):
+    """Build an FTS5 MATCH expression for the words of a search string, the last of which may be incomplete
+
+        Args:
+            search_string (str): The text to search for
+
+        Returns:
+            (str): The MATCH expression, or None if the search string holds no words
+    """
+
+    ls_word = re.findall(r"\w+", search_string)
+    if not ls_word:
+        return None
+
+    return '"%s" *' % " ".join(ls_word)
+
+
+def search_contents(conn, search_string):
+    """Find the documents whose extracted text contains the words of the search string
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+            search_string (str): The text to search for
+
+        Returns:
+            (list: int): Sorted list of matching document ids
+    """
+
+    _expression = fts_expression(search_string)
+    if _expression is None:
+        return []
+
+    crsr = conn.cursor()
+    crsr.execute("SELECT rowid "
+                 "FROM Contents_fts "
+                 "WHERE Contents_fts MATCH (?) "
+                 "ORDER BY rowid;",
+                 (_expression,))
+    ls_id = [row[0] for row in crsr.fetchall()]
+    crsr.close()
+
+    return ls_id
+
+
+class ContentIndexer(object):
+    """Background indexer extracting the text of archived documents in a process pool
+
+        Progress is kept in the ContentIndex table, one row per document processed, so the indexer resumes from where
+        it stopped after a restart. Extracted text is written in batched transactions. Every client runs an indexer
+        over the shared database, so each write only keeps the documents no other indexer has written meanwhile.
+        Documents whose file was missing or could not be read are recorded with a time to try them again.
+
+        Class Variables:
+            scan_batch (int): Number of unindexed documents gathered per scan of the database
+            commit_batch (int): Number of documents written per transaction
+            idle_interval (float): Seconds between scans for new documents once everything is indexed
+            stop_timeout (float): Most seconds to wait on stopping for the documents in progress to be written
+
+        Attributes:
+            wake_event (threading.Event): Set to make the indexer scan for new documents immediately
+            stop_event (threading.Event): Set to stop the indexer
+            scanned_id (int): Largest document id scanned for new documents
+    """
+
+    scan_batch = 256
+    commit_batch = 32
+    idle_interval = 60.0
+    stop_timeout = 10.0
+
+    def __init__(self):
+        """Constructor"""
+
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.scanned_id = 0
+        self._thread = threading.Thread(target=self._run, name="content-indexer", daemon=True)
+
+    def start(self):
+        """Start indexing in the background"""
+
+        self._thread.start()
+
+    def wake(self):
+        """Scan for new documents now, such as after a document has been added"""
+
+        self.wake_event.set()
+
+    def stop(self, wait=False):
+        """Stop indexing once the documents in progress are written, leaving the rest for the next start
+
+            Args:
+                wait (bool): Wait, up to stop_timeout, for the indexer to finish writing
+        """
+
+        self.stop_event.set()
+        self.wake_event.set()
+        if wait and self._thread.is_alive():
+            self._thread.join(ContentIndexer.stop_timeout)
+
+    def pending(self, conn):
+        """Find documents not yet processed by the indexer, and those due to be tried again, with the path to each in
+        the archive
+
+            New documents are found past scanned_id, as ids only grow, so each document is scanned once per start.
+
+            Args:
+                conn (sqlite3.Connection): An open connection to the library database
+
+            Returns:
+                (list: tuple): List of (doc_id, path) tuples, at most scan_batch long
+        """
+
+        crsr = conn.cursor()
+        ls_row = []
+
+        # Documents added since the last scan, skipping those another indexer has already processed
+        while len(ls_row) < ContentIndexer.scan_batch:
+            crsr.execute("SELECT d.id, d.file_name, c.category, s.discipline, l.level3, x.doc_id "
+                         "FROM Documents d "
+                         "JOIN Categories c ON c.id = d.category "
+                         "JOIN Disciplines s ON s.id = d.discipline "
+                         "LEFT JOIN Level3 l ON l.id = d.level3 "
+                         "LEFT JOIN ContentIndex x ON x.doc_id = d.id "
+                         "WHERE d.id > (?) "
+                         "ORDER BY d.id "
+                         "LIMIT (?);",
+                         (self.scanned_id, ContentIndexer.scan_batch - len(ls_row)))
+            _ls_scanned = crsr.fetchall()
+            if not _ls_scanned:
+                break
+            self.scanned_id = _ls_scanned[-1][0]
+            ls_row += [row[:5] for row in _ls_scanned if row[5] is None]
+
+        # Documents that were missing or failed, once due to be tried again
+        if len(ls_row) < ContentIndexer.scan_batch:
+            crsr.execute("SELECT d.id, d.file_name, c.category, s.discipline, l.level3 "
+                         "FROM ContentIndex x "
+                         "JOIN Documents d ON d.id = x.doc_id "
+                         "JOIN Categories c ON c.id = d.category "
+                         "JOIN Disciplines s ON s.id = d.discipline "
+                         "LEFT JOIN Level3 l ON l.id = d.level3 "
+                         "WHERE x.retry_after <= (?) "
+                         "ORDER BY x.retry_after "
+                         "LIMIT (?);",
+                         (time.time(), ContentIndexer.scan_batch - len(ls_row)))
+            ls_row += crsr.fetchall()
+        crsr.close()
+
+        return [(ident, fn_path.concat_archive(file_name, category, discipline, level3))
+                for (ident, file_name, category, discipline, level3) in ls_row]
+
+    @staticmethod
+    def write(ls_extracted):
+        """Write a batch of extracted text and indexer progress in a single short write transaction
+
+            Documents already written by another indexer since they were found are left out.
+
+            Args:
+                ls_extracted (list: tuple): List of (doc_id, status, text) tuples
+
+            Returns:
+                (int): Number of documents written
+        """
+
+        _now = time.time()
+        with database.transaction(immediate=True) as conn:
+            # The write lock is held, so documents not yet processed cannot be claimed by another indexer meanwhile
+            _ls_id = [doc_id for (doc_id, status, text) in ls_extracted]
+            set_done = set(row[0] for row in
+                           conn.execute("SELECT doc_id FROM ContentIndex "
+                                        "WHERE doc_id IN (%s) AND (retry_after IS NULL OR retry_after > (?));" %
+                                        ",".join("?" * len(_ls_id)),
+                                        _ls_id + [_now]).fetchall())
+            ls_extracted = [extracted for extracted in ls_extracted if extracted[0] not in set_done]
+
+            conn.executemany("INSERT INTO Contents_fts (rowid, content) "
+                             "VALUES ((?), (?));",
+                             [(doc_id, text) for (doc_id, status, text) in ls_extracted if status == 'indexed'])
+            conn.executemany("INSERT OR REPLACE INTO ContentIndex (doc_id, status, retry_after) "
+                             "VALUES ((?), (?), (?));",
+                             [(doc_id, status, _now + retry_delays[status] if status in retry_delays else None)
+                              for (doc_id, status, text) in ls_extracted])
+
+        return len(ls_extracted)
+
+    def index_round(self, pool, ls_pending):
+        """Extract a scan's worth of documents in the process pool, writing results in batches as they complete
+
+            Args:
+                pool (concurrent.futures.ProcessPoolExecutor): The pool to extract in
+                ls_pending (list: tuple): List of (doc_id, path) tuples to extract
+        """
+
+        future_to_id = dict((pool.submit(extract_text, path), doc_id) for (doc_id, path) in ls_pending)
+        ls_extracted = []
+        for future in concurrent.futures.as_completed(future_to_id):
+            # On stopping, documents not yet started are left for the next start
+            if self.stop_event.is_set():
+                for _future in future_to_id:
+                    _future.cancel()
+            if future.cancelled():
+                continue
+            try:
+                _status, _text = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                raise
+            except Exception:
+                _status, _text = 'error', ""
+            ls_extracted.append((future_to_id[future], _status, _text))
+
+            if len(ls_extracted) >= ContentIndexer.commit_batch:
+                self.write(ls_extracted)
+                ls_extracted = []
+
+        if ls_extracted:
+            self.write(ls_extracted)
+
+        # Fold the log written by this round back into the database without waiting on readers
+        database.checkpoint()
+
+    def _run(self):
+        """Indexer loop - extract pending documents in the process pool, otherwise wait to be woken"""
+
+        conn = database.connect()
+        _workers = config.cfg.get('content_workers', max(1, (os.cpu_count() or 2) - 1))
+
+        while not self.stop_event.is_set():
+            # A pool broken by a crashed worker process is replaced
+            with concurrent.futures.ProcessPoolExecutor(max_workers=_workers) as pool:
+                while not self.stop_event.is_set():
+                    self.wake_event.clear()
+                    try:
+                        ls_pending = self.pending(conn)
+                        if not ls_pending:
+                            self.wake_event.wait(ContentIndexer.idle_interval)
+                            continue
+                        self.index_round(pool, ls_pending)
+                    except concurrent.futures.process.BrokenProcessPool as error:
+                        print("Content indexing pool failed, restarting it: %s" % error, file=sys.stderr)
+                        self.scanned_id = 0
+                        break
+                    except Exception as error:
+                        # Keep indexing in later rounds, scanning again from the start for the documents of the round
+                        # that failed, and waiting so a persistent fault does not spin
+                        print("Content indexing failed, retrying later: %s" % error, file=sys.stderr)
+                        self.scanned_id = 0
+                        self.wake_event.wait(ContentIndexer.idle_interval)
+
+        database.close()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""This module owns the connections to the library database - one long-lived connection per thread
+
+    Opening the database is the most expensive part of a short operation when it is hosted on a network share, so each
+    thread opens its connection once and reuses it, along with its cache of prepared statements. Connections wait up to
+    the configured busy timeout (config key 'busy_timeout', in seconds) for another user's lock to clear.
+
+    The journal mode is left as the database has it unless configured (config key 'journal_mode'). Setting 'wal' lets
+    searches read a snapshot while another user writes, rather than being locked out, but WAL relies on shared memory
+    between the processes using the database, so must only be opted into where every user runs on the same machine -
+    not where the users' machines share the file over a network file system. Write transactions take the write lock up
+    front, retrying with backoff while another writer holds it."""
+
+import contextlib
+import random
+import sqlite3
+import threading
+import time
+
+import config
+
+# Seconds a connection waits on a locked database before giving up, unless configured
+default_busy_timeout = 30.0
+
+# Synchronous setting applied to each connection in WAL mode, unless configured - other journal modes keep SQLite's
+# safer default
+default_synchronous = 'normal'
+
+# Pages written to the write-ahead log before it is checkpointed into the database, unless configured
+default_autocheckpoint = 1000
+
+# Attempts to begin a write transaction while the database is locked, the seconds each attempt waits on the lock, and
+# the first and largest delays between attempts - together bounding the wait to about ten seconds
+busy_retries = 8
+busy_attempt_timeout = 0.5
+busy_backoff = 0.05
+busy_backoff_max = 2.0
+
+# Prepared statements kept per connection
+cached_statements = 256
+
+_local = threading.local()
+
+
+def connect():
+    """Get the calling thread's connection to the library database, opening it on first use
+
+        Returns:
+            (sqlite3.Connection): The thread's long-lived connection
+    """
+
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(config.cfg['db_location'],
+                               timeout=config.cfg.get('busy_timeout', default_busy_timeout),
+                               cached_statements=cached_statements)
+        configure(conn)
+        _local.conn = conn
+
+    return conn
+
+
+def configure(conn):
+    """Apply the journal mode, synchronous setting and checkpoint policy to a new connection
+
+        Args:
+            conn (sqlite3.Connection): A newly opened connection to the library database
+    """
+
+    # The journal mode is kept in the database file, so only needs changing once - if another user holds a lock it
+    # is left for a later connection to change
+    _journal_mode = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+    if config.cfg.get('journal_mode') and _journal_mode != config.cfg['journal_mode'].lower():
+        try:
+            _journal_mode = conn.execute("PRAGMA journal_mode=%s;" % config.cfg['journal_mode']).fetchone()[0]
+        except sqlite3.OperationalError as error:
+            if not is_busy(error):
+                raise
+
+    # NORMAL only syncs at checkpoints in WAL mode, which cannot corrupt the database, only lose the latest commits
+    _synchronous = config.cfg.get('synchronous', default_synchronous if _journal_mode == 'wal' else None)
+    if _synchronous:
+        conn.execute("PRAGMA synchronous=%s;" % _synchronous)
+    if _journal_mode == 'wal':
+        conn.execute("PRAGMA wal_autocheckpoint=%d;" % config.cfg.get('wal_autocheckpoint', default_autocheckpoint))
+
+
+def is_busy(error):
+    """Whether a database error was caused by another connection holding a lock
+
+        Args:
+            error (sqlite3.OperationalError): The error raised
+
+        Returns:
+            (bool): True if the operation may succeed if retried
+    """
+
+    return "locked" in str(error) or "busy" in str(error)
+
+
+def begin(conn, immediate):
+    """Begin a transaction, retrying with randomized exponential backoff while the database is locked
+
+        Each attempt to take the write lock waits only busy_attempt_timeout rather than the connection's full busy
+        timeout, so a lock held by another user blocks the caller for about ten seconds at most before failing.
+
+        Args:
+            conn (sqlite3.Connection): The connection to begin the transaction on
+            immediate (bool): Whether to take the write lock at the start
+    """
+
+    if not immediate:
+        conn.execute("BEGIN;")
+        return
+
+    _busy_timeout = conn.execute("PRAGMA busy_timeout;").fetchone()[0]
+    conn.execute("PRAGMA busy_timeout=%d;" % int(busy_attempt_timeout * 1000))
+    try:
+        _delay = busy_backoff
+        for _attempt in range(busy_retries):
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+                return
+            except sqlite3.OperationalError as error:
+                if not is_busy(error) or _attempt == busy_retries - 1:
+                    raise
+            time.sleep(_delay * random.uniform(0.5, 1.5))
+            _delay = min(_delay * 2, busy_backoff_max)
+    finally:
+        conn.execute("PRAGMA busy_timeout=%d;" % _busy_timeout)
+
+
+def checkpoint(mode='PASSIVE'):
+    """Copy the write-ahead log back into the database from the calling thread's connection
+
+        Args:
+            mode (str): Checkpoint mode - PASSIVE never waits on other connections, TRUNCATE also empties the log
+
+        Returns:
+            (tuple): (busy, log pages, checkpointed pages) as reported by SQLite
+    """
+
+    return connect().execute("PRAGMA wal_checkpoint(%s);" % mode).fetchone()
+
+
+def close():
+    """Close the calling thread's connection, such as when a worker thread finishes"""
+
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextlib.contextmanager
+def transaction(immediate=False):
+    """Context manager running a block in a transaction on the calling thread's connection
+
+        The transaction is committed if the block completes and rolled back if it raises. A transaction begun inside
+        another on the same thread joins the outer one.
+
+        Writes should pass immediate, so a locked database is waited out before the transaction begins rather than
+        failing part way, and keep the block short - files are copied and values prepared before it.
+
+        Args:
+            immediate (bool): Whether to take the write lock at the start, rather than on the first write
+
+        Yields:
+            (sqlite3.Connection): The thread's connection
+    """
+
+    conn = connect()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    begin(conn, immediate)
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+@contextlib.contextmanager
+def cursor():
+    """Context manager providing a cursor on the calling thread's connection, closed after the block
+
+        Yields:
+            (sqlite3.Cursor): A new cursor
+    """
+
+    crsr = connect().cursor()
+    try:
+        yield crsr
+    finally:
+        crsr.close()
+
+
+def data_version():
+    """Get the calling thread's PRAGMA data_version, which changes whenever another connection commits a write
+
+        Returns:
+            (int): The data version
+    """
+
+    return connect().execute("PRAGMA data_version;").fetchone()[0]
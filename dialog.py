@@ -3,12 +3,9 @@
 
 import wx
 import os
-import shutil
-import datetime
-import sqlite3
 
-import config
-import fn_path
+import database
+import ingest
 import autocomplete
 
 
@@ -19,30 +16,35 @@ class AddDocument(wx.Dialog):
             parent (ref): Reference to the parent wx.object
             root_pane (ref): Reference to the root parts tab
             old_type (str): The value of the part's "type" before editing
+            ls_batch (list: ingest.PendingDocument): List to gather the document into for the caller to queue, or
+                                                     None to queue it when the dialog is committed
 
         Attributes:
             parent (ref): Reference to the parent wx.object
             root_pane (ref): Reference to the root parts tab
             old_type (str): The value of the part's "type" before editing
+            ls_batch (list: ingest.PendingDocument): List to gather the document into, or None
     """
 
-    def __init__(self, parent, root_pane, doc_path):
+    def __init__(self, parent, root_pane, doc_path, ls_batch=None):
         """Constructor"""
         super().__init__(parent)
 
         self.parent = parent
         self.root_pane = root_pane
         self.doc_path = doc_path
+        self.ls_batch = ls_batch
         self.doc_name = os.path.basename(doc_path)
+
+        # Refresh tags list, and any other lookups changed since last loaded
+        self.root_pane.load_lookups()
+
         self.ls_tags = list(self.root_pane.tag_to_id.keys())
         self.ls_category = list(self.root_pane.category_to_id.keys())
         self.ls_discipline = list(self.root_pane.discipline_to_id.keys())
 
         self.ls_add_tags = []
 
-        # Refresh tags list
-        self.root_pane.load_tags()
-
         # Type selection dropdown, with bind and sizer
         self.wgt_filename = wx.StaticText(self, label=self.doc_name, style=wx.ALIGN_CENTER)
         self.wgt_drop_category = wx.ComboBox(self, choices=self.ls_category, style=wx.CB_READONLY)
@@ -153,27 +155,18 @@ class AddDocument(wx.Dialog):
 
         if self.wgt_drop_discipline.GetValue() and self.wgt_drop_category.GetValue():
 
-            # Connect to the database
-            conn = sqlite3.connect(config.cfg['db_location'])
-            crsr = conn.cursor()
-
-            # Retrieve list of all tags from SQL database
-            crsr.execute("SELECT id, level3 "
-                         "FROM Level3 "
-                         "WHERE discipline_id=(?) "
-                         "AND category_id=(?);",
-                         (self.root_pane.discipline_to_id[self.wgt_drop_discipline.GetValue()],
-                          self.root_pane.category_to_id[self.wgt_drop_category.GetValue()]))
+            # Pick the level3's under the chosen discipline and category from the cached lookups
+            self.root_pane.load_lookups()
+            _discipline_id = self.root_pane.discipline_to_id[self.wgt_drop_discipline.GetValue()]
+            _category_id = self.root_pane.category_to_id[self.wgt_drop_category.GetValue()]
+            _level3_tuples = [(ident, level3) for (ident, level3, category_id, discipline_id)
+                              in self.root_pane.lookup_cache.rows['Level3']
+                              if discipline_id == _discipline_id and category_id == _category_id]
 
             # Set possible options for level 3 dropdown
-            _level3_tuples = crsr.fetchall()
             self.level3_to_id = dict((level3, ident) for (ident, level3) in _level3_tuples)
             self.wgt_drop_level3.SetItems([i[1] for i in _level3_tuples])
 
-            # Close connection
-            crsr.close()
-            conn.close()
-
     def evt_add_tag(self, event):
         """Execute when adding a tag to the list of tags for this document
 
@@ -205,48 +198,17 @@ class AddDocument(wx.Dialog):
             _level3_id = self.level3_to_id[self.wgt_drop_level3.GetValue()] if self.wgt_drop_level3.GetValue() else None
             _level3_name = self.wgt_drop_level3.GetValue()
 
-            # Add any new tags
-            self.root_pane.add_tags(self.ls_add_tags)
-
-            # try:
-            # Make directory if needed
-            _path = fn_path.concat_archive(self.doc_name, _category_name, _discipline_name, _level3_name)
-            if not os.path.exists(os.path.dirname(_path)):
-                os.makedirs(os.path.dirname(_path))
-
-            # Copy file
-            shutil.copy2(self.doc_path, _path)
-
-            # Connect to the database
-            conn = sqlite3.connect(config.cfg['db_location'])
-            crsr = conn.cursor()
-
-            # Add the new document to the library
-            crsr.execute("INSERT INTO Documents (file_name, title, category, discipline, level3, user, time_added) "
-                         "VALUES ((?), (?), (?), (?), (?), (?), (?));",
-                         (self.doc_name,
-                          self.wgt_title.GetValue(),
-                          _category_id,
-                          _discipline_id,
-                          _level3_id,
-                          self.root_pane.user,
-                          str(datetime.datetime.now().timestamp())))
-
-            # Get ids of the document added and of the tags associated with it
-            _doc_id = crsr.lastrowid
-            _tag_ids = [self.root_pane.tag_to_id[tag] for tag in self.ls_tags]
-
-            # Add the tags and document to the junction table
-            for _tag_id in _tag_ids:
-                print((".".join([str(_tag_id), str(_doc_id)]), _tag_id, _doc_id))
-                crsr.execute("INSERT INTO JunctionTable (name, tag_id, doc_id) "
-                             "VALUES ((?), (?), (?));",
-                             (".".join([str(_tag_id), str(_doc_id)]), _tag_id, _doc_id))
-
-            # Commit changes and close connection
-            conn.commit()
-            crsr.close()
-            conn.close()
+            # Gather the document, queueing it to be added in the background unless it is part of a batch the caller
+            # queues - its hash is filled in once computed
+            self.root_pane.hash_later(self.doc_path)
+            _pending = ingest.make_pending(self.doc_path, self.wgt_title.GetValue(),
+                                           _category_id, _discipline_id, _level3_id,
+                                           _category_name, _discipline_name, _level3_name,
+                                           self.ls_add_tags, self.root_pane.user)
+            if self.ls_batch is not None:
+                self.ls_batch.append(_pending)
+            else:
+                self.root_pane.add_documents([_pending])
 
             self.evt_close()
 
@@ -257,6 +219,9 @@ class AddDocument(wx.Dialog):
                 event: A button event object passed from the button click
         """
 
+        # Discard any hash of a document not added
+        self.root_pane.hash_futures.pop(self.doc_path, None)
+
         self.evt_close()
 
     def evt_close(self, *args):
@@ -355,21 +320,18 @@ class AddLevel3(wx.Dialog):
 
         if self.wgt_drop_discipline.GetValue() and self.wgt_drop_category.GetValue():
 
-            # Connect to the database
-            conn = sqlite3.connect(config.cfg['db_location'])
-            crsr = conn.cursor()
-
-            # Add the new document to the library
-            crsr.execute("INSERT INTO Level3 (category_id, discipline_id, level3) "
-                         "VALUES ((?), (?), (?));",
-                         (_category_id,
-                          _discipline_id,
-                          _level3_name))
-
-            # Commit changes and close connection
-            conn.commit()
-            crsr.close()
-            conn.close()
+            # Add the new level3 in a transaction on the shared connection
+            with database.transaction(immediate=True) as conn:
+                conn.execute("INSERT INTO Level3 (category_id, discipline_id, level3) "
+                             "VALUES ((?), (?), (?));",
+                             (_category_id,
+                              _discipline_id,
+                              _level3_name))
+
+            # Discard cached searches now out of date, and load the new level3
+            self.root_pane.invalidate_searches()
+            self.root_pane.lookup_cache.invalidate()
+            self.root_pane.load_lookups()
 
             self.evt_close()
 
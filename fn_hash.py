@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for hashing the content of files."""
+
+import hashlib
+
+# Bytes read at a time when hashing, so large files are never held in memory
+hash_chunk_size = 1 << 20
+
+
+def hash_file(path):
+    """Compute the SHA-256 hash of a file's content, reading it a chunk at a time
+
+        Args:
+            path (str): Path to the file
+
+        Returns:
+            (str): The hex digest
+    """
+
+    _hash = hashlib.sha256()
+    _buffer = bytearray(hash_chunk_size)
+    _view = memoryview(_buffer)
+    with open(path, 'rb', buffering=0) as file:
+        # hashlib releases the GIL on large updates, so files hash in parallel across threads
+        for _size in iter(lambda: file.readinto(_buffer), 0):
+            _hash.update(_view[:_size])
+
+    return _hash.hexdigest()
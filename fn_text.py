@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for normalizing text so that searches can compare it consistently."""
+
+import unicodedata
+
+
+def normalize(text):
+    """Convert text to its search form - casefolded, with accents and other combining marks stripped
+
+        Args:
+            text (str): The text to normalize, None is treated as empty
+
+        Returns:
+            (str): The normalized text
+    """
+
+    _decomposed = unicodedata.normalize('NFKD', (text or "").casefold())
+    return "".join(char for char in _decomposed if not unicodedata.combining(char))
+
+
+def substring_distance(pattern, text, max_distance):
+    """Find the least edit distance between a pattern and any substring of a text, giving up beyond a bound
+
+        Only rows of the edit distance table that can still finish within the bound are computed (Ukkonen's cut-off).
+
+        Args:
+            pattern (str): The text to look for
+            text (str): The text to look in
+            max_distance (int): The largest edit distance of interest
+
+        Returns:
+            (int): The least edit distance, or None if it exceeds max_distance
+    """
+
+    _m = len(pattern)
+    _over = max_distance + 1
+
+    # Matching may start anywhere in the text, so row zero is always zero
+    prev = [min(i, _over) for i in range(_m + 1)]
+    last = min(max_distance, _m)
+    best = prev[_m]
+
+    for char in text:
+        cur = [0] + [_over] * _m
+        left = 0
+        for i in range(1, min(last + 1, _m) + 1):
+            # Cheapest of substitution (or match), deletion and insertion, capped at the bound
+            value = prev[i - 1] + (pattern[i - 1] != char)
+            if prev[i] < value:
+                value = prev[i] + 1
+            if left < value:
+                value = left + 1
+            left = cur[i] = value if value < _over else _over
+
+        # Rows past the last one within bound cannot come back within bound
+        last = min(last + 1, _m)
+        while last > 0 and cur[last] > max_distance:
+            last -= 1
+
+        best = min(best, cur[_m])
+        if best == 0:
+            break
+        prev = cur
+
+    return best if best <= max_distance else None
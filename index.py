@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""This module contains in-memory indexes over the library database, used to answer searches without scanning it"""
+
+import array
+import bisect
+
+import fn_text
+
+
+def trigrams(text):
+    """Split text into the set of its overlapping three-character substrings
+
+        Args:
+            text (str): The (normalized) text to split
+
+        Returns:
+            (set: str): Set of the trigrams in the text
+    """
+
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def sorted_contains(posting, value):
+    """Test membership of a value in a sorted array by bisection
+
+        Args:
+            posting (array): A sorted array of integers
+            value (int): The value to look for
+
+        Returns:
+            (bool): True if the value is in the array
+    """
+
+    i = bisect.bisect_left(posting, value)
+    return i < len(posting) and posting[i] == value
+
+
+def intersect_sorted(ls_a, ls_b):
+    """Intersect two sorted sequences of integers, walking the shorter and bisecting into the longer
+
+        Args:
+            ls_a (sequence: int): A sorted sequence of integers
+            ls_b (sequence: int): A sorted sequence of integers
+
+        Returns:
+            (list: int): Sorted list of the integers present in both
+    """
+
+    if len(ls_a) > len(ls_b):
+        ls_a, ls_b = ls_b, ls_a
+    return [value for value in ls_a if sorted_contains(ls_b, value)]
+
+
+class TrigramIndex(object):
+    """In-memory trigram posting lists over the normalized file name and title of every document
+
+        Class Variables:
+            verify_threshold (int): Candidate count below which posting lists stop being intersected
+            fuzzy_chars_per_edit (int): Query characters per edit allowed by default in fuzzy searches
+            fuzzy_max_distance (int): Largest edit distance allowed in fuzzy searches
+
+        Attributes:
+            texts (dict: int -> tuple): Normalized (file_name, title) of each document, keyed by document id
+            postings (list: dict): Per field, a sorted array of document ids for each trigram
+            loaded_id (int): Largest document id read from the library database, documents added locally aside
+    """
+
+    verify_threshold = 64
+    fuzzy_chars_per_edit = 5
+    fuzzy_max_distance = 3
+
+    def __init__(self):
+        """Constructor"""
+
+        self.texts = {}
+        self.postings = [{}, {}]
+        self.loaded_id = 0
+
+    def load(self, conn):
+        """Build the index from every document in the library database
+
+            Args:
+                conn (sqlite3.Connection): An open connection to the library database
+        """
+
+        self.texts = {}
+        self.postings = [{}, {}]
+        self.loaded_id = 0
+        self.catch_up(conn)
+
+    def catch_up(self, conn):
+        """Add the documents written to the library since it was last read, such as by other users
+
+            Ids are given out in commit order, so every document not yet read has an id above the largest read so far.
+            Documents already added locally are skipped.
+
+            Args:
+                conn (sqlite3.Connection): An open connection to the library database
+
+            Returns:
+                (int): Number of documents added
+        """
+
+        crsr = conn.cursor()
+        crsr.execute("SELECT id, file_name_norm, title_norm "
+                     "FROM Documents "
+                     "WHERE id > (?) "
+                     "ORDER BY id;",
+                     (self.loaded_id,))
+
+        # Ids arrive in ascending order, so posting lists can mostly be appended to and remain sorted
+        _count = 0
+        for (ident, file_name_norm, title_norm) in crsr:
+            self.loaded_id = ident
+            if ident not in self.texts:
+                self._insert(ident, (file_name_norm or "", title_norm or ""))
+                _count += 1
+
+        crsr.close()
+
+        return _count
+
+    def add(self, doc_id, file_name, title):
+        """Add a newly inserted document to the index
+
+            Args:
+                doc_id (int): The id of the document in the Documents table
+                file_name (str): The file name of the document
+                title (str): The title of the document
+        """
+
+        self._insert(doc_id, (fn_text.normalize(file_name), fn_text.normalize(title)))
+
+    def _insert(self, doc_id, texts):
+        """Add a document's normalized texts and its id to the posting list of each of its trigrams
+
+            Args:
+                doc_id (int): The id of the document in the Documents table
+                texts (tuple: str): The normalized (file_name, title) of the document
+        """
+
+        self.texts[doc_id] = texts
+
+        for postings, text in zip(self.postings, texts):
+            for trigram in trigrams(text):
+                posting = postings.get(trigram)
+                if posting is None:
+                    postings[trigram] = array.array('q', [doc_id])
+                elif posting[-1] < doc_id:
+                    posting.append(doc_id)
+                else:
+                    posting.insert(bisect.bisect_left(posting, doc_id), doc_id)
+
+    def candidates(self, query_norm, field):
+        """Intersect the posting lists of the query's trigrams within one field
+
+            Args:
+                query_norm (str): The normalized query, at least three characters long
+                field (int): Index of the field to search in
+
+            Returns:
+                (set: int): Set of ids of documents containing every trigram of the query
+        """
+
+        postings = self.postings[field]
+
+        # Start from the rarest trigram, any missing trigram means there are no candidates
+        ls_posting = sorted((postings.get(trigram, ()) for trigram in trigrams(query_norm)), key=len)
+        if not ls_posting or not ls_posting[0]:
+            return set()
+
+        result = set(ls_posting[0])
+        for posting in ls_posting[1:]:
+            # Once few candidates remain it is cheaper to verify them directly
+            if len(result) < TrigramIndex.verify_threshold:
+                break
+            result = set(doc_id for doc_id in result if sorted_contains(posting, doc_id))
+
+        return result
+
+    def search(self, search_string, ls_searchin):
+        """Find the ids of all documents containing the search string in the chosen fields
+
+            Args:
+                search_string (str): The text to search for
+                ls_searchin (list: bool): Whether to search the file name and title respectively
+
+            Returns:
+                (list: int): Sorted list of matching document ids, or None if the query is too short for the index
+        """
+
+        query_norm = fn_text.normalize(search_string)
+        if len(query_norm) < 3:
+            return None
+
+        # Gather the candidates from each field being searched, then verify each against its normalized text
+        result = set()
+        for field, is_in in enumerate(ls_searchin[:len(self.postings)]):
+            if is_in:
+                result.update(doc_id for doc_id in self.candidates(query_norm, field)
+                              if query_norm in self.texts[doc_id][field])
+
+        return sorted(result)
+
+    def search_fuzzy(self, search_string, ls_searchin, max_distance=None):
+        """Find the documents containing an approximate match of the search string in the chosen fields
+
+            Candidates must share enough trigrams with the query to possibly be within the edit distance bound (the
+            q-gram lemma), so only the rarest trigrams are scanned for candidates and the rest are probed by bisection.
+            Surviving candidates are verified with a bounded edit distance.
+
+            Args:
+                search_string (str): The text to search for
+                ls_searchin (list: bool): Whether to search the file name and title respectively
+                max_distance (int): Largest edit distance accepted, defaults to one per fuzzy_chars_per_edit characters
+
+            Returns:
+                (list: tuple): List of (distance, doc_id) tuples, best match first, or None if the query is too short
+        """
+
+        query_norm = fn_text.normalize(search_string)
+        ls_trigram = list(trigrams(query_norm))
+        if not ls_trigram:
+            return None
+
+        # Each edit destroys at most three trigrams, and at least one trigram must survive to find any candidate
+        if max_distance is None:
+            max_distance = max(1, len(query_norm) // TrigramIndex.fuzzy_chars_per_edit)
+        max_distance = min(max_distance, (len(ls_trigram) - 1) // 3, TrigramIndex.fuzzy_max_distance)
+        _min_shared = len(ls_trigram) - 3 * max_distance
+
+        result = {}
+        for field, is_in in enumerate(ls_searchin[:len(self.postings)]):
+            if not is_in:
+                continue
+
+            # Any document sharing enough trigrams must contain one of the rarest few
+            ls_posting = sorted((self.postings[field].get(trigram, ()) for trigram in ls_trigram), key=len)
+            _n_scan = len(ls_posting) - _min_shared + 1
+            shared = {}
+            for posting in ls_posting[:_n_scan]:
+                for doc_id in posting:
+                    shared[doc_id] = shared.get(doc_id, 0) + 1
+
+            for doc_id, count in shared.items():
+                # Probe the commoner trigrams, abandoning the candidate once it cannot reach the minimum
+                for j, posting in enumerate(ls_posting[_n_scan:]):
+                    if count >= _min_shared or count + len(ls_posting) - _n_scan - j < _min_shared:
+                        break
+                    count += sorted_contains(posting, doc_id)
+                if count < _min_shared:
+                    continue
+
+                _distance = fn_text.substring_distance(query_norm, self.texts[doc_id][field], max_distance)
+                if _distance is not None and _distance < result.get(doc_id, max_distance + 1):
+                    result[doc_id] = _distance
+
+        return sorted((distance, doc_id) for (doc_id, distance) in result.items())
+
+
+class TagIndex(object):
+    """In-memory posting lists mapping each tag to the sorted array of ids of the documents carrying it
+
+        Attributes:
+            postings (dict: int -> array): Sorted array of document ids for each tag id
+            doc_tags (dict: int -> list): List of tag ids carried by each document, keyed by document id
+            loaded_doc_id (int): Largest document id read from the junction table, documents added locally aside
+    """
+
+    def __init__(self):
+        """Constructor"""
+
+        self.postings = {}
+        self.doc_tags = {}
+        self.loaded_doc_id = 0
+
+    def load(self, conn):
+        """Build the index from the junction table of the library database
+
+            Args:
+                conn (sqlite3.Connection): An open connection to the library database
+        """
+
+        self.postings = {}
+        self.doc_tags = {}
+        self.loaded_doc_id = 0
+
+        crsr = conn.cursor()
+        crsr.execute("SELECT tag_id, doc_id "
+                     "FROM JunctionTable "
+                     "ORDER BY tag_id, doc_id;")
+
+        for (tag_id, doc_id) in crsr:
+            self.add(doc_id, [tag_id])
+            self.loaded_doc_id = max(self.loaded_doc_id, doc_id)
+
+        crsr.close()
+
+    def catch_up(self, conn):
+        """Add the tags of documents written to the library since it was last read, such as by other users
+
+            A document's tags are written in the same transaction as the document, and ids are given out in commit
+            order, so every document not yet read has an id above the largest read so far.
+
+            Args:
+                conn (sqlite3.Connection): An open connection to the library database
+        """
+
+        crsr = conn.cursor()
+        crsr.execute("SELECT tag_id, doc_id "
+                     "FROM JunctionTable "
+                     "WHERE doc_id > (?) "
+                     "ORDER BY doc_id, tag_id;",
+                     (self.loaded_doc_id,))
+
+        # Tags already added locally are skipped by add()
+        for (tag_id, doc_id) in crsr:
+            self.add(doc_id, [tag_id])
+            self.loaded_doc_id = doc_id
+
+        crsr.close()
+
+    def add(self, doc_id, ls_tag_id):
+        """Add a document to the posting list of each of its tags
+
+            Args:
+                doc_id (int): The id of the document in the Documents table
+                ls_tag_id (list: int): List of ids of the tags associated with the document
+        """
+
+        for tag_id in ls_tag_id:
+            posting = self.postings.get(tag_id)
+            if posting is None:
+                self.postings[tag_id] = array.array('q', [doc_id])
+            elif posting[-1] < doc_id:
+                posting.append(doc_id)
+            elif not sorted_contains(posting, doc_id):
+                posting.insert(bisect.bisect_left(posting, doc_id), doc_id)
+            else:
+                continue
+            self.doc_tags.setdefault(doc_id, []).append(tag_id)
+
+    def match(self, ls_tag_id, match_all=True):
+        """Find the documents carrying all, or any, of the given tags
+
+            Args:
+                ls_tag_id (list: int): List of tag ids to match, unknown tags may be given as None
+                match_all (bool): If true documents must carry every tag, otherwise any one of them
+
+            Returns:
+                (list: int): Sorted list of matching document ids
+        """
+
+        ls_posting = [self.postings.get(tag_id, ()) for tag_id in ls_tag_id]
+        if not ls_posting:
+            return []
+
+        if not match_all:
+            return sorted(set().union(*ls_posting))
+
+        # Intersect from the rarest tag upwards so each step only walks the surviving ids
+        ls_posting.sort(key=len)
+        result = list(ls_posting[0])
+        for posting in ls_posting[1:]:
+            if not result:
+                break
+            result = intersect_sorted(result, posting)
+
+        return result
@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+"""This module contains the pipeline that adds documents to the library in batches
+
+    Documents are gathered as PendingDocument records and committed together - files are first copied into the archive
+    under temporary names, then the documents, any new tags and the junction rows are written in one transaction, and
+    only once that commits are the files moved into place. A failure at any stage leaves neither rows nor files behind.
+
+    Each document's SHA-256 content hash is stored with it, so a file already in the archive can be found by lookup and
+    hard-linked rather than copied again - as can a file added earlier in the same batch.
+
+    The helpers relating files in the archive to the documents of the library, shared by the archive tools, are here
+    too."""
+
+import collections
+import concurrent.futures
+import datetime
+import os
+import threading
+
+import archive_copy
+import config
+import database
+import fn_hash
+import fn_path
+import fn_text
+
+# Suffix of archive copies not yet committed
+partial_suffix = ".part"
+
+# Largest number of values bound in a single IN list
+id_chunk_size = 500
+
+# A document waiting to be committed - content_hash is filled in before committing if not known, and link_path names
+# an archived copy of the same content to hard-link from instead of copying
+PendingDocument = collections.namedtuple('PendingDocument', ['source_path', 'file_name', 'title',
+                                                             'category_id', 'discipline_id', 'level3_id',
+                                                             'category', 'discipline', 'level3',
+                                                             'tags', 'user', 'time_added',
+                                                             'content_hash', 'link_path'],
+                                         defaults=(None, None))
+
+
+def make_pending(source_path, title, category_id, discipline_id, level3_id, category, discipline, level3, tags, user,
+                 content_hash=None):
+    """Build the record of a document waiting to be committed, stamped with the time it was prepared
+
+        Args:
+            source_path (str): Path to the file to add
+            title (str): Title of the document
+            category_id (int): Id of the document's category
+            discipline_id (int): Id of the document's discipline
+            level3_id (int): Id of the document's level3, or None
+            category (str): Name of the category, for the archive path
+            discipline (str): Name of the discipline, for the archive path
+            level3 (str): Name of the level3 for the archive path, or None
+            tags (list: str): Tags to give the document, new or existing
+            user (str): User adding the document
+            content_hash (str): Hash of the file's content if already computed, otherwise None
+
+        Returns:
+            (PendingDocument): The pending document
+    """
+
+    return PendingDocument(source_path, os.path.basename(source_path), title,
+                           category_id, discipline_id, level3_id,
+                           category, discipline, level3 or None,
+                           list(dict.fromkeys(tags)), user, str(datetime.datetime.now().timestamp()),
+                           content_hash)
+
+
+def fill_hashes(ls_pending, executor=None):
+    """Hash the content of any pending documents not yet hashed
+
+        Args:
+            ls_pending (list: PendingDocument): The pending documents
+            executor (concurrent.futures.Executor): Pool to hash the files in parallel with, or None to hash in turn
+
+        Returns:
+            (list: PendingDocument): The pending documents, each with its content_hash
+    """
+
+    ls_path = [pending.source_path for pending in ls_pending if pending.content_hash is None]
+    path_to_hash = dict(zip(ls_path, (executor.map if executor else map)(fn_hash.hash_file, ls_path)))
+
+    return [pending if pending.content_hash is not None else
+            pending._replace(content_hash=path_to_hash[pending.source_path]) for pending in ls_pending]
+
+
+def find_duplicates(conn, ls_hash):
+    """Find archived documents with the given content hashes
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+            ls_hash (list: str): Content hashes to look for
+
+        Returns:
+            (dict): Mapping of each hash found to the archive path of a document with that content
+    """
+
+    ls_hash = list(dict.fromkeys(ls_hash))
+    hash_to_path = {}
+    for i in range(0, len(ls_hash), id_chunk_size):
+        _chunk = ls_hash[i:i + id_chunk_size]
+        crsr = conn.execute("SELECT d.content_hash, d.file_name, c.category, s.discipline, l.level3 "
+                            "FROM Documents d "
+                            "JOIN Categories c ON c.id = d.category "
+                            "JOIN Disciplines s ON s.id = d.discipline "
+                            "LEFT JOIN Level3 l ON l.id = d.level3 "
+                            "WHERE d.content_hash IN (%s);" % ",".join("?" * len(_chunk)),
+                            _chunk)
+        for (content_hash, file_name, category, discipline, level3) in crsr.fetchall():
+            _path = fn_path.concat_archive(file_name, category, discipline, level3)
+            if content_hash not in hash_to_path and os.path.isfile(_path):
+                hash_to_path[content_hash] = _path
+        crsr.close()
+
+    return hash_to_path
+
+
+def link_batch_duplicates(ls_pending):
+    """Link each pending document to the first earlier in the batch with the same content, rather than copying it again
+
+        Documents already linked to an archived copy are left as they are, and later copies of their content are
+        linked to that same archived copy.
+
+        Args:
+            ls_pending (list: PendingDocument): The pending documents, each with its content_hash
+
+        Returns:
+            (list: PendingDocument): The pending documents, later copies of the same content linked to the first
+    """
+
+    hash_to_path = {}
+    ls_linked = []
+    for pending in ls_pending:
+        if pending.content_hash is not None:
+            _path = hash_to_path.setdefault(pending.content_hash, pending.link_path or archive_path(pending))
+            if pending.link_path is None and _path != archive_path(pending):
+                pending = pending._replace(link_path=_path)
+        ls_linked.append(pending)
+
+    return ls_linked
+
+
+def archive_path(pending):
+    """Get the path a pending document is archived at
+
+        Args:
+            pending (PendingDocument): The pending document
+
+        Returns:
+            (str): Path in the document archive
+    """
+
+    return fn_path.concat_archive(pending.file_name, pending.category, pending.discipline, pending.level3)
+
+
+def stage_file(pending, fn_progress=None):
+    """Copy the file of a pending document into the archive under a temporary name
+
+        Args:
+            pending (PendingDocument): The pending document
+            fn_progress (callable): Function called with (bytes copied, total bytes) as the copy proceeds, or None
+
+        Returns:
+            (tuple): (temporary path, final path)
+    """
+
+    _path = archive_path(pending)
+    os.makedirs(os.path.dirname(_path), exist_ok=True)
+
+    # Share the archived copy of identical content where the file system allows - a copy staged earlier in the same
+    # batch is still under its temporary name
+    if pending.link_path is not None:
+        _link_path = pending.link_path
+        if not os.path.exists(_link_path) and os.path.exists(_link_path + partial_suffix):
+            _link_path += partial_suffix
+        try:
+            os.link(_link_path, _path + partial_suffix)
+            return _path + partial_suffix, _path
+        except OSError:
+            pass
+
+    archive_copy.copy_file(pending.source_path, _path + partial_suffix, pending.content_hash, fn_progress)
+
+    return _path + partial_suffix, _path
+
+
+def stage_files(ls_pending, executor=None, fn_progress=None):
+    """Copy the files of pending documents into the archive under temporary names
+
+        Args:
+            ls_pending (list: PendingDocument): The pending documents
+            executor (concurrent.futures.Executor): Pool to copy the files in parallel with, or None to copy in turn
+            fn_progress (callable): Function called with (bytes copied, total bytes) over all the files as the copies
+                                    proceed, from whichever thread is copying, or None
+
+        Returns:
+            (list: tuple): List of (temporary path, final path) tuples, one per document
+    """
+
+    # Total the progress of every copy, which may be running in parallel
+    _total = sum(os.path.getsize(pending.source_path) for pending in ls_pending)
+    _lock = threading.Lock()
+    ls_copied = [0] * len(ls_pending)
+    _sum = [0]
+
+    def file_progress(i):
+        if fn_progress is None:
+            return None
+
+        def fn_file_progress(done, total):
+            with _lock:
+                _sum[0] += done - ls_copied[i]
+                ls_copied[i] = done
+                _sum_copied = _sum[0]
+            fn_progress(_sum_copied, _total)
+
+        return fn_file_progress
+
+    # Documents linked to another in the same batch are staged once it is, so there is a copy to link from
+    _set_path = set(archive_path(pending) for pending in ls_pending)
+    ls_wave = [[i for i, pending in enumerate(ls_pending) if pending.link_path not in _set_path],
+               [i for i, pending in enumerate(ls_pending) if pending.link_path in _set_path]]
+
+    ls_staged = [None] * len(ls_pending)
+    try:
+        for ls_index in ls_wave:
+            if executor is None:
+                for i in ls_index:
+                    ls_staged[i] = stage_file(ls_pending[i], file_progress(i))
+                continue
+
+            # Wait for every copy, so none is left running if one fails
+            ls_future = [(i, executor.submit(stage_file, ls_pending[i], file_progress(i))) for i in ls_index]
+            concurrent.futures.wait([future for (i, future) in ls_future])
+            for (i, future) in ls_future:
+                if future.exception() is None:
+                    ls_staged[i] = future.result()
+            ls_error = [future.exception() for (i, future) in ls_future if future.exception() is not None]
+            if ls_error:
+                raise ls_error[0]
+    except BaseException:
+        discard_files([staged for staged in ls_staged if staged is not None])
+        raise
+
+    return ls_staged
+
+
+def discard_files(ls_staged):
+    """Remove temporary archive copies that will not be committed
+
+        Args:
+            ls_staged (list: tuple): List of (temporary path, final path) tuples
+    """
+
+    for (_part_path, _path) in ls_staged:
+        if os.path.exists(_part_path):
+            os.remove(_part_path)
+
+
+def move_staged(ls_staged):
+    """Move committed temporary archive copies into place
+
+        Args:
+            ls_staged (list: tuple): List of (temporary path, final path) tuples
+
+        Returns:
+            (list: tuple): The tuples of copies that could not be moved, left under their temporary names
+    """
+
+    ls_unmoved = []
+    for (_part_path, _path) in ls_staged:
+        try:
+            os.replace(_part_path, _path)
+        except OSError:
+            # A copy already moved into place by an earlier attempt or another client is done
+            if os.path.exists(_part_path) or not os.path.exists(_path):
+                ls_unmoved.append((_part_path, _path))
+
+    return ls_unmoved
+
+
+def finish_staged(pending):
+    """Move a committed document's temporary archive copy into place, if an interruption left it behind
+
+        Args:
+            pending (PendingDocument): A pending document already committed to the library
+
+        Returns:
+            (bool): True if a temporary copy was moved into place
+    """
+
+    _path = archive_path(pending)
+    if not os.path.exists(_path) and os.path.exists(_path + partial_suffix):
+        os.replace(_path + partial_suffix, _path)
+        return True
+
+    return False
+
+
+def recover_staged(conn):
+    """Move into place the temporary archive copies of committed documents that an interruption left behind, such as
+    the application closing between committing documents and moving their files
+
+        Copies of documents not in the library are left alone, as they may still be being added.
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+
+        Returns:
+            (int): Number of copies moved into place
+            (list: tuple): List of (temporary path, final path) tuples of the copies that could not be moved
+    """
+
+    _root = config.cfg['document_archive']
+    ls_part = [path for (path, size, mtime_ns) in walk_archive(_root) if path.endswith(partial_suffix)]
+    if not ls_part:
+        return 0, []
+
+    path_to_docs = catalogued_documents(conn)
+    ls_staged = []
+    for _part in ls_part:
+        _relative = _part[:-len(partial_suffix)]
+        _path = os.path.join(_root, *_relative.split("/"))
+        if _relative in path_to_docs and not os.path.exists(_path):
+            ls_staged.append((_path + partial_suffix, _path))
+    ls_unmoved = move_staged(ls_staged)
+
+    return len(ls_staged) - len(ls_unmoved), ls_unmoved
+
+
+def write_documents(conn, ls_pending):
+    """Write pending documents, their new tags and their junction rows - must be called in a write transaction
+
+        Args:
+            conn (sqlite3.Connection): The connection, in a write transaction so that document ids can be assigned
+            ls_pending (list: PendingDocument): The pending documents
+
+        Returns:
+            (list: int): The id given to each document, in order
+            (dict): Mapping of each tag used to its id
+    """
+
+    # Add tags not already in the library, then look up the ids of every tag used - both by exact name, through the
+    # Tags_tag_exact index
+    ls_tag = list(dict.fromkeys(tag for pending in ls_pending for tag in pending.tags))
+    conn.executemany("INSERT INTO Tags (tag) "
+                     "SELECT (?) WHERE NOT EXISTS (SELECT 1 FROM Tags WHERE tag = (?));",
+                     [(tag, tag) for tag in ls_tag])
+    tag_to_id = {}
+    for i in range(0, len(ls_tag), id_chunk_size):
+        _chunk = ls_tag[i:i + id_chunk_size]
+        tag_to_id.update((tag, ident) for (ident, tag) in
+                         conn.execute("SELECT id, tag FROM Tags WHERE tag IN (%s);" % ",".join("?" * len(_chunk)),
+                                      _chunk).fetchall())
+
+    # The write lock is held, so the ids following the largest are free to assign up front
+    _first_id = conn.execute("SELECT coalesce(max(id), 0) + 1 FROM Documents;").fetchone()[0]
+    ls_doc_id = list(range(_first_id, _first_id + len(ls_pending)))
+
+    conn.executemany("INSERT INTO Documents (id, file_name, title, category, discipline, level3, user, time_added, "
+                     "file_name_norm, title_norm, content_hash) "
+                     "VALUES ((?), (?), (?), (?), (?), (?), (?), (?), (?), (?), (?));",
+                     [(doc_id, pending.file_name, pending.title, pending.category_id, pending.discipline_id,
+                       pending.level3_id, pending.user, pending.time_added,
+                       fn_text.normalize(pending.file_name), fn_text.normalize(pending.title), pending.content_hash)
+                      for doc_id, pending in zip(ls_doc_id, ls_pending)])
+
+    conn.executemany("INSERT INTO JunctionTable (name, tag_id, doc_id) "
+                     "VALUES ((?), (?), (?));",
+                     [(".".join([str(tag_to_id[tag]), str(doc_id)]), tag_to_id[tag], doc_id)
+                      for doc_id, pending in zip(ls_doc_id, ls_pending) for tag in pending.tags])
+
+    return ls_doc_id, tag_to_id
+
+
+def commit_documents(ls_pending, executor=None, fn_progress=None):
+    """Add a batch of pending documents to the library, all or nothing
+
+        Once the documents are committed the call succeeds, even if a file could not then be moved into place - it is
+        left under its temporary name, and returned to be moved later with move_staged.
+
+        Args:
+            ls_pending (list: PendingDocument): The pending documents
+            executor (concurrent.futures.Executor): Pool to hash and copy the files in parallel with, or None to do
+                                                    each in turn
+            fn_progress (callable): Function called with (bytes copied, total bytes) as the files are copied, or None
+
+        Returns:
+            (list: int): The id given to each document, in order
+            (dict): Mapping of each tag used to its id
+            (list: tuple): List of (temporary path, final path) tuples of the files that could not be moved into place
+    """
+
+    if not ls_pending:
+        return [], {}, []
+
+    # Hash and copy outside the transaction, so the write lock is only held for the inserts
+    ls_pending = fill_hashes(ls_pending, executor)
+    ls_staged = stage_files(ls_pending, executor, fn_progress)
+    try:
+        with database.transaction(immediate=True) as conn:
+            ls_doc_id, tag_to_id = write_documents(conn, ls_pending)
+    except BaseException:
+        discard_files(ls_staged)
+        raise
+
+    # Move the committed files into place - the documents are committed, so failing now would have a retry add them
+    # again, and a file that cannot be moved is instead left under its temporary name and handed back
+    ls_unmoved = move_staged(ls_staged)
+
+    return ls_doc_id, tag_to_id, ls_unmoved
+
+
+def relative_path(path):
+    """Express a path in the archive relative to the archive, with forward slashes whatever the platform
+
+        Args:
+            path (str): Path to a file in the document archive
+
+        Returns:
+            (str): The path relative to the archive
+    """
+
+    return os.path.relpath(path, config.cfg['document_archive']).replace(os.sep, "/")
+
+
+def walk_archive(root):
+    """Walk the archive, yielding every file with its size and modification time
+
+        Temporary files written by the copy engine, named with a leading dot, are skipped.
+
+        Args:
+            root (str): Root of the document archive
+
+        Yields:
+            (tuple): (relative path, size, modification time in nanoseconds)
+    """
+
+    ls_dir = [root]
+    while ls_dir:
+        try:
+            it_entry = os.scandir(ls_dir.pop())
+        except OSError as error:
+            print("Cannot read %s: %s" % (error.filename, error.strerror), file=sys.stderr)
+            continue
+
+        with it_entry:
+            for entry in it_entry:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    ls_dir.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    _stat = entry.stat(follow_symlinks=False)
+                    yield relative_path(entry.path), _stat.st_size, _stat.st_mtime_ns
+
+
+def catalogued_documents(conn):
+    """Find where each document in the library should be archived
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+
+        Returns:
+            (dict): Mapping of relative archive path to a list of (document id, content hash) tuples
+    """
+
+    path_to_docs = {}
+    crsr = conn.execute("SELECT d.id, d.content_hash, d.file_name, c.category, s.discipline, l.level3 "
+                        "FROM Documents d "
+                        "JOIN Categories c ON c.id = d.category "
+                        "JOIN Disciplines s ON s.id = d.discipline "
+                        "LEFT JOIN Level3 l ON l.id = d.level3;")
+    for (ident, content_hash, file_name, category, discipline, level3) in crsr.fetchall():
+        _path = relative_path(fn_path.concat_archive(file_name, category, discipline, level3))
+        path_to_docs.setdefault(_path, []).append((ident, content_hash))
+    crsr.close()
+
+    return path_to_docs
+
+
+def existing_documents():
+    """Find the documents already in the library, by where they are archived
+
+        Returns:
+            (set: tuple): Set of (file name, category id, discipline id, level3 id) tuples
+    """
+
+    with database.cursor() as crsr:
+        crsr.execute("SELECT file_name, category, discipline, level3 "
+                     "FROM Documents;")
+        return set(crsr.fetchall())
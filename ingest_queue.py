@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""This module contains the background queue that documents are added to the library through
+
+    Adding documents enqueues a job and returns at once. Each job is committed in one transaction, all or nothing. A
+    pool of worker threads takes the jobs waiting at the time, up to a limit, and commits them together through the
+    ingest pipeline - so jobs queued in quick succession share a transaction. If a combined commit fails, its jobs are
+    committed one at a time so only the job at fault fails.
+    Failed jobs keep their pending documents, so they can be retried without entering their details again."""
+
+import collections
+import threading
+import time
+
+import ingest
+
+
+class IngestJob(object):
+    """A batch of documents to add to the library, and how adding it went
+
+        Args:
+            ls_pending (list: ingest.PendingDocument): The documents to add
+
+        Attributes:
+            ls_pending (list: ingest.PendingDocument): The documents to add
+            status (str): 'queued', 'running', 'done' or 'failed'
+            error (Exception): The error the job last failed with, or None
+            attempts (int): Number of times the job has been run
+            is_prepared (bool): Whether the queue's prepare function has run on the documents
+            ls_doc_id (list: int): The id given to each document once done
+            tag_to_id (dict): Mapping of each tag used to its id once done
+            ls_unmoved (list: tuple): List of (temporary path, final path) tuples of the job's files that could not be
+                                      moved into the archive once done
+    """
+
+    def __init__(self, ls_pending):
+        """Constructor"""
+
+        self.ls_pending = list(ls_pending)
+        self.status = 'queued'
+        self.error = None
+        self.attempts = 0
+        self.is_prepared = False
+        self.ls_doc_id = None
+        self.tag_to_id = None
+        self.ls_unmoved = []
+
+
+class IngestQueue(object):
+    """Queue of ingest jobs processed by a pool of worker threads
+
+        Class Variables:
+            max_batch (int): Most documents of waiting jobs combined into one transaction - a larger job is still
+                             committed whole
+            throughput_window (float): Seconds of completed jobs averaged over for the throughput
+            status_interval (float): Least seconds between status reports while files are copying
+
+        Args:
+            dispatch (callable): Function that runs a callable on the GUI thread, such as wx.CallAfter
+            fn_prepare (callable): Function run on a worker with a job's pending documents before they are committed,
+                                   returning them ready to commit - or None
+            fn_done (callable): Function dispatched with each job once done, or None
+            fn_status (callable): Function dispatched with a line describing the queue whenever it changes, or None
+            workers (int): Number of worker threads
+
+        Attributes:
+            ls_failed (list: IngestJob): Jobs that failed, in the order they failed
+            ls_unmoved (list: tuple): List of (temporary path, final path) tuples of committed files that could not be
+                                      moved into the archive, to be moved again on retrying
+    """
+
+    max_batch = 100
+    throughput_window = 60.0
+    status_interval = 0.2
+
+    def __init__(self, dispatch, fn_prepare=None, fn_done=None, fn_status=None, workers=2):
+        """Constructor"""
+
+        self.dispatch = dispatch
+        self.fn_prepare = fn_prepare
+        self.fn_done = fn_done
+        self.fn_status = fn_status
+        self.ls_failed = []
+        self.ls_unmoved = []
+
+        self._lock = threading.Condition()
+        self._waiting = collections.deque()
+        self._running = 0
+        self._completed = collections.deque()
+        self._copied = {}
+        self._time_status = 0.0
+
+        for i in range(workers):
+            threading.Thread(target=self._run, name="ingest-%d" % i, daemon=True).start()
+
+    def submit(self, ls_pending):
+        """Queue documents to be added to the library
+
+            Args:
+                ls_pending (list: ingest.PendingDocument): The documents to add
+
+            Returns:
+                (IngestJob): The queued job
+        """
+
+        job = IngestJob(ls_pending)
+        with self._lock:
+            self._waiting.append(job)
+            self._lock.notify()
+        self.report()
+
+        return job
+
+    def retry(self, job):
+        """Queue a failed job again, with the documents as they were first entered
+
+            Args:
+                job (IngestJob): A failed job
+        """
+
+        with self._lock:
+            if job.status != 'failed':
+                return
+            self.ls_failed.remove(job)
+            job.status = 'queued'
+            self._waiting.append(job)
+            self._lock.notify()
+        self.report()
+
+    def retry_failed(self):
+        """Queue every failed job again, and try again to move committed files that could not be moved into place
+
+            Returns:
+                (int): Number of jobs queued again and files tried again
+        """
+
+        ls_job = list(self.ls_failed)
+        for job in ls_job:
+            self.retry(job)
+
+        with self._lock:
+            ls_unmoved, self.ls_unmoved = self.ls_unmoved, []
+        if ls_unmoved:
+            self.add_unmoved(ingest.move_staged(ls_unmoved))
+            self.report()
+
+        return len(ls_job) + len(ls_unmoved)
+
+    def add_unmoved(self, ls_staged):
+        """Keep committed files that could not be moved into the archive, to be moved again on retrying
+
+            Args:
+                ls_staged (list: tuple): List of (temporary path, final path) tuples
+        """
+
+        if not ls_staged:
+            return
+        with self._lock:
+            self.ls_unmoved.extend(ls_staged)
+        self.report()
+
+    def is_busy(self):
+        """Whether any job is waiting or in progress
+
+            Returns:
+                (bool): True if the queue has work left
+        """
+
+        with self._lock:
+            return bool(self._waiting) or self._running > 0
+
+    def throughput(self):
+        """Documents added per second over the recent window
+
+            Returns:
+                (float): The throughput
+        """
+
+        _now = time.perf_counter()
+        with self._lock:
+            while self._completed and self._completed[0][0] < _now - IngestQueue.throughput_window:
+                self._completed.popleft()
+            if not self._completed:
+                return 0.0
+            _count = sum(count for (_time, count) in self._completed)
+            _span = max(_now - self._completed[0][0], 1.0)
+
+        return _count / _span
+
+    def describe(self):
+        """Describe the state of the queue for the status bar
+
+            Returns:
+                (str): The description
+        """
+
+        with self._lock:
+            _waiting = sum(len(job.ls_pending) for job in self._waiting)
+            _running = self._running
+            _failed = len(self.ls_failed)
+            _unmoved = len(self.ls_unmoved)
+            _copied = sum(copied for (copied, total) in self._copied.values())
+            _total = sum(total for (copied, total) in self._copied.values())
+
+        ls_part = ["Adding documents: %d waiting, %d in progress" % (_waiting, _running)]
+        if _total:
+            ls_part.append("%d of %d MB copied" % (_copied >> 20, _total >> 20))
+        ls_part.append("%.1f documents/s" % self.throughput())
+        if _failed:
+            ls_part.append("%d failed" % _failed)
+        if _unmoved:
+            ls_part.append("%d added but not moved into the archive" % _unmoved)
+        if _failed or _unmoved:
+            ls_part[-1] += " (double-click to retry)"
+
+        return ", ".join(ls_part)
+
+    def report(self, is_progress=False):
+        """Dispatch the description of the queue to the status function
+
+            Args:
+                is_progress (bool): Whether this is a copy progress report, which is limited to status_interval
+        """
+
+        if self.fn_status is None:
+            return
+        if is_progress and time.perf_counter() - self._time_status < IngestQueue.status_interval:
+            return
+
+        self._time_status = time.perf_counter()
+        self.dispatch(self.fn_status, self.describe())
+
+    def _take(self):
+        """Wait for jobs and take those waiting, up to max_batch documents - called on a worker
+
+            Returns:
+                (list: IngestJob): The jobs taken, now running
+        """
+
+        with self._lock:
+            while not self._waiting:
+                self._lock.wait()
+
+            ls_job = [self._waiting.popleft()]
+            _count = len(ls_job[0].ls_pending)
+            while self._waiting and _count + len(self._waiting[0].ls_pending) <= IngestQueue.max_batch:
+                _count += len(self._waiting[0].ls_pending)
+                ls_job.append(self._waiting.popleft())
+
+            for job in ls_job:
+                job.status = 'running'
+                job.attempts += 1
+            self._running += _count
+
+        return ls_job
+
+    def _commit(self, ls_job):
+        """Commit jobs together in one transaction, recording the outcome on each
+
+            Args:
+                ls_job (list: IngestJob): The jobs to commit
+        """
+
+        _key = object()
+
+        def fn_progress(copied, total):
+            with self._lock:
+                self._copied[_key] = (copied, total)
+            self.report(is_progress=True)
+
+        ls_pending = []
+        for job in ls_job:
+            if self.fn_prepare is not None and not job.is_prepared:
+                job.ls_pending = self.fn_prepare(job.ls_pending)
+                job.is_prepared = True
+            ls_pending.extend(job.ls_pending)
+
+        try:
+            ls_doc_id, tag_to_id, ls_unmoved = ingest.commit_documents(ls_pending, fn_progress=fn_progress)
+        finally:
+            with self._lock:
+                self._copied.pop(_key, None)
+
+        # Hand each job its share of the results, keeping files that could not be moved for a retry
+        _start = 0
+        for job in ls_job:
+            job.ls_doc_id = ls_doc_id[_start:_start + len(job.ls_pending)]
+            job.tag_to_id = dict((tag, tag_to_id[tag]) for pending in job.ls_pending for tag in pending.tags)
+            _set_path = set(ingest.archive_path(pending) for pending in job.ls_pending)
+            job.ls_unmoved = [staged for staged in ls_unmoved if staged[1] in _set_path]
+            _start += len(job.ls_pending)
+        self.add_unmoved(ls_unmoved)
+
+    def _run(self):
+        """Worker loop - commit waiting jobs together, separating them to find the one at fault if that fails"""
+
+        while True:
+            ls_job = self._take()
+            self.report()
+
+            try:
+                self._commit(ls_job)
+                ls_done = ls_job
+            except Exception as error:
+                ls_done = []
+                if len(ls_job) == 1:
+                    ls_job[0].error = error
+                else:
+                    for job in ls_job:
+                        try:
+                            self._commit([job])
+                            ls_done.append(job)
+                        except Exception as job_error:
+                            job.error = job_error
+
+            with self._lock:
+                for job in ls_job:
+                    job.status = 'done' if job in ls_done else 'failed'
+                    if job.status == 'failed':
+                        self.ls_failed.append(job)
+                self._running -= sum(len(job.ls_pending) for job in ls_job)
+                self._completed.append((time.perf_counter(), sum(len(job.ls_pending) for job in ls_done)))
+
+            if self.fn_done is not None:
+                for job in ls_done:
+                    self.dispatch(self.fn_done, job)
+            self.report()
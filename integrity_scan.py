@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Command-line integrity scanner comparing the document archive against the library
+
+    Usage:
+        python integrity_scan.py [--db PATH] [--archive PATH] [--report PATH] [--workers N] [--full]
+                                 [--backfill-hashes]
+
+    The archive is walked and each file compared with the documents catalogued in the library, reporting documents
+    whose file is missing, files no document refers to, files whose content no longer matches the hash stored with
+    their document, and temporary copies left behind by an interrupted add. The report is written as JSON.
+
+    The size, modification time and hash of every catalogued file are cached in the ArchiveScan table, so a file is
+    only hashed again once its size or modification time changes - after the first run, a scan reads the directory
+    entries and little else."""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import sys
+import time
+
+import database
+import fn_hash
+import ingest
+import schema
+
+import config
+import mode
+
+# Threads hashing files, unless given on the command line
+default_workers = 4
+
+
+def load_cache(conn):
+    """Load the cached size, modification time and hash of each archived file
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+
+        Returns:
+            (dict): Mapping of relative archive path to a (size, modification time, content hash) tuple
+    """
+
+    crsr = conn.execute("SELECT path, size, mtime_ns, content_hash "
+                        "FROM ArchiveScan;")
+    path_to_entry = dict((path, (size, mtime_ns, content_hash)) for (path, size, mtime_ns, content_hash)
+                         in crsr.fetchall())
+    crsr.close()
+
+    return path_to_entry
+
+
+def scan_archive(workers=default_workers, is_full=False, is_backfill=False):
+    """Compare the document archive against the library, hashing only files changed since the last scan
+
+        Args:
+            workers (int): Number of threads hashing files
+            is_full (bool): Whether to hash every catalogued file, ignoring the cache
+            is_backfill (bool): Whether to store the hash of documents recorded without one
+
+        Returns:
+            (dict): The report, ready to be written as JSON
+    """
+
+    conn = database.connect()
+    schema.migrate(conn)
+    _time_start = time.perf_counter()
+
+    # Read the directory entries, then the catalogue and the cache of earlier scans
+    path_to_stat = dict((path, (size, mtime_ns)) for (path, size, mtime_ns)
+                        in ingest.walk_archive(config.cfg['document_archive']))
+    path_to_docs = ingest.catalogued_documents(conn)
+    path_to_cached = {} if is_full else load_cache(conn)
+
+    # Reuse the cached hash of any catalogued file whose size and modification time are unchanged, hashing the rest
+    path_to_hash = {}
+    ls_stale = []
+    for _path in path_to_docs:
+        if _path not in path_to_stat:
+            continue
+        _cached = path_to_cached.get(_path)
+        if _cached is not None and _cached[:2] == path_to_stat[_path] and _cached[2] is not None:
+            path_to_hash[_path] = _cached[2]
+        else:
+            ls_stale.append(_path)
+    _cached_count = len(path_to_hash)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        ls_future = [(_path, executor.submit(fn_hash.hash_file, os.path.join(config.cfg['document_archive'], _path)))
+                     for _path in ls_stale]
+        for (_path, future) in ls_future:
+            try:
+                path_to_hash[_path] = future.result()
+            except OSError as error:
+                print("Cannot hash %s: %s" % (_path, error.strerror), file=sys.stderr)
+
+    # Compare each document with its file
+    ls_missing = []
+    ls_modified = []
+    ls_backfill = []
+    for _path, ls_doc in sorted(path_to_docs.items()):
+        for (ident, content_hash) in ls_doc:
+            if _path not in path_to_stat:
+                ls_missing.append(dict(id=ident, path=_path))
+            elif _path not in path_to_hash:
+                continue
+            elif content_hash is None:
+                ls_backfill.append((path_to_hash[_path], ident))
+            elif content_hash != path_to_hash[_path]:
+                ls_modified.append(dict(id=ident, path=_path, expected_hash=content_hash,
+                                        actual_hash=path_to_hash[_path]))
+
+    # Files no document refers to, separating the temporary copies of interrupted adds
+    ls_partial = sorted(_path for _path in path_to_stat
+                        if _path.endswith(ingest.partial_suffix) and _path not in path_to_docs)
+    ls_orphaned = sorted(_path for _path in path_to_stat
+                         if not _path.endswith(ingest.partial_suffix) and _path not in path_to_docs)
+
+    # Bring the cache up to date, and store the hashes of documents recorded without one if asked to
+    with database.transaction(immediate=True) as conn:
+        conn.executemany("INSERT OR REPLACE INTO ArchiveScan (path, size, mtime_ns, content_hash) "
+                         "VALUES ((?), (?), (?), (?));",
+                         [(_path, path_to_stat[_path][0], path_to_stat[_path][1], path_to_hash[_path])
+                          for _path in ls_stale if _path in path_to_hash])
+        conn.executemany("DELETE FROM ArchiveScan "
+                         "WHERE path=(?);",
+                         [(_path,) for _path in load_cache(conn) if _path not in path_to_docs or
+                          _path not in path_to_stat])
+        if is_backfill:
+            conn.executemany("UPDATE Documents "
+                             "SET content_hash=(?) "
+                             "WHERE id=(?) AND content_hash IS NULL;",
+                             ls_backfill)
+
+    return dict(archive=config.cfg['document_archive'],
+                scanned_at=datetime.datetime.now().isoformat(timespec='seconds'),
+                seconds=round(time.perf_counter() - _time_start, 3),
+                files=len(path_to_stat),
+                documents=sum(len(ls_doc) for ls_doc in path_to_docs.values()),
+                hashed=len(ls_stale),
+                cached=_cached_count,
+                unhashed_documents=len(ls_backfill),
+                backfilled=len(ls_backfill) if is_backfill else 0,
+                missing=ls_missing,
+                orphaned=ls_orphaned,
+                modified=ls_modified,
+                partial=ls_partial)
+
+
+def main(argv=None):
+    """Parse the command line, run the scan and write the report
+
+        Args:
+            argv (list: str): Command line arguments, sys.argv[1:] if None
+
+        Returns:
+            (int): Exit status - zero if the archive and library agree
+    """
+
+    parser = argparse.ArgumentParser(description="Check the document archive against the library")
+    parser.add_argument('--db', help="library database, instead of the configured one")
+    parser.add_argument('--archive', help="document archive, instead of the configured one")
+    parser.add_argument('--report', help="file to write the JSON report to, instead of standard output")
+    parser.add_argument('--workers', type=int, default=default_workers, help="threads hashing files")
+    parser.add_argument('--full', action='store_true', help="hash every file, ignoring the cache of earlier scans")
+    parser.add_argument('--backfill-hashes', action='store_true',
+                        help="store the content hash of documents recorded without one")
+    args = parser.parse_args(argv)
+
+    # Load the configuration as the application does, then apply any overrides
+    if not (args.db and args.archive):
+        import wx
+        mode.set_mode(getattr(sys, 'frozen', False))
+        config.load_config(wx.App(False))
+    if args.db:
+        config.cfg['db_location'] = args.db
+    if args.archive:
+        config.cfg['document_archive'] = args.archive
+
+    report = scan_archive(args.workers, args.full, args.backfill_hashes)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    print("%d files, %d documents: %d missing, %d orphaned, %d modified, %d partial - %d hashed in %.1f s" %
+          (report['files'], report['documents'], len(report['missing']), len(report['orphaned']),
+           len(report['modified']), len(report['partial']), report['hashed'], report['seconds']), file=sys.stderr)
+
+    return 1 if report['missing'] or report['orphaned'] or report['modified'] or report['partial'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""This module contains the cache of the lookup tables - tags, disciplines, categories and level3s"""
+
+import collections
+
+import database
+
+# Columns loaded from each lookup table, id first
+lookup_columns = collections.OrderedDict([('Tags', ('id', 'tag')),
+                                          ('Disciplines', ('id', 'discipline')),
+                                          ('Categories', ('id', 'category')),
+                                          ('Level3', ('id', 'level3', 'category_id', 'discipline_id'))])
+
+
+class LookupCache(object):
+    """Cache of the lookup tables, loaded together in one transaction and reloaded only where they have changed
+
+        Writes by other connections are noticed through PRAGMA data_version, and local writes through invalidate(). A
+        table is then reloaded only if its (row count, largest id) watermark moved, and only its new rows are read if it
+        has just grown.
+
+        Attributes:
+            rows (dict): For each table, list of its rows as tuples of lookup_columns
+            watermarks (dict): For each table, the (row count, largest id) it was loaded at
+            data_version (int): The PRAGMA data_version the tables were loaded under
+            is_stale (bool): Whether a local write may have changed the tables since they were loaded
+    """
+
+    def __init__(self):
+        """Constructor"""
+
+        self.rows = dict((table, []) for table in lookup_columns)
+        self.watermarks = {}
+        self.data_version = None
+        self.is_stale = True
+
+    def invalidate(self):
+        """Have the next refresh check the tables for changes, such as after writing to one of them locally"""
+
+        self.is_stale = True
+
+    def refresh(self):
+        """Load any tables changed since they were last loaded, all in a single transaction
+
+            Returns:
+                (list: str): Names of the tables that were reloaded
+        """
+
+        with database.transaction() as conn:
+            # Nothing to do unless this or another connection has written since the last refresh
+            _data_version = conn.execute("PRAGMA data_version;").fetchone()[0]
+            if not self.is_stale and _data_version == self.data_version:
+                return []
+
+            # Watermarks of every table in one round trip
+            crsr = conn.cursor()
+            crsr.execute("SELECT %s;" % ", ".join("(SELECT count(*) FROM %s), (SELECT coalesce(max(id), 0) FROM %s)"
+                                                  % (table, table) for table in lookup_columns))
+            _values = crsr.fetchone()
+            _watermarks = dict((table, _values[2 * i:2 * i + 2]) for i, table in enumerate(lookup_columns))
+
+            ls_changed = []
+            for table, columns in lookup_columns.items():
+                _old = self.watermarks.get(table)
+                if _old == _watermarks[table]:
+                    continue
+
+                # Read only the new rows of a table that has just grown, otherwise the whole table
+                _rows = None
+                if _old is not None:
+                    crsr.execute("SELECT %s FROM %s WHERE id > (?) ORDER BY id;" % (", ".join(columns), table),
+                                 (_old[1],))
+                    _new_rows = crsr.fetchall()
+                    if _old[0] + len(_new_rows) == _watermarks[table][0]:
+                        _rows = self.rows[table] + _new_rows
+                if _rows is None:
+                    crsr.execute("SELECT %s FROM %s ORDER BY id;" % (", ".join(columns), table))
+                    _rows = crsr.fetchall()
+
+                self.rows[table] = _rows
+                self.watermarks[table] = _watermarks[table]
+                ls_changed.append(table)
+            crsr.close()
+
+        self.data_version = _data_version
+        self.is_stale = False
+
+        return ls_changed
+
+
+def resolve_level3(lookup_cache, ls_entry, category_to_id, discipline_to_id):
+    """Add any level3's named by the entries but missing from the library
+
+        Args:
+            lookup_cache (LookupCache): The lookup cache, refreshed afterwards if anything was added
+            ls_entry (list: dict): Entries naming a 'category', 'discipline' and 'level3', such as the rows of a bulk
+                                   import mapping
+            category_to_id (dict): Mapping of category name to id
+            discipline_to_id (dict): Mapping of discipline name to id
+
+        Returns:
+            (dict): Mapping of (category id, discipline id, level3 name) to level3 id
+    """
+
+    def level3_ids():
+        return dict(((category_id, discipline_id, level3), ident) for (ident, level3, category_id, discipline_id)
+                    in lookup_cache.rows['Level3'])
+
+    key_to_level3 = level3_ids()
+    ls_missing = list(dict.fromkeys((category_to_id[entry['category']], discipline_to_id[entry['discipline']],
+                                     entry['level3'])
+                                    for entry in ls_entry if entry['level3'] and
+                                    entry['category'] in category_to_id and entry['discipline'] in discipline_to_id))
+    ls_missing = [key for key in ls_missing if key not in key_to_level3]
+
+    if ls_missing:
+        with database.transaction(immediate=True) as conn:
+            conn.executemany("INSERT INTO Level3 (category_id, discipline_id, level3) "
+                             "VALUES ((?), (?), (?));",
+                             ls_missing)
+        lookup_cache.invalidate()
+        lookup_cache.refresh()
+        key_to_level3 = level3_ids()
+
+    return key_to_level3
@@ -2,14 +2,120 @@
 """This module defines panes - master panels that act as direct children of the progenitor frame"""
 
 import wx
-import sqlite3
 import os
+import time
+import collections
+import concurrent.futures
+import sqlite3
 
 import widget
 import tab
+import database
+import ingest
+import ingest_queue
+import lookup
+import schema
+import search
+import query
+import index
+import content_index
 
 import config
+import fn_hash
 import fn_path
+import fn_text
+
+
+class SearchCache(object):
+    """Least-recently-used cache of search results, invalidated whenever the library database is written to
+
+        Local writes invalidate the cache by calling invalidate(), while writes by other users are detected through a
+        change in PRAGMA data_version passed to check().
+
+        Args:
+            capacity (int): Maximum number of search results to keep
+
+        Attributes:
+            capacity (int): Maximum number of search results to keep
+            generation (int): Counter bumped on every invalidation, so results of searches begun before it are not kept
+            data_version (int): The PRAGMA data_version the cached results were computed under
+            hits (int): Number of lookups answered from the cache
+            misses (int): Number of lookups not in the cache
+    """
+
+    def __init__(self, capacity):
+        """Constructor"""
+
+        self.capacity = capacity
+        self.generation = 0
+        self.data_version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def make_key(search_string, ls_searchin, ls_lim_cat, ls_lim_disc, ls_tag, is_tag_all, is_fuzzy):
+        """Build the cache key identifying a search
+
+            Returns:
+                (tuple): Hashable key from the casefolded query, search-in flags and sorted restrictions
+        """
+
+        return (search_string.casefold(), tuple(ls_searchin), tuple(sorted(ls_lim_cat)), tuple(sorted(ls_lim_disc)),
+                tuple(sorted(ls_tag)), is_tag_all if ls_tag else None, is_fuzzy)
+
+    def check(self, data_version):
+        """Invalidate the cache if the database has been written to since the cached results were computed
+
+            Args:
+                data_version (int): The current PRAGMA data_version of a long-lived connection
+        """
+
+        if data_version != self.data_version:
+            self.invalidate()
+            self.data_version = data_version
+
+    def invalidate(self):
+        """Discard all cached results"""
+
+        self.generation += 1
+        self._entries.clear()
+
+    def get(self, key):
+        """Look up the results of a search
+
+            Args:
+                key (tuple): Key from make_key
+
+            Returns:
+                (list: tuple): The cached search results, or None if not cached
+        """
+
+        search_results = self._entries.get(key)
+        if search_results is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return search_results
+
+    def put(self, key, search_results, generation):
+        """Store the results of a search, unless the cache was invalidated while it ran
+
+            Args:
+                key (tuple): Key from make_key
+                search_results (list: tuple): The results of the search
+                generation (int): The value of self.generation when the search began
+        """
+
+        if generation != self.generation:
+            return
+
+        self._entries[key] = search_results
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
 
 
 class PaneMain(wx.Panel):
@@ -17,6 +123,8 @@ class PaneMain(wx.Panel):
 
         Class Variables:
             bar_size (int): Size (height) of the top ribbon with the searchbar
+            preview_delay (int): Milliseconds after a keystroke before the preview search runs
+            preview_min_length (int): Shortest text in the searchbar that is previewed
 
         Args:
             parent (ptr): Reference to the wx.frame this panel belongs to
@@ -26,6 +134,8 @@ class PaneMain(wx.Panel):
     """
 
     bar_size = 25
+    preview_delay = 250
+    preview_min_length = 3
 
     def __init__(self, parent):
         """Constructor"""
@@ -38,31 +148,72 @@ class PaneMain(wx.Panel):
         # Set user for application
         self.user = os.getlogin()
 
-        # Load tags and the mapping of tag to id
+        # Define the tag list and the mappings between id and tag, discipline, category and level3
         self.ls_tags = []
         self.tag_to_id = {}
-        self.load_tags()
-
-        # Define and load mappings between id and discipline
         self.id_to_discipline = {}
         self.discipline_to_id = {}
-        self.load_disciplines()
-
-        # Define and load mappings between id and category
         self.id_to_category = {}
         self.category_to_id = {}
-        self.load_categories()
-
-        # Define and load mappings between id and level3
         self.id_to_level3 = {}
         self.level3_to_id = {}
-        self.load_level3()
+
+        # Load them all in a single transaction
+        self.lookup_cache = lookup.LookupCache()
+        self.load_lookups()
+
+        # Bring the schema up to date, and ensure the full-text search index is in sync
+        conn = database.connect()
+        schema.migrate(conn)
+        self.has_fts = schema.ensure_fts(conn)
+
+        # Load the in-memory trigram index for substring search, unless disabled to save memory
+        self.text_index = None
+        if config.cfg.get('trigram_index', True):
+            self.text_index = index.TrigramIndex()
+            self.text_index.load(conn)
+
+        # Load the tag to documents index for tag search
+        self.tag_index = index.TagIndex()
+        self.tag_index.load(conn)
+
+        # Check the document contents index is available, and extract the text of any documents not yet indexed
+        self.has_content = schema.ensure_content_index(conn)
+        self.content_indexer = content_index.ContentIndexer()
+        if self.has_content:
+            self.content_indexer.start()
+
+        # Background search worker, handing results back to the GUI thread - a search whose tab is open is completed
+        # even if another is started, so the tab is not left holding part of its results
+        self.search_executor = search.SearchExecutor(wx.CallAfter, keep_started=True)
+
+        # Background worker for search-as-you-type, and the previous preview to narrow from - along with the search cache
+        # generation it was computed under, as a write to the library can add documents it leaves out
+        self.preview_executor = search.SearchExecutor(wx.CallAfter)
+        self.preview_previous = None
+        self.queued_preview = False
+
+        # Search result cache, invalidated by writes from other users seen through this thread's connection
+        self.search_cache = SearchCache(config.cfg.get('search_cache_size', 64))
+
+        # Thread pool hashing documents being added, and the hashes already under way by path
+        self.ingest_executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.cfg.get('ingest_workers', 4))
+        self.hash_futures = {}
+
+        # Background queue copying and committing added documents, reporting its progress in the status bar
+        self.ingest_queue = ingest_queue.IngestQueue(wx.CallAfter, self.prepare_documents, self.documents_added,
+                                                     self.parent.set_activity,
+                                                     config.cfg.get('ingest_queue_workers', 2))
+
+        # Finish adding any documents whose files were left outside the archive by the application closing part way
+        self.ingest_executor.submit(self.recover_staged)
 
         # Search bar and bind
         self.wgt_searchbar = wx.TextCtrl(self,
                                          size=(PaneMain.bar_size*10, PaneMain.bar_size),
                                          style=wx.TE_PROCESS_ENTER)
         self.wgt_searchbar.Bind(wx.EVT_TEXT_ENTER, self.evt_search)
+        self.wgt_searchbar.Bind(wx.EVT_TEXT, self.evt_search_typed)
 
         # Search bar button and bind
         btn_search = wx.BitmapButton(self,
@@ -78,6 +229,8 @@ class PaneMain(wx.Panel):
         self.wgt_restrictions = widget.Restrictions(self)
         self.wgt_restrictions.Bind(wx.EVT_LEFT_DOWN, self.wgt_restrictions.evt_click_header)
         self.wgt_restrictions.SetMinSize((500, -1))
+        if not self.has_content:
+            self.wgt_restrictions.wgt_ls_chk_searchin[2].Disable()
 
         # Top bar sizer
         szr_top_bar = wx.BoxSizer(wx.HORIZONTAL)
@@ -100,118 +253,193 @@ class PaneMain(wx.Panel):
         self.SetSizer(self.szr_main)
         self.Layout()
 
-    def load_disciplines(self):
-        """Loads a dictionary and the reverse dictionary for disciplines and their id in the SQL database"""
-
-        # Connect to the database
-        conn = sqlite3.connect(config.cfg['db_location'])
-        crsr = conn.cursor()
+    def load_lookups(self):
+        """Loads the tags, disciplines, categories and level3's, with the mappings between each and their id in the SQL
+        database - only tables changed since they were last loaded are read again"""
 
-        # Retrieve list of all tags from SQL database
-        crsr.execute("SELECT id, discipline "
-                     "FROM Disciplines;")
+        ls_changed = self.lookup_cache.refresh()
 
         # Write tags to self.tags and define enumeration for cross-reference
-        _discipline_tuples = crsr.fetchall()
-        self.discipline_to_id = dict((discipline, ident) for (ident, discipline) in _discipline_tuples)
-        self.id_to_discipline = dict((ident, discipline) for (ident, discipline) in _discipline_tuples)
+        if 'Tags' in ls_changed:
+            _tag_tuples = self.lookup_cache.rows['Tags']
+            self.tag_to_id = dict((tag, ident) for (ident, tag) in _tag_tuples)
+            self.ls_tags = [i[1] for i in _tag_tuples]
+
+        if 'Disciplines' in ls_changed:
+            _discipline_tuples = self.lookup_cache.rows['Disciplines']
+            self.discipline_to_id = dict((discipline, ident) for (ident, discipline) in _discipline_tuples)
+            self.id_to_discipline = dict((ident, discipline) for (ident, discipline) in _discipline_tuples)
+
+        if 'Categories' in ls_changed:
+            _category_tuples = self.lookup_cache.rows['Categories']
+            self.category_to_id = dict((category, ident) for (ident, category) in _category_tuples)
+            self.id_to_category = dict((ident, category) for (ident, category) in _category_tuples)
+
+        if 'Level3' in ls_changed:
+            _level3_tuples = self.lookup_cache.rows['Level3']
+            self.level3_to_id = dict((level3, ident) for (ident, level3, category_id, discipline_id) in _level3_tuples)
+            self.id_to_level3 = dict((ident, level3) for (ident, level3, category_id, discipline_id) in _level3_tuples)
+
+    def sync_library(self):
+        """Bring the search cache and in-memory indexes up to date with writes to the library by other users, or by
+        this client's own background workers, seen through a change in PRAGMA data_version"""
+
+        _data_version = database.data_version()
+        if _data_version == self.search_cache.data_version:
+            return
+
+        # Tags written elsewhere are needed to resolve tag restrictions, then the indexes read what was added
+        self.search_cache.check(_data_version)
+        self.load_lookups()
+        if self.text_index is not None:
+            self.text_index.catch_up(database.connect())
+        self.tag_index.catch_up(database.connect())
+
+    def invalidate_searches(self):
+        """Discard cached search results and the previous preview, after writing to the library"""
+
+        self.search_cache.invalidate()
+        self.preview_previous = None
+
+    def add_documents(self, ls_pending):
+        """Queue documents to be added to the library in the background, returning at once
 
-        # Close connection
-        crsr.close()
-        conn.close()
+            Args:
+                ls_pending (list: ingest.PendingDocument): The documents to add
 
-    def load_categories(self):
-        """Loads a dictionary and the reverse dictionary for categories and their id in the SQL database"""
+            Returns:
+                (ingest_queue.IngestJob): The queued job, or None if there was nothing to add
+        """
 
-        # Connect to the database
-        conn = sqlite3.connect(config.cfg['db_location'])
-        crsr = conn.cursor()
+        if not ls_pending:
+            return None
 
-        # Retrieve list of all tags from SQL database
-        crsr.execute("SELECT id, category "
-                     "FROM Categories;")
+        return self.ingest_queue.submit(ls_pending)
 
-        # Write tags to self.tags and define enumeration for cross-reference
-        _category_tuples = crsr.fetchall()
-        self.category_to_id = dict((category, ident) for (ident, category) in _category_tuples)
-        self.id_to_category = dict((ident, category) for (ident, category) in _category_tuples)
+    def prepare_documents(self, ls_pending):
+        """Hash queued documents and offer to link any whose content is already archived or earlier in the batch - runs
+            on an ingest worker
+
+            Args:
+                ls_pending (list: ingest.PendingDocument): The documents about to be committed
 
-        # Close connection
-        crsr.close()
-        conn.close()
+            Returns:
+                (list: ingest.PendingDocument): The documents with their hashes, and links to other copies accepted
+        """
 
-    def load_level3(self):
-        """Loads a dictionary and the reverse dictionary for level3's and their id in the SQL database"""
+        ls_pending = [pending if pending.content_hash is not None else
+                      pending._replace(content_hash=self.take_hash(pending.source_path)) for pending in ls_pending]
 
-        # Connect to the database
-        conn = sqlite3.connect(config.cfg['db_location'])
-        crsr = conn.cursor()
+        # Offer to link documents whose content is already archived, rather than storing a second copy
+        hash_to_path = ingest.find_duplicates(database.connect(), [pending.content_hash for pending in ls_pending])
+        for i, pending in enumerate(ls_pending):
+            if pending.content_hash in hash_to_path:
+                if self.ask_on_gui("%s has the same content as the archived document\n%s\n\nLink to the archived "
+                                   "copy rather than storing a second copy?" %
+                                   (pending.file_name, hash_to_path[pending.content_hash]), "Duplicate document"):
+                    ls_pending[i] = pending._replace(link_path=hash_to_path[pending.content_hash])
 
-        # Retrieve list of all tags from SQL database
-        crsr.execute("SELECT id, level3 "
-                     "FROM Level3;")
+        # Likewise for documents with the same content as another earlier in the batch
+        for i, linked in enumerate(ingest.link_batch_duplicates(ls_pending)):
+            if linked.link_path not in (ls_pending[i].link_path, hash_to_path.get(linked.content_hash)):
+                if self.ask_on_gui("%s has the same content as\n%s\n\nwhich is also being added. Link to that copy "
+                                   "rather than storing a second copy?" % (linked.file_name, linked.link_path),
+                                   "Duplicate document"):
+                    ls_pending[i] = linked
 
-        # Write tags to self.tags and define enumeration for cross-reference
-        _level3_tuples = crsr.fetchall()
-        self.level3_to_id = dict((level3, ident) for (ident, level3) in _level3_tuples)
-        self.id_to_level3 = dict((ident, level3) for (ident, level3) in _level3_tuples)
+        return ls_pending
 
-        # Close connection
-        crsr.close()
-        conn.close()
+    def ask_on_gui(self, message, caption):
+        """Ask the user a yes or no question from a background thread, waiting for the answer
 
-    def load_tags(self):
-        """Loads a list of available tags from the SQL database and populates to self.tags"""
+            Args:
+                message (str): The question
+                caption (str): The title of the message box
 
-        # Connect to the database
-        conn = sqlite3.connect(config.cfg['db_location'])
-        crsr = conn.cursor()
+            Returns:
+                (bool): True if the user answered yes
+        """
 
-        # Retrieve list of all tags from SQL database
-        crsr.execute("SELECT id, tag "
-                     "FROM Tags;")
+        _answer = concurrent.futures.Future()
+        wx.CallAfter(lambda: _answer.set_result(wx.MessageBox(message, caption, wx.YES_NO | wx.ICON_QUESTION, self)))
+        return _answer.result() == wx.YES
 
-        # Write tags to self.tags and define enumeration for cross-reference
-        _tag_tuples = crsr.fetchall()
-        self.tag_to_id = dict((tag, ident) for (ident, tag) in _tag_tuples)
-        self.ls_tags = [i[1] for i in _tag_tuples]
+    def documents_added(self, job):
+        """Bring the caches and indexes up to date with a newly committed ingest job
+
+            Args:
+                job (ingest_queue.IngestJob): The job done
+        """
+
+        # Discard cached searches now out of date, and pick up any new tags
+        self.invalidate_searches()
+        self.lookup_cache.invalidate()
+        self.load_lookups()
+
+        # Add the committed documents to the in-memory search indexes
+        for _doc_id, pending in zip(job.ls_doc_id, job.ls_pending):
+            if self.text_index is not None:
+                self.text_index.add(_doc_id, pending.file_name, pending.title)
+            self.tag_index.add(_doc_id, [job.tag_to_id[tag] for tag in pending.tags])
+
+        # Have the new documents' contents indexed
+        self.content_indexer.wake()
+
+    def recover_staged(self):
+        """Move committed files left under their temporary names into the archive, handing any that cannot be moved to
+        the ingest queue to retry - runs on a worker"""
 
-        # Close connection
-        crsr.close()
-        conn.close()
+        try:
+            _moved, ls_unmoved = ingest.recover_staged(database.connect())
+        except (OSError, sqlite3.Error) as error:
+            wx.CallAfter(self.parent.set_activity, "Could not check the archive for unfinished documents: %s" % error)
+            return
+        finally:
+            database.close()
 
-    def add_tags(self, add_tags):
-        """Adds a list of new tags to the SQL database
+        self.ingest_queue.add_unmoved(ls_unmoved)
+        if _moved:
+            wx.CallAfter(self.parent.set_activity, "Moved %d documents left unfinished into the archive" % _moved)
+
+    def retry_documents(self):
+        """Queue every failed ingest job again, with the details entered for it, and move any added files left outside
+        the archive into place
 
             Returns:
-                (list: str): List of strings that are existing tags
+                (int): Number of jobs queued again and files tried again
         """
 
-        # Ensure tags list is updated prior to adding potentially new tags
-        self.load_tags()
+        return self.ingest_queue.retry_failed()
+
+    def shutdown(self):
+        """Stop the background workers before the application exits"""
 
-        # Resolve values as single-entry lists containing that value
-        if type(add_tags) is not list: add_tags = [add_tags]
+        # Let the content indexer write the text it has extracted, and stop hashing files no longer needed
+        self.content_indexer.stop(wait=True)
+        self.ingest_executor.shutdown(wait=False)
 
-        # Only carry on if there is new tags to add
-        _new_tags = [(str(x),) for x in add_tags if str(x) not in self.ls_tags]
-        if _new_tags:
-            # Connect to the database
-            conn = sqlite3.connect(config.cfg['db_location'])
-            crsr = conn.cursor()
+    def hash_later(self, path):
+        """Start hashing a file in the background, such as when it is dropped, so its hash is ready at commit
+
+            Args:
+                path (str): Path to the file
+        """
 
-            # Modify the existing cell in the database for existing part number and desired column
-            crsr.executemany("INSERT INTO Tags (tag) "
-                             "VALUES (?);",
-                             _new_tags)
+        if path not in self.hash_futures:
+            self.hash_futures[path] = self.ingest_executor.submit(fn_hash.hash_file, path)
 
-            # Commit changes and close connection
-            conn.commit()
-            crsr.close()
-            conn.close()
+    def take_hash(self, path):
+        """Get the content hash of a file, waiting on a hash started by hash_later or computing it now
 
-            # Load new tags after adding tags
-            self.load_tags()
+            Args:
+                path (str): Path to the file
+
+            Returns:
+                (str): The hex digest of the file's content
+        """
+
+        self.hash_later(path)
+        return self.hash_futures.pop(path).result()
 
     def evt_button_no_focus(self, event):
         """Prevents focus from being called on the buttons
@@ -221,64 +449,212 @@ class PaneMain(wx.Panel):
         """
         pass
 
-    def evt_search(self, *args):
-        """Search for a part number and call open_parts_tab before emptying the searchbar
+    def read_restrictions(self):
+        """Read the search restrictions from the restrictions widget
 
-            Args:
-                args[0]: Either None or a button click event
+            Returns:
+                (list: bool): Whether to search each text field
+                (bool): Whether to tolerate typos
+                (list: int): List of category ids to restrict to
+                (list: int): List of discipline ids to restrict to
+                (list: str): List of tags to restrict to
+                (bool): Whether documents must carry all of the tags rather than any
         """
 
-        # Is there restrictions (limitations) on category and discipline?
-        is_lim_cat = any([checkbox.GetValue() for checkbox in self.wgt_restrictions.wgt_ls_chk_category])
-        is_lim_disc = any([checkbox.GetValue() for checkbox in self.wgt_restrictions.wgt_ls_chk_disciplines])
-        ls_is_lim = [is_lim_cat, is_lim_disc]
-
         # List of restrictions (limitations) on category and discipline
         ls_lim_cat = [self.category_to_id[x.GetLabel()] for x in self.wgt_restrictions.wgt_ls_chk_category
                       if x.GetValue()]
         ls_lim_disc = [self.discipline_to_id[x.GetLabel()] for x in self.wgt_restrictions.wgt_ls_chk_disciplines
                        if x.GetValue()]
 
-        # Connect to the database
-        conn = sqlite3.connect(config.cfg['db_location'])
-        crsr = conn.cursor()
-
-        # Complex SQL execution depending on what restrictions are chosen, if any
-        crsr.execute(" ".join(["SELECT file_name, title, category, discipline, level3 "
-                               "FROM Documents",
-                               self.opt_str("WHERE", self.min_truth(1, ls_is_lim)),
-                               self.opt_str("category IN (%s)" % (",".join("?" * len(ls_lim_cat))), is_lim_cat),
-                               self.opt_str("AND", self.min_truth(2, ls_is_lim)),
-                               self.opt_str("discipline IN (%s);" % (",".join("?" * len(ls_lim_disc))), is_lim_disc)]),
-                     (ls_lim_cat + ls_lim_disc))
-
-        # Grab search results and search string
-        search_results = crsr.fetchall()
+        # Determine what fields to search for text in, and how
+        ls_searchin = [x.IsChecked() for x in self.wgt_restrictions.wgt_ls_chk_searchin]
+        is_fuzzy = self.wgt_restrictions.wgt_chk_fuzzy.IsChecked()
+
+        # Grab any tags to restrict to
+        ls_tag, is_tag_all = self.wgt_restrictions.get_tags()
+
+        return ls_searchin, is_fuzzy, ls_lim_cat, ls_lim_disc, ls_tag, is_tag_all
+
+    def make_search(self, search_string, ls_searchin, is_fuzzy, ls_lim_cat, ls_lim_disc, ls_tag, is_tag_all):
+        """Build the function a search executor runs to perform a search in the background
+
+            Returns:
+                (callable): Generator function yielding pages of results, given a function returning True once stale
+        """
+
+        # Resolve any tag restriction to the documents carrying those tags
+        ls_tag_doc = self.tag_index.match([self.tag_to_id.get(tag) for tag in ls_tag], is_tag_all) if ls_tag else None
+
+        def fn_search(is_stale):
+            # Use the worker thread's connection, interrupting the query if it is superseded by a newer search
+            conn = database.connect()
+            conn.set_progress_handler(is_stale, 10000)
+
+            # Compile structured queries to a single statement, otherwise search using the trigram or full-text index
+            # where possible, streaming pages of results
+            try:
+                if query.is_structured(search_string):
+                    yield from query.search_pages(conn, search_string, ls_searchin, ls_lim_cat, ls_lim_disc,
+                                                  ls_tag, is_tag_all)
+                else:
+                    yield from search.search_pages(conn, search_string, ls_searchin,
+                                                   ls_lim_cat, ls_lim_disc, self.has_fts, self.text_index,
+                                                   ls_tag_doc, is_fuzzy)
+            finally:
+                conn.set_progress_handler(None, 0)
+
+        return fn_search
+
+    def evt_search(self, *args):
+        """Search for a part number and call open_parts_tab before emptying the searchbar
+
+            Args:
+                args[0]: Either None or a button click event
+        """
+
+        # Grab search string and restrictions
         search_string = self.wgt_searchbar.GetValue().strip()
+        ls_searchin, is_fuzzy, ls_lim_cat, ls_lim_disc, ls_tag, is_tag_all = self.read_restrictions()
+
+        # Ensure there is something in the search bar or tag restriction before searching
+        if search_string or ls_tag:
+            _query = " ".join([search_string] + (["[%s]" % ", ".join(ls_tag)] if ls_tag else []) +
+                              (["(fuzzy)"] if is_fuzzy and search_string else [])).strip()
+            _time_start = time.perf_counter()
+
+            # Reuse the results of an identical search if nothing has been written since
+            self.sync_library()
+            _key = SearchCache.make_key(search_string, ls_searchin, ls_lim_cat, ls_lim_disc, ls_tag, is_tag_all,
+                                        is_fuzzy)
+            _generation = self.search_cache.generation
+            search_results_cached = self.search_cache.get(_key)
+            if search_results_cached is not None:
+                self.parent.set_activity("%d results for \"%s\" (cached)" % (len(search_results_cached), _query))
+                self.wgt_notebook.open_search_tab(_query, search_results_cached, search_string=search_string)
+                self.wgt_searchbar.ChangeValue("")
+                return
+
+            ls_search_results = []
+            ls_tab = []
+
+            def fn_page(search_results_page, is_first):
+                # Open new tab of results on the first page, named for the tags too if restricted to them
+                ls_search_results.extend(search_results_page)
+                if is_first:
+                    ls_tab.append(self.wgt_notebook.open_search_tab(_query, search_results_page,
+                                                                    search_string=search_string))
+                elif ls_tab[0]:
+                    ls_tab[0].append_results(search_results_page)
+                self.parent.set_activity("Searching for \"%s\"... %d results" % (_query, len(ls_search_results)))
+
+            def fn_done():
+                if ls_tab and ls_tab[0]:
+                    ls_tab[0].finish_results()
+                self.search_cache.put(_key, ls_search_results, _generation)
+                self.parent.set_activity("%d results for \"%s\" (%.2f s)" %
+                                         (len(ls_search_results), _query, time.perf_counter() - _time_start))
+
+            def fn_error(error):
+                self.parent.set_activity("Search for \"%s\" failed: %s" % (_query, error))
+
+            # Run the search in the background, dropping any preview still under way so it cannot take the selection
+            # from the search's tab
+            self.parent.set_activity("Searching for \"%s\"..." % _query)
+            self.preview_executor.cancel()
+            self.search_executor.submit(self.make_search(search_string, ls_searchin, is_fuzzy, ls_lim_cat,
+                                                         ls_lim_disc, ls_tag, is_tag_all),
+                                        fn_page, fn_done, fn_error)
+
+        # Empty the searchbar, without triggering a preview search
+        self.wgt_searchbar.ChangeValue("")
+
+    def evt_search_typed(self, event):
+        """Queue a preview search shortly after the text in the searchbar changes, coalescing quick keystrokes
 
-        # Determine what fields to search for text in
-        ls_searchin = [x.IsChecked() for x in self.wgt_restrictions.wgt_ls_chk_searchin]
+            Args:
+                event: A text event passed from the searchbar
+        """
 
-        # Ensure there is something in the search bar before searching
-        if search_string:
-            search_results_refined = [s for s in search_results
-                                      if ((search_string.lower() in s[0].lower() if ls_searchin[0] else False) or
-                                          (search_string.lower() in s[1].lower() if ls_searchin[1] else False))]
+        if not self.queued_preview:
+            wx.CallLater(PaneMain.preview_delay, self.preview_search)
+            self.queued_preview = True
+        event.Skip()
 
-            # Open new tab of results
-            self.wgt_notebook.open_search_tab(search_string, search_results_refined)
+    def preview_search(self):
+        """Search for the text typed so far, showing the results in the reusable preview tab
 
-        # Close connection
-        crsr.close()
-        conn.close()
+            A query that extends the previous preview's query, under the same restrictions, can only match a subset
+            of the previous results, so those are narrowed in memory rather than searching again.
+        """
 
-        # Empty the searchbar
-        self.wgt_searchbar.SetValue("")
+        self.queued_preview = False
 
-    @staticmethod
-    def opt_str(text, check):
-        return text if check else ""
+        search_string = self.wgt_searchbar.GetValue().strip()
+        ls_searchin, is_fuzzy, ls_lim_cat, ls_lim_disc, ls_tag, is_tag_all = self.read_restrictions()
+        if len(search_string) < PaneMain.preview_min_length:
+            return
+
+        _query_norm = fn_text.normalize(search_string)
+        _restrictions = (tuple(ls_searchin), is_fuzzy, tuple(ls_lim_cat), tuple(ls_lim_disc),
+                         tuple(ls_tag), is_tag_all)
+
+        # Writes by other users move the cache on to a new generation, dropping the previous preview with it
+        self.sync_library()
+        _generation = self.search_cache.generation
+
+        # Narrowing only holds for exact, unstructured matching within the name and title fields, with nothing written
+        # since the previous preview
+        _previous = self.preview_previous
+        if (_previous and _previous[3] == _generation and _previous[1] == _restrictions and
+                _previous[0] in _query_norm and not is_fuzzy and
+                not any(ls_searchin[2:]) and not query.is_structured(search_string)):
+            ls_field = [f for f, is_in in enumerate(ls_searchin[:2]) if is_in]
+            search_results = [row for row in _previous[2]
+                              if any(_query_norm in text for text in self.normalized_fields(row, ls_field))]
+            self.preview_previous = (_query_norm, _restrictions, search_results, _generation)
+            self.wgt_notebook.open_preview_tab(search_string, search_results)
+            return
+
+        self.preview_previous = None
+        ls_search_results = []
+        ls_token = []
+
+        def fn_page(search_results_page, is_first):
+            # Pages already handed back by a preview since cancelled by a full search are dropped
+            if not self.preview_executor.is_current(ls_token[0]):
+                return
+            ls_search_results.extend(search_results_page)
+            if is_first:
+                self.wgt_notebook.open_preview_tab(search_string, search_results_page)
+            else:
+                self.wgt_notebook.preview_tab.append_results(search_results_page)
+
+        def fn_done():
+            if not self.preview_executor.is_current(ls_token[0]):
+                return
+            self.wgt_notebook.preview_tab.finish_results()
+            if not query.is_structured(search_string):
+                self.preview_previous = (_query_norm, _restrictions, ls_search_results, _generation)
+
+        ls_token.append(self.preview_executor.submit(self.make_search(search_string, ls_searchin, is_fuzzy,
+                                                                      ls_lim_cat, ls_lim_disc, ls_tag, is_tag_all),
+                                                     fn_page, fn_done))
+
+    def normalized_fields(self, row, ls_field):
+        """Get the normalized text of the chosen fields of a result row, from the trigram index where loaded
 
-    @staticmethod
-    def min_truth(count, truths):
-        return sum(truths) >= count
\ No newline at end of file
+            Args:
+                row (tuple): A result tuple
+                ls_field (list: int): List of field indexes - 0 for file name, 1 for title
+
+            Returns:
+                (list: str): The normalized text of each chosen field
+        """
+
+        if self.text_index is not None and row[5] in self.text_index.texts:
+            _texts = self.text_index.texts[row[5]]
+        else:
+            _texts = (fn_text.normalize(row[0]), fn_text.normalize(row[1]))
+
+        return [_texts[f] for f in ls_field]
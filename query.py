@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""This module contains the structured search query language and its compiler to parameterized SQL
+
+    Terms are separated by spaces and must all match. A term may be prefixed with a field - title:, file:, tag:, cat:,
+    disc:, sub:, user: or added: - and negated with a leading '-'. Values containing spaces may be double quoted. The
+    added: field takes a date (YYYY-MM-DD) with an optional comparison, such as added:>2024-01-01. Unprefixed terms
+    are searched for in the fields chosen under "Search for text in".
+
+    A query compiles to a single SQL statement over Documents, JunctionTable and Level3. Queries of the same shape -
+    the same fields, operators and negations in the same order - compile to identical SQL text, so the compiled text is
+    cached by shape and SQLite's per-connection statement cache reuses the prepared statement."""
+
+import datetime
+import functools
+import re
+
+import fn_text
+import search
+
+# Pattern of a single term - optional negation, optional field and comparison, and a quoted or bare value
+term_pattern = re.compile(r'(-?)(?:([a-z]+):(>=|<=|>|<|=)?)?("[^"]*"|\S+)')
+
+# Fields that take a comparison operator
+comparison_fields = {'added'}
+
+# SQL comparison for each date operator - dates are whole days, so > and <= compare against the start of the next day
+# as bound by bind_value, and = is a range from the start of the day to the start of the next
+date_comparisons = {'=': ">=", '>': ">=", '>=': ">=", '<': "<", '<=': "<"}
+
+# SQL predicate for each field, with a single parameter for the value
+field_clauses = {
+    'file': "instr(d.file_name_norm, (?)) > 0",
+    'title': "instr(d.title_norm, (?)) > 0",
+    'tag': "EXISTS (SELECT 1 FROM JunctionTable j JOIN Tags t ON t.id = j.tag_id "
+           "WHERE j.doc_id = d.id AND t.tag = (?) COLLATE NOCASE)",
+    'cat': "d.category IN (SELECT id FROM Categories WHERE category = (?) COLLATE NOCASE)",
+    'disc': "d.discipline IN (SELECT id FROM Disciplines WHERE discipline = (?) COLLATE NOCASE)",
+    'sub': "d.level3 IN (SELECT id FROM Level3 WHERE level3 = (?) COLLATE NOCASE)",
+    'user': "d.user = (?) COLLATE NOCASE",
+    'added': "CAST(d.time_added AS REAL) %s (?)"}
+
+
+class QueryError(ValueError):
+    """Raised when a structured query cannot be compiled"""
+    pass
+
+
+def parse(text):
+    """Split a query into its terms
+
+        Args:
+            text (str): The query text
+
+        Returns:
+            (list: tuple): List of (negated, field, operator, value) tuples - field is None for unprefixed terms
+    """
+
+    ls_term = []
+    for match in term_pattern.finditer(text):
+        _negated, _field, _operator, _value = match.groups()
+
+        # Quoted values may contain spaces, unknown prefixes are part of an unprefixed value
+        if _value.startswith('"'):
+            _value = _value.strip('"')
+        if _field is not None and _field not in field_clauses:
+            _value = "%s:%s%s" % (_field, _operator or "", _value)
+            _field, _operator = None, None
+
+        if _value:
+            ls_term.append((bool(_negated), _field, _operator, _value))
+
+    return ls_term
+
+
+def is_structured(text):
+    """Whether a query uses any of the structured syntax, rather than being a plain substring search
+
+        Args:
+            text (str): The query text
+
+        Returns:
+            (bool): True if any term has a field prefix or is negated
+    """
+
+    return any(_negated or _field for (_negated, _field, _operator, _value) in parse(text))
+
+
+def ranking_text(text):
+    """Get the words of a query that results are ranked against - the text of unprefixed, file, title and tag terms
+
+        Args:
+            text (str): The query text
+
+        Returns:
+            (str): The words to rank against, without field prefixes, negated terms or restrictions
+    """
+
+    return " ".join(_value for (_negated, _field, _operator, _value) in parse(text)
+                    if not _negated and _field in (None, 'file', 'title', 'tag'))
+
+
+@functools.lru_cache(maxsize=256)
+def compile_shape(shape):
+    """Compile the shape of a query to SQL text - cached, as the text only depends on the shape
+
+        Args:
+            shape (tuple): (searchin, terms, category count, discipline count, tag count, match all tags) where
+                           terms is a tuple of (negated, field, operator) tuples
+
+        Returns:
+            (str): The SQL statement, with a parameter for each value
+    """
+
+    ls_searchin, ls_term_shape, n_cat, n_disc, n_tag, is_tag_all = shape
+    ls_clause = []
+
+    for (_negated, _field, _operator) in ls_term_shape:
+        if _field is None:
+            _clause = "(%s)" % " OR ".join("instr(d.%s, (?)) > 0" % col for col, is_in
+                                           in zip(search.searchin_norm_columns, ls_searchin) if is_in)
+        elif _field in comparison_fields:
+            _clause = field_clauses[_field] % date_comparisons[_operator]
+            if _operator == "=":
+                _clause = "(%s AND CAST(d.time_added AS REAL) < (?))" % _clause
+        else:
+            _clause = field_clauses[_field]
+        ls_clause.append("NOT " + _clause if _negated else _clause)
+
+    # Restrictions chosen in the restrictions widget
+    if n_cat:
+        ls_clause.append("d.category IN (%s)" % ",".join("?" * n_cat))
+    if n_disc:
+        ls_clause.append("d.discipline IN (%s)" % ",".join("?" * n_disc))
+    if n_tag and is_tag_all:
+        ls_clause.extend([field_clauses['tag']] * n_tag)
+    elif n_tag:
+        ls_clause.append("EXISTS (SELECT 1 FROM JunctionTable j JOIN Tags t ON t.id = j.tag_id "
+                         "WHERE j.doc_id = d.id AND t.tag COLLATE NOCASE IN (%s))" % ",".join("?" * n_tag))
+
+    return " ".join(["SELECT d.file_name, d.title, d.category, d.discipline, d.level3, d.id, d.time_added "
+                     "FROM Documents d"] +
+                    (["WHERE " + " AND ".join(ls_clause)] if ls_clause else []) +
+                    ["ORDER BY d.id;"])
+
+
+def bind_value(field, operator, value):
+    """Convert a term's value to its SQL parameters
+
+        Args:
+            field (str): The field of the term, None if unprefixed
+            operator (str): The comparison operator of the term, if any
+            value (str): The value of the term
+
+        Returns:
+            (list): The parameters for the term's predicate
+    """
+
+    if field in comparison_fields:
+        try:
+            _date = datetime.datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            raise QueryError("%s: expects a date as YYYY-MM-DD, not \"%s\"" % (field, value))
+        _start = _date.timestamp()
+        _next = (_date + datetime.timedelta(days=1)).timestamp()
+        if operator == "=":
+            return [_start, _next]
+        return [_next if operator in (">", "<=") else _start]
+
+    # Text fields are compared against their normalized columns
+    if field in (None, 'file', 'title'):
+        return [fn_text.normalize(value)]
+
+    return [value]
+
+
+def compile_query(text, ls_searchin, ls_lim_cat=(), ls_lim_disc=(), ls_tag=(), is_tag_all=True):
+    """Compile a structured query, with the widget restrictions, to one parameterized SQL statement
+
+        Args:
+            text (str): The query text
+            ls_searchin (list: bool): Whether unprefixed terms search each of search.searchin_columns, in order
+            ls_lim_cat (list: int): List of category ids to restrict to, empty for no restriction
+            ls_lim_disc (list: int): List of discipline ids to restrict to, empty for no restriction
+            ls_tag (list: str): List of tags to restrict to, empty for no restriction
+            is_tag_all (bool): Whether documents must carry all of ls_tag rather than any
+
+        Returns:
+            (str): The SQL statement
+            (list): The parameters of the statement, in order
+    """
+
+    ls_term = parse(text)
+    _searchin = tuple(ls_searchin[:len(search.searchin_columns)])
+    if any(_field is None for (_negated, _field, _operator, _value) in ls_term) and not any(_searchin):
+        raise QueryError("Unprefixed terms need a field chosen under \"Search for text in\"")
+
+    ls_param = []
+    for (_negated, _field, _operator, _value) in ls_term:
+        if _field in comparison_fields and not _operator:
+            _operator = "="
+        _params = bind_value(_field, _operator, _value)
+        ls_param.extend(_params * (sum(_searchin) if _field is None else 1))
+
+    _shape = (_searchin,
+              tuple((_negated, _field, (_operator or "=") if _field in comparison_fields else None)
+                    for (_negated, _field, _operator, _value) in ls_term),
+              len(ls_lim_cat), len(ls_lim_disc), len(ls_tag), is_tag_all)
+
+    return compile_shape(_shape), ls_param + list(ls_lim_cat) + list(ls_lim_disc) + list(ls_tag)
+
+
+def search_pages(conn, text, ls_searchin, ls_lim_cat=(), ls_lim_disc=(), ls_tag=(), is_tag_all=True,
+                 page_size=search.default_page_size):
+    """Run a structured query, streaming its results
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+            text (str): The query text
+            ls_searchin (list: bool): Whether unprefixed terms search each of search.searchin_columns, in order
+            ls_lim_cat (list: int): List of category ids to restrict to, empty for no restriction
+            ls_lim_disc (list: int): List of discipline ids to restrict to, empty for no restriction
+            ls_tag (list: str): List of tags to restrict to, empty for no restriction
+            is_tag_all (bool): Whether documents must carry all of ls_tag rather than any
+            page_size (int): Maximum number of rows per page
+
+        Yields:
+            (list: tuple): The next page of (file_name, title, category, discipline, level3, id, time_added) tuples
+    """
+
+    _sql, ls_param = compile_query(text, ls_searchin, ls_lim_cat, ls_lim_disc, ls_tag, is_tag_all)
+
+    crsr = conn.cursor()
+    crsr.execute(_sql, ls_param)
+    yield from search.iter_pages(crsr, page_size)
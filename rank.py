@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions that rank search results by their relevance to the query"""
+
+import heapq
+import math
+import re
+
+import fn_text
+
+# Relative weight of a query term found in each field - file name, title and tags
+field_weights = (1.0, 2.0, 1.5)
+
+# BM25 term frequency saturation and field length normalization
+bm25_k1 = 1.2
+bm25_b = 0.75
+
+# Number of best results selected by relevance
+default_top_k = 1000
+
+
+def tokenize(text):
+    """Split text into its normalized words
+
+        Args:
+            text (str): The text to split
+
+        Returns:
+            (list: str): List of normalized words in the text
+    """
+
+    return re.findall(r"\w+", fn_text.normalize(text))
+
+
+def top_k(ls_fields, query, k=default_top_k):
+    """Score documents against a query with BM25F and select the best of them with a bounded heap
+
+        A query term is counted in a word of a field if it is a substring of that word, matching how searches are run.
+
+        Args:
+            ls_fields (list: tuple): For each document, the text of its fields in the order of field_weights
+            query (str): The query to rank the documents against
+            k (int): Maximum number of documents to select
+
+        Returns:
+            (list: int): Indexes into ls_fields of the best scoring documents, best first, omitting any scoring zero
+    """
+
+    ls_term = set(tokenize(query))
+    if not ls_fields or not ls_term:
+        return []
+
+    # Tokenize every field once and gather the statistics for length normalization and document frequency
+    ls_doc_tokens = [[tokenize(text) for text in fields] for fields in ls_fields]
+    ls_avg_length = [max(sum(len(doc[f]) for doc in ls_doc_tokens) / len(ls_doc_tokens), 1)
+                     for f in range(len(field_weights))]
+
+    ls_doc_tf = []
+    df = dict.fromkeys(ls_term, 0)
+    for doc in ls_doc_tokens:
+        # Field-weighted, length-normalized frequency of each term in this document
+        tf = {}
+        for f, tokens in enumerate(doc):
+            _norm = 1 - bm25_b + bm25_b * len(tokens) / ls_avg_length[f]
+            for term in ls_term:
+                _count = sum(1 for token in tokens if term in token)
+                if _count:
+                    tf[term] = tf.get(term, 0) + field_weights[f] * _count / _norm
+        for term in tf:
+            df[term] += 1
+        ls_doc_tf.append(tf)
+
+    _n = len(ls_doc_tf)
+    idf = dict((term, math.log(1 + (_n - df[term] + 0.5) / (df[term] + 0.5))) for term in ls_term)
+
+    def score(i):
+        return sum(idf[term] * tf * (bm25_k1 + 1) / (tf + bm25_k1) for term, tf in ls_doc_tf[i].items())
+
+    # Bounded heap of the k best, rather than sorting every candidate
+    ls_best = heapq.nlargest(k, ((score(i), -i) for i in range(_n)))
+    return [-neg_i for (_score, neg_i) in ls_best if _score > 0]
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions that bring the library database schema up to what the application expects
+
+    Tables, columns and indexes are added by versioned migrations tracked in PRAGMA user_version. The full-text indexes
+    depend on how SQLite was built, so are created where supported and checked for separately."""
+
+import sqlite3
+
+import database
+import fn_text
+
+# Tables as created by the original application, before any migration - for building test and benchmark libraries
+base_tables = ("CREATE TABLE Categories (id INTEGER PRIMARY KEY, category TEXT);"
+               "CREATE TABLE Disciplines (id INTEGER PRIMARY KEY, discipline TEXT);"
+               "CREATE TABLE Level3 (id INTEGER PRIMARY KEY, category_id INTEGER, discipline_id INTEGER, level3 TEXT);"
+               "CREATE TABLE Tags (id INTEGER PRIMARY KEY, tag TEXT);"
+               "CREATE TABLE JunctionTable (name TEXT, tag_id INTEGER, doc_id INTEGER);"
+               "CREATE TABLE Documents (id INTEGER PRIMARY KEY, file_name TEXT, title TEXT, category INTEGER, "
+               "discipline INTEGER, level3 INTEGER, user TEXT, time_added TEXT);")
+
+
+def add_normalized_columns(conn):
+    """Migration adding the normalized file_name_norm and title_norm columns to Documents
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database, in a transaction
+    """
+
+    # Add the columns if this database predates them
+    _columns = [row[1] for row in conn.execute("PRAGMA table_info(Documents);").fetchall()]
+    for _column in ["file_name_norm", "title_norm"]:
+        if _column not in _columns:
+            conn.execute("ALTER TABLE Documents ADD COLUMN %s TEXT;" % _column)
+
+
+def add_lookup_indexes(conn):
+    """Migration adding the indexes behind restriction, level3 and tag lookups
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database, in a transaction
+    """
+
+    # Documents restricted by category and discipline, together or by discipline alone
+    conn.execute("CREATE INDEX IF NOT EXISTS Documents_category_discipline ON Documents (category, discipline);")
+    conn.execute("CREATE INDEX IF NOT EXISTS Documents_discipline ON Documents (discipline);")
+
+    # Level3's under a discipline and category, covering the level3 name
+    conn.execute("CREATE INDEX IF NOT EXISTS Level3_discipline_category "
+                 "ON Level3 (discipline_id, category_id, level3);")
+
+    # Documents carrying a tag, and the tags of a document - each covering the other id
+    conn.execute("CREATE INDEX IF NOT EXISTS JunctionTable_tag_doc ON JunctionTable (tag_id, doc_id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS JunctionTable_doc_tag ON JunctionTable (doc_id, tag_id);")
+
+    # Tags by name, as compared by structured queries
+    conn.execute("CREATE INDEX IF NOT EXISTS Tags_tag ON Tags (tag COLLATE NOCASE);")
+
+
+def add_content_hash(conn):
+    """Migration adding the indexed content_hash column to Documents, so duplicate files are found by lookup
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database, in a transaction
+    """
+
+    _columns = [row[1] for row in conn.execute("PRAGMA table_info(Documents);").fetchall()]
+    if "content_hash" not in _columns:
+        conn.execute("ALTER TABLE Documents ADD COLUMN content_hash TEXT;")
+    conn.execute("CREATE INDEX IF NOT EXISTS Documents_content_hash ON Documents (content_hash);")
+
+
+def add_archive_scan(conn):
+    """Migration adding the ArchiveScan table, caching the size, modification time and hash of each archived file
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database, in a transaction
+    """
+
+    conn.execute("CREATE TABLE IF NOT EXISTS ArchiveScan ("
+                 "path TEXT PRIMARY KEY, "
+                 "size INTEGER NOT NULL, "
+                 "mtime_ns INTEGER NOT NULL, "
+                 "content_hash TEXT);")
+
+
+def add_tag_index(conn):
+    """Migration adding an index on Tags by exact name, as looked up when documents are added with their tags
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database, in a transaction
+    """
+
+    # The NOCASE index only serves case-insensitive comparisons, so exact lookups need their own
+    conn.execute("CREATE INDEX IF NOT EXISTS Tags_tag_exact ON Tags (tag);")
+
+
+def create_contents_fts(conn):
+    """Create the FTS5 word index over extracted document text, if not already present
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+
+        Raises:
+            sqlite3.OperationalError: This SQLite build does not support FTS5
+    """
+
+    # Word index with accents folded, as extracted text is too large for a trigram index
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS Contents_fts "
+                 "USING fts5(content, tokenize='unicode61 remove_diacritics 2');")
+
+
+def add_content_index(conn):
+    """Migration adding the ContentIndex table tracking which documents the content indexer has processed, and the
+    FTS5 index of their text where supported
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database, in a transaction
+    """
+
+    # Indexer progress, one row per document processed, so indexing resumes where it stopped - documents that were
+    # missing or failed are tried again once past retry_after
+    conn.execute("CREATE TABLE IF NOT EXISTS ContentIndex ("
+                 "doc_id INTEGER PRIMARY KEY, "
+                 "status TEXT NOT NULL, "
+                 "retry_after REAL);")
+
+    # A table created before retry_after existed has its missing and failed documents tried again now
+    if "retry_after" not in [row[1] for row in conn.execute("PRAGMA table_info(ContentIndex);").fetchall()]:
+        conn.execute("ALTER TABLE ContentIndex ADD COLUMN retry_after REAL;")
+        conn.execute("UPDATE ContentIndex "
+                     "SET retry_after=0 "
+                     "WHERE status IN ('missing', 'error');")
+
+    # Documents due to be tried again, found by time
+    conn.execute("CREATE INDEX IF NOT EXISTS ContentIndex_retry_after ON ContentIndex (retry_after);")
+
+    # A SQLite build without FTS5 leaves the text index to be created by a client that supports it
+    try:
+        create_contents_fts(conn)
+    except sqlite3.OperationalError:
+        pass
+
+
+def fill_normalized_columns(conn):
+    """Migration filling in the normalized columns of documents written before they existed, or by an older client
+    before this migration - every client since writes them with each document
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database, in a transaction
+    """
+
+    crsr = conn.cursor()
+    crsr.execute("SELECT id, file_name, title "
+                 "FROM Documents "
+                 "WHERE file_name_norm IS NULL OR title_norm IS NULL;")
+    crsr.executemany("UPDATE Documents "
+                     "SET file_name_norm=(?), title_norm=(?) "
+                     "WHERE id=(?);",
+                     [(fn_text.normalize(file_name), fn_text.normalize(title), ident)
+                      for (ident, file_name, title) in crsr.fetchall()])
+    crsr.close()
+
+
+# Schema migrations in order - the database's PRAGMA user_version is the number of them applied
+migrations = [add_normalized_columns,
+              add_lookup_indexes,
+              add_content_hash,
+              add_archive_scan,
+              add_tag_index,
+              add_content_index,
+              fill_normalized_columns]
+
+
+def migrate(conn):
+    """Apply any migrations not yet applied to the database, each in its own transaction
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+
+        Returns:
+            (int): The schema version of the database after migrating
+    """
+
+    for _version, migration in enumerate(migrations, start=1):
+        if conn.execute("PRAGMA user_version;").fetchone()[0] >= _version:
+            continue
+
+        # Take the write lock first, then check again in case another user migrated in the meantime
+        database.begin(conn, immediate=True)
+        try:
+            if conn.execute("PRAGMA user_version;").fetchone()[0] < _version:
+                migration(conn)
+                conn.execute("PRAGMA user_version = %d;" % _version)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def ensure_fts(conn):
+    """Create the FTS5 full-text index over Documents, and the triggers that keep it in sync, if not already present
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+
+        Returns:
+            (bool): True if the full-text index is available, False if this SQLite build does not support it
+    """
+
+    crsr = conn.cursor()
+
+    # Determine whether the index already exists, so a fresh index can be populated from existing documents
+    crsr.execute("SELECT sql "
+                 "FROM sqlite_master "
+                 "WHERE type='table' AND name='Documents_fts';")
+    _existing = crsr.fetchone()
+
+    # An index built by an older client over the raw columns is replaced by one over the normalized columns
+    if _existing is not None and "file_name_norm" not in _existing[0]:
+        for _trigger in ["Documents_fts_insert", "Documents_fts_delete", "Documents_fts_update"]:
+            crsr.execute("DROP TRIGGER IF EXISTS %s;" % _trigger)
+        crsr.execute("DROP TABLE Documents_fts;")
+        _existing = None
+    _is_new = _existing is None
+
+    try:
+        # External-content trigram index so that any substring of three or more characters is an index lookup - over
+        # the normalized columns, so searches fold case and accents as the other search paths do
+        crsr.execute("CREATE VIRTUAL TABLE IF NOT EXISTS Documents_fts "
+                     "USING fts5(file_name_norm, title_norm, content='Documents', content_rowid='id', "
+                     "tokenize='trigram');")
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5 or older than 3.34 (no trigram tokenizer)
+        crsr.close()
+        return False
+
+    # Keep the index in sync with every write to Documents, including the normalized columns being filled in
+    crsr.execute("CREATE TRIGGER IF NOT EXISTS Documents_fts_insert AFTER INSERT ON Documents BEGIN "
+                 "INSERT INTO Documents_fts (rowid, file_name_norm, title_norm) "
+                 "VALUES (new.id, new.file_name_norm, new.title_norm); "
+                 "END;")
+    crsr.execute("CREATE TRIGGER IF NOT EXISTS Documents_fts_delete AFTER DELETE ON Documents BEGIN "
+                 "INSERT INTO Documents_fts (Documents_fts, rowid, file_name_norm, title_norm) "
+                 "VALUES ('delete', old.id, old.file_name_norm, old.title_norm); "
+                 "END;")
+    crsr.execute("CREATE TRIGGER IF NOT EXISTS Documents_fts_update "
+                 "AFTER UPDATE OF file_name_norm, title_norm ON Documents BEGIN "
+                 "INSERT INTO Documents_fts (Documents_fts, rowid, file_name_norm, title_norm) "
+                 "VALUES ('delete', old.id, old.file_name_norm, old.title_norm); "
+                 "INSERT INTO Documents_fts (rowid, file_name_norm, title_norm) "
+                 "VALUES (new.id, new.file_name_norm, new.title_norm); "
+                 "END;")
+
+    # Populate a freshly created index from the documents already in the library
+    if _is_new:
+        crsr.execute("INSERT INTO Documents_fts (Documents_fts) "
+                     "VALUES ('rebuild');")
+
+    # Commit changes and close cursor
+    conn.commit()
+    crsr.close()
+
+    return True
+
+
+def ensure_content_index(conn):
+    """Determine whether the FTS5 index over extracted document text is available, creating it if the migration that
+    adds it ran on a SQLite build without FTS5
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+
+        Returns:
+            (bool): True if the content index is available, False if this SQLite build does not support it
+    """
+
+    try:
+        create_contents_fts(conn)
+        conn.execute("SELECT rowid "
+                     "FROM Contents_fts "
+                     "LIMIT 1;").fetchall()
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5
+        conn.rollback()
+        return False
+
+    conn.commit()
+    return True
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""This module contains the functions that query the library database for documents matching a search"""
+
+import concurrent.futures
+import threading
+
+import fn_text
+import index
+import content_index
+
+# Minimum query length that the trigram full-text index can answer
+fts_min_length = 3
+
+# Columns of Documents that the "Search for text in" checkboxes map onto, in checkbox order
+searchin_columns = ["file_name", "title"]
+
+# Normalized counterparts of searchin_columns, filled in by schema.fill_normalized_columns and AddDocument
+searchin_norm_columns = ["file_name_norm", "title_norm"]
+
+# Maximum number of document ids bound into a single IN (...) clause
+id_chunk_size = 500
+
+# Number of result rows handed back per page when streaming results
+default_page_size = 200
+
+
+def restriction_clause(ls_lim_cat, ls_lim_disc, alias=""):
+    """Build the SQL predicates and parameters restricting documents to the chosen categories and disciplines
+
+        Args:
+            ls_lim_cat (list: int): List of category ids to restrict to, empty for no restriction
+            ls_lim_disc (list: int): List of discipline ids to restrict to, empty for no restriction
+            alias (str): Optional table alias to qualify the column names with
+
+        Returns:
+            (list: str): List of SQL predicates to be joined with AND
+            (list: int): List of parameters for the predicates, in order
+    """
+
+    _prefix = alias + "." if alias else ""
+    ls_clause = []
+
+    if ls_lim_cat:
+        ls_clause.append("%scategory IN (%s)" % (_prefix, ",".join("?" * len(ls_lim_cat))))
+    if ls_lim_disc:
+        ls_clause.append("%sdiscipline IN (%s)" % (_prefix, ",".join("?" * len(ls_lim_disc))))
+
+    return ls_clause, list(ls_lim_cat) + list(ls_lim_disc)
+
+
+def text_clause(search_string, ls_searchin, alias=""):
+    """Build the SQL predicate and parameters testing for the search string in the chosen normalized columns
+
+        Args:
+            search_string (str): The text to search for
+            ls_searchin (list: bool): Whether to search each of searchin_columns, in order
+            alias (str): Optional table alias to qualify the column names with
+
+        Returns:
+            (list: str): List holding the single SQL predicate, to be joined with AND
+            (list: str): List of parameters for the predicate, in order
+    """
+
+    _prefix = alias + "." if alias else ""
+    ls_text = ["instr(%s%s, (?)) > 0" % (_prefix, col)
+               for col, is_in in zip(searchin_norm_columns, ls_searchin) if is_in]
+
+    return ["(%s)" % " OR ".join(ls_text)], [fn_text.normalize(search_string)] * len(ls_text)
+
+
+def fts_expression(search_string, ls_searchin):
+    """Build an FTS5 MATCH expression for a literal substring, normalized and restricted to the chosen columns
+
+        Args:
+            search_string (str): The text to search for
+            ls_searchin (list: bool): Whether to search each of searchin_columns, in order
+
+        Returns:
+            (str): The MATCH expression
+    """
+
+    _columns = " ".join(col for col, is_in in zip(searchin_norm_columns, ls_searchin) if is_in)
+    return '{%s} : "%s"' % (_columns, fn_text.normalize(search_string).replace('"', '""'))
+
+
+def iter_pages(crsr, page_size):
+    """Yield the rows of an executed cursor in pages, closing the cursor once exhausted
+
+        Args:
+            crsr (sqlite3.Cursor): A cursor on which a query has been executed
+            page_size (int): Maximum number of rows per page
+
+        Yields:
+            (list: tuple): The next page of rows
+    """
+
+    try:
+        while True:
+            page = crsr.fetchmany(page_size)
+            if not page:
+                return
+            yield page
+    finally:
+        crsr.close()
+
+
+def fetch_documents(conn, ls_id, ls_lim_cat, ls_lim_disc, ls_extra_clause=(), ls_extra_param=(),
+                    page_size=default_page_size):
+    """Retrieve the rows for a list of document ids, within the chosen restrictions, in pages
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+            ls_id (list: int): Sorted list of document ids to retrieve
+            ls_lim_cat (list: int): List of category ids to restrict to, empty for no restriction
+            ls_lim_disc (list: int): List of discipline ids to restrict to, empty for no restriction
+            ls_extra_clause (list: str): List of further SQL predicates the rows must satisfy
+            ls_extra_param (list): List of parameters for the further predicates, in order
+            page_size (int): Maximum number of rows per page
+
+        Yields:
+            (list: tuple): The next page of (file_name, title, category, discipline, level3, id, time_added) tuples,
+                           in id order
+    """
+
+    ls_clause, ls_param = restriction_clause(ls_lim_cat, ls_lim_disc)
+    ls_clause += list(ls_extra_clause)
+    ls_param += list(ls_extra_param)
+
+    # Retrieve in chunks to stay within the bound parameter limit
+    for i in range(0, len(ls_id), id_chunk_size):
+        _chunk = list(ls_id[i:i + id_chunk_size])
+        crsr = conn.cursor()
+        crsr.execute(" ".join(["SELECT file_name, title, category, discipline, level3, id, time_added "
+                               "FROM Documents "
+                               "WHERE id IN (%s)" % ",".join("?" * len(_chunk))] +
+                              ["AND " + clause for clause in ls_clause] +
+                              ["ORDER BY id;"]),
+                     _chunk + ls_param)
+        yield from iter_pages(crsr, page_size)
+
+
+def search_ids(conn, search_string, ls_searchin, has_fts=True, text_index=None):
+    """Find the ids of all documents containing the search string in the chosen name and title fields
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+            search_string (str): The text to search for
+            ls_searchin (list: bool): Whether to search each of searchin_columns, in order
+            has_fts (bool): Whether the Documents_fts index is available
+            text_index (index.TrigramIndex): In-memory trigram index to search with, if loaded
+
+        Returns:
+            (list: int): Sorted list of matching document ids
+    """
+
+    if not any(ls_searchin[:len(searchin_columns)]):
+        return []
+
+    if text_index is not None:
+        ls_id = text_index.search(search_string, ls_searchin)
+        if ls_id is not None:
+            return ls_id
+
+    crsr = conn.cursor()
+    if has_fts and len(fn_text.normalize(search_string)) >= fts_min_length:
+        crsr.execute("SELECT rowid "
+                     "FROM Documents_fts "
+                     "WHERE Documents_fts MATCH (?) "
+                     "ORDER BY rowid;",
+                     (fts_expression(search_string, ls_searchin),))
+    else:
+        ls_text, ls_text_param = text_clause(search_string, ls_searchin)
+        crsr.execute("SELECT id "
+                     "FROM Documents "
+                     "WHERE %s "
+                     "ORDER BY id;" % ls_text[0],
+                     ls_text_param)
+    ls_id = [row[0] for row in crsr.fetchall()]
+    crsr.close()
+
+    return ls_id
+
+
+def search_pages(conn, search_string, ls_searchin, ls_lim_cat, ls_lim_disc, has_fts=True, text_index=None,
+                 ls_tag_doc=None, is_fuzzy=False, page_size=default_page_size):
+    """Find all documents containing the search string in the chosen fields, within the chosen restrictions
+
+        Results are streamed a page at a time, so the first page is available before the whole query has run.
+
+        Args:
+            conn (sqlite3.Connection): An open connection to the library database
+            search_string (str): The text to search for, may be empty if searching by tags alone
+            ls_searchin (list: bool): Whether to search each of searchin_columns, in order, then document contents
+            ls_lim_cat (list: int): List of category ids to restrict to, empty for no restriction
+            ls_lim_disc (list: int): List of discipline ids to restrict to, empty for no restriction
+            has_fts (bool): Whether the Documents_fts index is available
+            text_index (index.TrigramIndex): In-memory trigram index to search with, if loaded
+            ls_tag_doc (list: int): Sorted list of ids of the documents matching the chosen tags, None if no tags
+            is_fuzzy (bool): Whether to tolerate typos, returning the closest matches first - needs text_index
+            page_size (int): Maximum number of rows per page
+
+        Yields:
+            (list: tuple): The next page of (file_name, title, category, discipline, level3, id, time_added) tuples
+    """
+
+    # Nothing can match if no field is being searched, or if there is nothing to search for
+    if (search_string and not any(ls_searchin)) or (not search_string and ls_tag_doc is None):
+        return
+
+    # Document contents have their own full-text index, so the matches of each index are merged by id
+    if search_string and len(ls_searchin) > len(searchin_columns) and ls_searchin[len(searchin_columns)]:
+        ls_id = sorted(set(content_index.search_contents(conn, search_string)) |
+                       set(search_ids(conn, search_string, ls_searchin, has_fts, text_index)))
+        if ls_tag_doc is not None:
+            ls_id = index.intersect_sorted(ls_id, ls_tag_doc)
+        yield from fetch_documents(conn, ls_id, ls_lim_cat, ls_lim_disc, page_size=page_size)
+        return
+
+    # Fuzzy matches are scored by the trigram index, and returned closest first rather than in table order
+    if search_string and is_fuzzy and text_index is not None:
+        ls_scored = text_index.search_fuzzy(search_string, ls_searchin)
+        if ls_scored is not None:
+            _tag_doc = set(ls_tag_doc) if ls_tag_doc is not None else None
+            rank_of = dict((doc_id, i) for i, (_distance, doc_id) in enumerate(ls_scored)
+                           if _tag_doc is None or doc_id in _tag_doc)
+            search_results = [row for page in fetch_documents(conn, sorted(rank_of), ls_lim_cat, ls_lim_disc)
+                              for row in page]
+            search_results.sort(key=lambda row: rank_of[row[5]])
+            for i in range(0, len(search_results), page_size):
+                yield search_results[i:i + page_size]
+            return
+
+    # The in-memory trigram index finds the matching ids, leaving only the restrictions to the database
+    ls_id = ls_tag_doc
+    if search_string and text_index is not None:
+        _ls_text_id = text_index.search(search_string, ls_searchin)
+        if _ls_text_id is not None:
+            ls_id = _ls_text_id if ls_id is None else index.intersect_sorted(ls_id, _ls_text_id)
+            search_string = ""
+
+    # Known candidate ids only need the remaining text test and restrictions applied by the database
+    if ls_id is not None:
+        ls_text, ls_text_param = text_clause(search_string, ls_searchin) if search_string else ([], [])
+        yield from fetch_documents(conn, ls_id, ls_lim_cat, ls_lim_disc, ls_text, ls_text_param, page_size)
+        return
+
+    crsr = conn.cursor()
+    ls_clause, ls_param = restriction_clause(ls_lim_cat, ls_lim_disc, "d")
+
+    if has_fts and len(fn_text.normalize(search_string)) >= fts_min_length:
+        # Index lookup on the trigram index, joined back to Documents for the restrictions - CROSS JOIN keeps the match
+        # as the outer loop, as SQLite would otherwise run it once per document within the restrictions
+        crsr.execute(" ".join(["SELECT d.file_name, d.title, d.category, d.discipline, d.level3, d.id, d.time_added "
+                               "FROM Documents_fts "
+                               "CROSS JOIN Documents d ON d.id = Documents_fts.rowid "
+                               "WHERE Documents_fts MATCH (?)"] +
+                              ["AND " + clause for clause in ls_clause]) + ";",
+                     [fts_expression(search_string, ls_searchin)] + ls_param)
+    else:
+        # Queries too short for the trigram index fall back to a substring test on the normalized columns
+        ls_text, ls_text_param = text_clause(search_string, ls_searchin, "d")
+        crsr.execute(" ".join(["SELECT d.file_name, d.title, d.category, d.discipline, d.level3, d.id, d.time_added "
+                               "FROM Documents d "
+                               "WHERE " + ls_text[0]] +
+                              ["AND " + clause for clause in ls_clause]) + ";",
+                     ls_text_param + ls_param)
+
+    yield from iter_pages(crsr, page_size)
+
+
+def search_documents(*args, **kwargs):
+    """Find all documents matching a search at once - takes the same arguments as search_pages
+
+        Returns:
+            (list: tuple): List of (file_name, title, category, discipline, level3, id, time_added) tuples
+    """
+
+    return [row for page in search_pages(*args, **kwargs) for row in page]
+
+
+class SearchExecutor(object):
+    """Runs searches on a background worker thread, dropping any search superseded by a newer one
+
+        Each submitted search is given a generation token. A search whose token is no longer current is skipped if it
+        has not yet started, interrupted if its SQL is running, and stops handing back pages once superseded - unless
+        keep_started is set and it has already handed back its first page, in which case it runs to completion so its
+        results are not left cut short.
+
+        Args:
+            dispatch (callable): Function used to hand back results, such as wx.CallAfter to run on the GUI thread
+            keep_started (bool): Whether searches that have handed back a page are completed even once superseded, as
+                                 when each search shows its results in a tab of its own
+
+        Attributes:
+            dispatch (callable): Function used to hand back results
+            keep_started (bool): Whether searches that have handed back a page are completed even once superseded
+            generation (int): Token of the most recently submitted search
+    """
+
+    def __init__(self, dispatch, keep_started=False):
+        """Constructor"""
+
+        self.dispatch = dispatch
+        self.keep_started = keep_started
+        self.generation = 0
+        self._set_started = set()
+        self._lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="search")
+
+    def submit(self, fn_search, fn_page, fn_done=None, fn_error=None):
+        """Queue a search, superseding any search submitted before it
+
+            Args:
+                fn_search (callable): Function returning an iterable of result pages, given a function that returns
+                                      True once the search is stale
+                fn_page (callable): Function dispatched with each page of results, and whether it is the first page
+                fn_done (callable): Function dispatched once all pages have been handed back
+                fn_error (callable): Function dispatched with the exception if the search fails while still current
+
+            Returns:
+                (int): The generation token of the queued search
+        """
+
+        with self._lock:
+            self.generation += 1
+            token = self.generation
+
+        self._pool.submit(self._run, token, fn_search, fn_page, fn_done, fn_error)
+        return token
+
+    def cancel(self):
+        """Supersede every submitted search without queueing another"""
+
+        with self._lock:
+            self.generation += 1
+
+    def is_current(self, token):
+        """Whether the given token belongs to the most recently submitted search
+
+            Args:
+                token (int): A generation token returned by submit
+
+            Returns:
+                (bool): True if no newer search has been submitted
+        """
+
+        return token == self.generation
+
+    def is_stale(self, token):
+        """Whether the given search should be abandoned - superseded, and not kept for having handed back a page
+
+            Args:
+                token (int): A generation token returned by submit
+
+            Returns:
+                (bool): True if the search should stop
+        """
+
+        return not self.is_current(token) and token not in self._set_started
+
+    def _run(self, token, fn_search, fn_page, fn_done, fn_error):
+        """Perform a queued search on the worker thread and dispatch its pages while it is still current
+
+            Args:
+                token (int): The generation token of the search
+                fn_search (callable): Function returning an iterable of result pages
+                fn_page (callable): Function dispatched with each page of results
+                fn_done (callable): Function dispatched once all pages have been handed back
+                fn_error (callable): Function dispatched with any exception
+        """
+
+        if self.is_stale(token):
+            return
+
+        pages = fn_search(lambda: self.is_stale(token))
+        try:
+            is_first = True
+            for page in pages:
+                if is_first and not self.keep_first(token):
+                    return
+                if self.is_stale(token):
+                    return
+                self.dispatch(fn_page, page, is_first)
+                is_first = False
+
+            # Always hand back a first page, even if empty, so that the search is seen to complete
+            if is_first:
+                if not self.keep_first(token):
+                    return
+                self.dispatch(fn_page, [], True)
+
+            if fn_done and not self.is_stale(token):
+                self.dispatch(fn_done)
+        except Exception as error:
+            # A superseded search raises on interruption, which is expected and not reported
+            if not self.is_stale(token) and fn_error:
+                self.dispatch(fn_error, error)
+            return
+        finally:
+            # Release the cursor and connection of a search abandoned part way
+            if hasattr(pages, 'close'):
+                pages.close()
+            with self._lock:
+                self._set_started.discard(token)
+
+    def keep_first(self, token):
+        """Check a search is still current as its first page is handed back, keeping it from then on if keep_started
+
+            Args:
+                token (int): The generation token of the search
+
+            Returns:
+                (bool): True if the first page should be handed back
+        """
+
+        with self._lock:
+            if not self.is_current(token):
+                return False
+            if self.keep_started:
+                self._set_started.add(token)
+            return True
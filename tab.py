@@ -34,27 +34,52 @@ class Notebook(wx.Notebook):
         self.open_tabs = []
         self.open_search_tab("", [])
 
+        # Tab reused to preview results while typing, created on first use
+        self.preview_tab = None
 
-    def open_search_tab(self, query, search_results, opt_stay=False):
+
+    def open_search_tab(self, query, search_results, opt_stay=False, search_string=None):
         """Open a new tab using the provided part number and revision
 
             Args:
                 query (string): The query string to name the new tab
                 search_results (list: tuple): List of tuples pertaining to query results
                 opt_stay (bool): If true, do not change to newly opened tab - default change tabs
+                search_string (str): The text searched for, if the name holds more - results are ranked against it
+
+            Returns:
+                (TabSearchQuery): The newly opened tab, or None if a tab for this query was already open
         """
 
         # If there is not yet a tab for this part number then create one, otherwise redirect to the existing
         if query not in [_tab.query for _tab in self.open_tabs]:
-            new_tab = TabSearchQuery(self, self.root_pane, query, search_results)
+            new_tab = TabSearchQuery(self, self.root_pane, query, search_results, search_string)
             self.open_tabs.append(new_tab)
             self.AddPage(new_tab, query)
 
             # Handles whether to stay on current tab or move to newly opened tab
             if not opt_stay:
                 self.SetSelection(self.GetPageCount() - 1)
+
+            return new_tab
         elif not opt_stay:
-            self.SetSelection([pnl.part_num for pnl in self.open_tabs].index(query))
+            self.SetSelection(self.FindPage(self.open_tabs[[pnl.query for pnl in self.open_tabs].index(query)]))
+
+    def open_preview_tab(self, query, search_results):
+        """Show results in the preview tab, replacing its previous results, and switch to it
+
+            Args:
+                query (string): The query string the results are for
+                search_results (list: tuple): List of tuples pertaining to query results
+        """
+
+        if self.preview_tab is None:
+            self.preview_tab = TabSearchQuery(self, self.root_pane, query, search_results)
+            self.AddPage(self.preview_tab, "Preview")
+        else:
+            self.preview_tab.replace_results(query, search_results)
+
+        self.SetSelection(self.FindPage(self.preview_tab))
 
 
 class TabSearchQuery(wx.Panel):
@@ -71,9 +96,15 @@ class TabSearchQuery(wx.Panel):
             root_pane (ref): Reference to the upstream wx.object pane
             query (str): The query string to name the new tab
             search_results (list: tuple): List of tuples pertaining to query results
+            search_string (str): The text searched for, if the name holds more - None if the name is the text
+
+        Attributes:
+            query (str): The query string naming the tab
+            search_string (str): The text searched for, which results are ranked against
+            search_results (list: tuple): List of tuples pertaining to query results
     """
 
-    def __init__(self, parent, root_pane, query, search_results):
+    def __init__(self, parent, root_pane, query, search_results, search_string=None):
         """Constructor"""
         wx.Panel.__init__(self, parent, size=(0, 0))  # Needs size parameter to remove black-square
         self.SetDoubleBuffered(True)  # Remove slight strobing on tab switch
@@ -83,9 +114,10 @@ class TabSearchQuery(wx.Panel):
         self.parent = parent
         self.root_pane = root_pane
 
-        # Instance Variables
+        # Instance Variables - copied, as rows streamed in later are appended
         self.query = query
-        self.search_results = search_results
+        self.search_string = query if search_string is None else search_string
+        self.search_results = list(search_results)
 
         # Library widget and sizer
         self.wgt_library = widget.CompositeLibrary(self, root_pane)
@@ -97,4 +129,31 @@ class TabSearchQuery(wx.Panel):
         self.szr_master.Add(self.szr_library, proportion=1, flag=wx.ALL | wx.EXPAND)
 
         # Set Sizer
-        self.SetSizer(self.szr_master)
\ No newline at end of file
+        self.SetSizer(self.szr_master)
+
+    def append_results(self, search_results):
+        """Append further rows of results, as a search streams them in
+
+            Args:
+                search_results (list: tuple): List of tuples pertaining to query results
+        """
+
+        self.wgt_library.append_rows(search_results)
+
+    def finish_results(self):
+        """Complete the results once a search has streamed in all of them, sorting any appended by the column sort"""
+
+        self.wgt_library.finish_rows()
+
+    def replace_results(self, query, search_results):
+        """Replace the results shown with those of another query
+
+            Args:
+                query (str): The query string the results are for
+                search_results (list: tuple): List of tuples pertaining to query results
+        """
+
+        self.query = query
+        self.search_string = query
+        self.szr_library.GetStaticBox().SetLabel('Search Results: ' + query)
+        self.wgt_library.replace_rows(search_results)
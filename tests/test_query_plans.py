@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Query plan regression tests - the statements issued when searching, adding documents and working in the background
+    must find their rows through indexes rather than by scanning the document, tag, junction or content index tables
+
+    Each test runs the functions the pane, dialogs and background workers call against an empty library built with the
+    current schema, records every statement they issue, and checks the EXPLAIN QUERY PLAN of each. Scans of the small
+    category, discipline and level3 tables are allowed. Searches with no restriction and a search string too short for
+    the trigram index read every document by design, so are not covered. Nor are the statements reading whole tables by
+    design - the first load of the lookup tables and the row counts that tell whether they changed, and the migration
+    filling in the normalized columns - though the statements alongside them are. Result rows carry the date each
+    document was added, so drawing them issues no statements at all."""
+
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import content_index
+import database
+import ingest
+import lookup
+import query
+import schema
+import search
+
+import config
+
+# Lookup tables small enough to scan
+small_tables = {'Categories', 'Disciplines', 'Level3'}
+
+# Plan step scanning a table, other than a virtual table answering a MATCH or the single row of an INSERT ... SELECT
+scan_pattern = re.compile(r'^SCAN (?!CONSTANT ROW)(\w+)\b(?! VIRTUAL TABLE)')
+
+# Structured queries as restricted by the restrictions widget - by category, discipline and tags
+structured_queries = ["cat:Specs", "disc:Mechanical", "sub:Pumps", "tag:pump", "-tag:valve", "user:demo",
+                      "added:>2024-01-01", "pump title:valve"]
+
+
+class QueryPlanTest(unittest.TestCase):
+    """Checks the plans of the statements behind searches, duplicate lookups and adding documents"""
+
+    def setUp(self):
+        """Build an empty library with the current schema, opened as this thread's connection"""
+
+        self.directory = tempfile.TemporaryDirectory()
+        config.cfg['db_location'] = os.path.join(self.directory.name, "library.sqlite")
+        self.conn = database.connect()
+        self.conn.executescript(schema.base_tables)
+        schema.migrate(self.conn)
+        self.has_fts = schema.ensure_fts(self.conn)
+        schema.ensure_content_index(self.conn)
+
+    def tearDown(self):
+        """Close and remove the library"""
+
+        database.close()
+        self.directory.cleanup()
+
+    def statements(self, fn):
+        """Record the statements issued while running a function
+
+            Args:
+                fn (callable): The function to run on the test library
+
+            Returns:
+                (list: str): The statements that read or write rows, with their parameters expanded
+        """
+
+        ls_sql = []
+        self.conn.set_trace_callback(ls_sql.append)
+        try:
+            fn()
+        finally:
+            self.conn.set_trace_callback(None)
+
+        return [sql for sql in ls_sql if sql.split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE")]
+
+    def assert_indexed(self, ls_sql):
+        """Fail if any statement's plan scans a table other than the small lookup tables
+
+            Args:
+                ls_sql (list: str): The statements to check
+        """
+
+        self.assertTrue(ls_sql, "no statements were issued")
+        for sql in ls_sql:
+            for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall():
+                match = scan_pattern.match(row[3])
+                self.assertFalse(match and match.group(1) not in small_tables,
+                                 "full scan '%s' in plan of: %s" % (row[3], sql))
+
+    def test_lookup_refresh(self):
+        """Refreshing the lookup tables reads only the rows added since they were loaded"""
+
+        lookup_cache = lookup.LookupCache()
+        lookup_cache.refresh()
+        self.conn.execute("INSERT INTO Tags (tag) VALUES ('pump');")
+        self.conn.commit()
+        lookup_cache.invalidate()
+
+        # Counting the rows of each table reads the whole table, so is left out
+        ls_sql = self.statements(lookup_cache.refresh)
+        self.assert_indexed([sql for sql in ls_sql if "count(*)" not in sql])
+
+    def test_search_fts(self):
+        """Restricted searches through the trigram index look up the matching documents by id"""
+
+        if not self.has_fts:
+            self.skipTest("SQLite built without the FTS5 trigram tokenizer")
+
+        ls_sql = self.statements(lambda: search.search_documents(self.conn, "pump", [True, True], [1], [2],
+                                                                 self.has_fts))
+        self.assert_indexed(ls_sql)
+
+        # The match must be the outer loop, not run again for each document within the restrictions
+        for sql in ls_sql:
+            _first = self.conn.execute("EXPLAIN QUERY PLAN " + sql).fetchone()[3]
+            self.assertTrue(_first.startswith("SCAN Documents_fts"), "match not run first in plan of: %s" % sql)
+
+    def test_search_candidates(self):
+        """Searches over known candidate ids, such as the documents carrying the chosen tags, look up each id"""
+
+        self.assert_indexed(self.statements(lambda: search.search_documents(self.conn, "pu", [True, True],
+                                                                            [1], [2], self.has_fts,
+                                                                            ls_tag_doc=[1, 2, 3])))
+        self.assert_indexed(self.statements(lambda: search.search_documents(self.conn, "", [True, True],
+                                                                            [], [], self.has_fts,
+                                                                            ls_tag_doc=[1, 2, 3])))
+
+    def test_structured_restricted(self):
+        """Structured queries within restrictions find the documents through the restriction indexes"""
+
+        for text in structured_queries:
+            with self.subTest(query=text):
+                self.assert_indexed(self.statements(lambda: [row for page in
+                                                             query.search_pages(self.conn, text, [True, True],
+                                                                                [1], [2], ["pump", "valve"])
+                                                             for row in page]))
+                self.assert_indexed(self.statements(lambda: [row for page in
+                                                             query.search_pages(self.conn, text, [True, True],
+                                                                                [1], [], ["pump", "valve"], False)
+                                                             for row in page]))
+
+    def test_find_duplicates(self):
+        """Archived copies of a file being added are found by content hash"""
+
+        self.assert_indexed(self.statements(lambda: ingest.find_duplicates(self.conn, ["0" * 64, "1" * 64])))
+
+    def test_content_pending(self):
+        """The content indexer finds new documents past the last it scanned, and those due to be tried again by time"""
+
+        indexer = content_index.ContentIndexer()
+        self.assert_indexed(self.statements(lambda: indexer.pending(self.conn)))
+
+    def test_fill_normalized_columns(self):
+        """Filling in the normalized columns writes each document by id"""
+
+        self.conn.execute("INSERT INTO Documents (file_name, title) VALUES ('a.pdf', 'A');")
+        ls_sql = self.statements(lambda: schema.fill_normalized_columns(self.conn))
+        self.conn.rollback()
+
+        # The migration reads every document once by design, so only its writes are checked
+        self.assert_indexed([sql for sql in ls_sql if sql.startswith("UPDATE")])
+
+    def test_write_documents(self):
+        """Adding documents looks up their tags by exact name, whether the tags are new or already in the library"""
+
+        self.conn.execute("INSERT INTO Tags (tag) VALUES ('pump');")
+        ls_pending = [ingest.make_pending("/source/%s.pdf" % name, "Title", 1, 2, None, "Category", "Discipline",
+                                          None, tags, "demo", "0" * 64)
+                      for (name, tags) in [("a", ["pump", "valve"]), ("b", ["valve", "motor"])]]
+
+        self.assert_indexed(self.statements(lambda: ingest.write_documents(self.conn, ls_pending)))
+
+
+if __name__ == '__main__':
+    unittest.main()
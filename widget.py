@@ -4,11 +4,16 @@
 
 import wx
 import wx.lib.agw.ultimatelistctrl as ULC
+import datetime
 import os
 
 import dialog
+import autocomplete
+import query
+import rank
 
 import fn_path
+import fn_text
 
 
 class DummyFileDrop(wx.FileDropTarget):
@@ -44,11 +49,284 @@ class DummyFileDrop(wx.FileDropTarget):
         return True
 
 
+class VirtualLibrary(ULC.UltimateListCtrl):
+    """Virtual list control drawing rows of search results on demand, rather than holding an item for every row
+
+        Only the rows scrolled into view are asked for, so the cost of showing results does not grow with their number.
+        Category, discipline and level3 ids are resolved to names, and dates added formatted, as their rows are drawn -
+        the rows carry everything drawn, so drawing never reads the database.
+
+        Rows can be sorted by up to max_sort_columns columns by clicking their headers. Sorting permutes an index array
+        over the rows rather than the rows themselves, ordered by integer ranks computed once per column and cached, so
+        sorting again by another column takes a single pass over the rows.
+
+        Class Variables:
+            sample_size (int): Number of rows measured to estimate the width of each column
+            column_padding (int): Pixels added to the widest text measured in a column
+            column_width_range (tuple: int): Narrowest and widest a column is sized to
+            column_labels (list: str): Header label of each column
+            max_sort_columns (int): Most columns the rows are sorted by at once
+
+        Args:
+            parent (ref): Reference to the parent wx.object
+            root_pane (ref): Reference to the upstream wx.object pane
+            rows (list: tuple): List of result tuples drawn by the list, shared with and updated by the caller
+
+        Attributes:
+            root_pane (ref): Reference to the upstream wx.object pane
+            rows (list: tuple): List of result tuples drawn by the list
+            ls_order (list: int): Index into rows of the row shown at each position in the list
+            ls_sort (list: tuple): List of (column, is descending) tuples the rows are sorted by, most significant first
+            col_to_ranks (dict): Mapping of column to the sort rank of each row in it, and the number of distinct ranks
+            is_sort_stale (bool): Whether rows were appended after the list was sorted, and are yet to be sorted in
+    """
+
+    sample_size = 200
+    column_padding = 16
+    column_width_range = (60, 400)
+    column_labels = ["File Name", "Title", "Category", "Discipline", "Level3", "Date Added"]
+    max_sort_columns = 3
+
+    def __init__(self, parent, root_pane, rows, *args, **kwargs):
+        """Constructor"""
+        ULC.UltimateListCtrl.__init__(self, parent, *args, **kwargs)
+
+        self.root_pane = root_pane
+        self.rows = rows
+        self.ls_order = []
+        self.ls_sort = []
+        self.col_to_ranks = {}
+        self.is_sort_stale = False
+
+    def OnGetItemText(self, item, col):
+        """Get the text of a cell as it is drawn
+
+            Args:
+                item (int): Index of the row
+                col (int): Index of the column
+
+            Returns:
+                (str): The text of the cell
+        """
+
+        _row = self.row_at(item)
+        if col in (2, 3, 4):
+            return self.column_name(col, _row[col])
+        if col == 5:
+            return self.date_added(_row[6])
+
+        return _row[col]
+
+    def row_at(self, item):
+        """Get the row of results shown at a position in the list
+
+            Args:
+                item (int): Index of the position in the list
+
+            Returns:
+                (tuple): The result tuple
+        """
+
+        return self.rows[self.ls_order[item]]
+
+    @staticmethod
+    def date_added(time_added):
+        """Format the time a document was added for display
+
+            Args:
+                time_added (str): The time added as stored, seconds since the epoch
+
+            Returns:
+                (str): The date and time added, or an empty string if not recorded
+        """
+
+        try:
+            return datetime.datetime.fromtimestamp(float(time_added)).strftime("%Y-%m-%d %H:%M")
+        except (TypeError, ValueError):
+            return ""
+
+    @staticmethod
+    def time_key(time_added):
+        """Get the sort key of the time a document was added
+
+            Args:
+                time_added (str): The time added as stored, seconds since the epoch
+
+            Returns:
+                (float): The time added, or negative infinity if not recorded
+        """
+
+        try:
+            return float(time_added)
+        except (TypeError, ValueError):
+            return float('-inf')
+
+    def sort_keys(self, col):
+        """Get the sort key of each row in a column - names are compared in their normalized form
+
+            Args:
+                col (int): Index of the column
+
+            Returns:
+                (list): The key of each row, in the order of rows
+        """
+
+        # Dates added compare as the times stored, with documents not recorded as added first
+        if col == 5:
+            return [self.time_key(row[6]) for row in self.rows]
+        if col in (0, 1):
+            return [fn_text.normalize(row[col]) for row in self.rows]
+
+        # Resolve each id once, as many rows share a category, discipline or level3
+        id_to_key = {}
+        ls_key = []
+        for row in self.rows:
+            if row[col] not in id_to_key:
+                id_to_key[row[col]] = fn_text.normalize(self.column_name(col, row[col]))
+            ls_key.append(id_to_key[row[col]])
+
+        return ls_key
+
+    def column_name(self, col, ident):
+        """Resolve the id in a category, discipline or level3 column to its name
+
+            Args:
+                col (int): Index of the column
+                ident: The id held in the row
+
+            Returns:
+                (str): The name, or an empty string if there is none
+        """
+
+        if col == 2:
+            return self.root_pane.id_to_category.get(ident, "")
+        if col == 3:
+            return self.root_pane.id_to_discipline.get(ident, "")
+
+        return self.root_pane.id_to_level3.get(int(ident), "") if ident else ""  # Need to int() the key
+
+    def sort_ranks(self, col):
+        """Get the rank of each row in a column, computing them on first use
+
+            Args:
+                col (int): Index of the column
+
+            Returns:
+                (list: int): The rank of each row, equal keys sharing a rank
+                (int): The number of distinct ranks
+        """
+
+        if col not in self.col_to_ranks:
+            ls_key = self.sort_keys(col)
+            key_to_rank = dict((key, rank) for rank, key in enumerate(sorted(set(ls_key))))
+            self.col_to_ranks[col] = ([key_to_rank[key] for key in ls_key], len(key_to_rank))
+
+        return self.col_to_ranks[col]
+
+    def sort_by(self, col):
+        """Sort the rows by a column, keeping earlier sort columns as tie-breakers - sorting again by the column first
+        sorted by reverses it
+
+            Args:
+                col (int): Index of the column
+        """
+
+        if self.ls_sort and self.ls_sort[0][0] == col:
+            self.ls_sort[0] = (col, not self.ls_sort[0][1])
+        else:
+            self.ls_sort = [(col, False)] + [sort for sort in self.ls_sort if sort[0] != col]
+            del self.ls_sort[VirtualLibrary.max_sort_columns:]
+
+        self.apply_sort()
+        self.label_columns()
+        self.Refresh()
+
+    def apply_sort(self):
+        """Order the index array by the sort columns, combining their ranks into one integer key per row"""
+
+        self.is_sort_stale = False
+        if not self.ls_sort:
+            self.ls_order = list(range(len(self.rows)))
+            return
+
+        ls_combined = [0] * len(self.rows)
+        for (col, is_descending) in self.ls_sort:
+            ls_rank, _count = self.sort_ranks(col)
+            if is_descending:
+                ls_combined = [combined * _count + _count - 1 - rank for combined, rank in zip(ls_combined, ls_rank)]
+            else:
+                ls_combined = [combined * _count + rank for combined, rank in zip(ls_combined, ls_rank)]
+
+        # Stable, so rows tied on every sort column keep the order of the results
+        self.ls_order = sorted(range(len(self.rows)), key=ls_combined.__getitem__)
+
+    def clear_sort(self):
+        """Forget the sort columns and cached ranks, such as when the rows have been replaced or reordered"""
+
+        self.ls_sort = []
+        self.col_to_ranks = {}
+        self.apply_sort()
+        self.label_columns()
+
+    def label_columns(self):
+        """Label the column headers, marking the column first sorted by with the direction it is sorted in"""
+
+        for col, label in enumerate(VirtualLibrary.column_labels[:self.GetColumnCount()]):
+            if self.ls_sort and self.ls_sort[0][0] == col:
+                label += " \u25bc" if self.ls_sort[0][1] else " \u25b2"
+            info = self.GetColumn(col)
+            if info.GetText() != label:
+                info.SetText(label)
+                self.SetColumn(col, info)
+
+    def refresh_rows(self):
+        """Bring the list up to date after the rows have been changed, redrawing the rows in view
+
+            Rows appended while the list is sorted are shown after the sorted rows until finish_rows, so a search
+            streaming in many pages is sorted once rather than once per page.
+        """
+
+        # Ranks are relative to every row, so are computed again on the next sort
+        if len(self.ls_order) < len(self.rows):
+            self.col_to_ranks = {}
+            self.ls_order.extend(range(len(self.ls_order), len(self.rows)))
+            self.is_sort_stale = bool(self.ls_sort)
+        elif len(self.ls_order) > len(self.rows):
+            self.col_to_ranks = {}
+            self.apply_sort()
+
+        self.SetItemCount(len(self.rows))
+        self.Refresh()
+
+    def finish_rows(self):
+        """Sort in any rows appended since the list was sorted, once a search has streamed in all of its results"""
+
+        if self.is_sort_stale:
+            self.apply_sort()
+            self.Refresh()
+
+    def estimate_widths(self):
+        """Size the columns to fit their text, measured over an evenly spread sample of the rows, filling with the last"""
+
+        _step = max(len(self.rows) // VirtualLibrary.sample_size, 1)
+        ls_sample = range(0, len(self.rows), _step)[:VirtualLibrary.sample_size]
+
+        dc = wx.ClientDC(self)
+        dc.SetFont(self.GetFont())
+        _narrowest, _widest = VirtualLibrary.column_width_range
+        for col in range(self.GetColumnCount() - 1):
+            _width = max([dc.GetTextExtent(self.GetColumn(col).GetText())[0]] +
+                         [dc.GetTextExtent(self.OnGetItemText(item, col))[0] for item in ls_sample])
+            self.SetColumnWidth(col, min(max(_width + VirtualLibrary.column_padding, _narrowest), _widest))
+        self.SetColumnWidth(self.GetColumnCount() - 1, ULC.ULC_AUTOSIZE_FILL)
+
+
 class CompositeLibrary(wx.Panel):
     """Custom widget that overlays an button on top of a wx list control
 
         Class Variables:
             btn_size (int): Size of the button in the overlay
+            sort_modes (list: str): Labels of the orders the results can be listed in
 
         Args:
             parent (ref): Reference to the parent wx.object
@@ -61,6 +339,7 @@ class CompositeLibrary(wx.Panel):
     """
 
     btn_size = 25
+    sort_modes = ["Table order", "Relevance"]
 
     def __init__(self, parent, root_pane):
         """Constructor"""
@@ -79,13 +358,22 @@ class CompositeLibrary(wx.Panel):
                                              bitmap=wx.Bitmap(fn_path.concat_gui('plus.png')),
                                              size=(CompositeLibrary.btn_size,) * 2)
 
-        # Library subwidget
-        self.pnl_library = ULC.UltimateListCtrl(self,
-                                                wx.ID_ANY,
-                                                agwStyle = wx.LC_REPORT |
-                                                           wx.LC_VRULES |
-                                                           wx.LC_HRULES)
+        # Library subwidget - virtual, drawing the tab's results as they are scrolled into view
+        self.pnl_library = VirtualLibrary(self,
+                                          self.root_pane,
+                                          self.root_tab.search_results,
+                                          wx.ID_ANY,
+                                          agwStyle = wx.LC_REPORT |
+                                                     wx.LC_VIRTUAL |
+                                                     wx.LC_VRULES |
+                                                     wx.LC_HRULES)
         self.pnl_library.Bind(ULC.EVT_LIST_ITEM_ACTIVATED, self.evt_open_document)
+        self.pnl_library.Bind(ULC.EVT_LIST_COL_CLICK, self.evt_sort_column)
+
+        # Sort mode selection and bind
+        self.wgt_sort = wx.Choice(self, choices=CompositeLibrary.sort_modes)
+        self.wgt_sort.SetSelection(0)
+        self.wgt_sort.Bind(wx.EVT_CHOICE, self.evt_sort_mode)
 
         info = ULC.UltimateListItem()
         info._mask = wx.LIST_MASK_TEXT | wx.LIST_MASK_IMAGE | wx.LIST_MASK_FORMAT | ULC.ULC_MASK_CHECK
@@ -119,16 +407,22 @@ class CompositeLibrary(wx.Panel):
         info._image = []
         self.pnl_library.InsertColumnInfo(3, info)
 
-        for i, result in enumerate(self.parent.search_results):
-            self.pnl_library.InsertStringItem(i, result[0])
-            self.pnl_library.SetStringItem(i, 1, result[1])
-            self.pnl_library.SetStringItem(i, 2, self.root_pane.id_to_category[result[2]])
-            self.pnl_library.SetStringItem(i, 3, self.root_pane.id_to_discipline[result[3]])
+        info = ULC.UltimateListItem()
+        info._mask = wx.LIST_MASK_TEXT | wx.LIST_MASK_IMAGE | wx.LIST_MASK_FORMAT
+        info._format = 0
+        info._text = "Level3"
+        info._image = []
+        self.pnl_library.InsertColumnInfo(4, info)
+
+        info = ULC.UltimateListItem()
+        info._mask = wx.LIST_MASK_TEXT | wx.LIST_MASK_IMAGE | wx.LIST_MASK_FORMAT
+        info._format = 0
+        info._text = "Date Added"
+        info._image = []
+        self.pnl_library.InsertColumnInfo(5, info)
 
-        self.pnl_library.SetColumnWidth(0, 120)
-        self.pnl_library.SetColumnWidth(1, 120)
-        self.pnl_library.SetColumnWidth(2, 120)
-        self.pnl_library.SetColumnWidth(3, -3)
+        self.pnl_library.refresh_rows()
+        self.pnl_library.estimate_widths()
 
         # Button overlay binding - Must be after subwidget to bind to
         self.btn_add_image.Bind(wx.EVT_BUTTON, self.evt_click_button)
@@ -136,13 +430,91 @@ class CompositeLibrary(wx.Panel):
         self.btn_add_image.SetDropTarget(file_drop_target)
 
         # Main sizer - do not add button so it floats
+        szr_sort = wx.BoxSizer(wx.HORIZONTAL)
+        szr_sort.Add(wx.StaticText(self, label="Order by:"), flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=5)
+        szr_sort.Add(self.wgt_sort)
         szr_main = wx.BoxSizer(wx.VERTICAL)
+        szr_main.Add(szr_sort, flag=wx.BOTTOM, border=2)
         szr_main.Add(self.pnl_library, proportion=1, flag=wx.EXPAND)
         self.SetSizer(szr_main)
 
         # Bind button movement to resize
         self.Bind(wx.EVT_SIZE, self.evt_resize)
 
+    def append_rows(self, rows):
+        """Append rows of results to the list, as a search streams them in
+
+            Args:
+                rows (list: tuple): List of result tuples
+        """
+
+        self.root_tab.search_results.extend(rows)
+        self.pnl_library.refresh_rows()
+
+    def finish_rows(self):
+        """Sort the rows streamed in by a search once it has finished, if the list is sorted by a column"""
+
+        self.pnl_library.finish_rows()
+
+    def replace_rows(self, rows):
+        """Replace every row of results in the list
+
+            Args:
+                rows (list: tuple): List of result tuples
+        """
+
+        self.root_tab.search_results[:] = rows
+        self.wgt_sort.SetSelection(0)
+        self.pnl_library.clear_sort()
+        self.pnl_library.refresh_rows()
+        self.pnl_library.estimate_widths()
+
+    def evt_sort_mode(self, event):
+        """Reorder the results when a different sort mode is chosen
+
+            Args:
+                event: A choice event object passed from the sort mode selection
+        """
+
+        _rows = self.root_tab.search_results
+        if CompositeLibrary.sort_modes[self.wgt_sort.GetSelection()] == "Relevance":
+            _rows = self.order_by_relevance(_rows)
+        else:
+            _rows = sorted(_rows, key=lambda row: row[5])
+
+        # Reorder the tab's results in place, dropping any column sort, then redraw the list
+        self.root_tab.search_results[:] = _rows
+        self.pnl_library.clear_sort()
+        self.pnl_library.refresh_rows()
+
+    def evt_sort_column(self, event):
+        """Sort the results by a column when its header is clicked, keeping earlier sort columns as tie-breakers
+
+            Args:
+                event: A list event object passed from the column header clicked
+        """
+
+        self.pnl_library.sort_by(event.GetColumn())
+
+    def order_by_relevance(self, rows):
+        """Order rows of results with the most relevant to the tab's query first
+
+            Args:
+                rows (list: tuple): List of result tuples
+
+            Returns:
+                (list: tuple): The top ranked results best first, followed by the remainder in their existing order
+        """
+
+        _id_to_tag = dict((ident, tag) for (tag, ident) in self.root_pane.tag_to_id.items())
+        ls_fields = [(row[0], row[1], " ".join(_id_to_tag.get(tag_id, "")
+                                              for tag_id in self.root_pane.tag_index.doc_tags.get(row[5], [])))
+                     for row in rows]
+
+        ls_best = rank.top_k(ls_fields, query.ranking_text(self.root_tab.search_string))
+        _best = set(ls_best)
+        return [rows[i] for i in ls_best] + [row for i, row in enumerate(rows) if i not in _best]
+
     def evt_open_document(self, event):
         """Open the desired document after double-clicking on an entry in the library
 
@@ -150,7 +522,7 @@ class CompositeLibrary(wx.Panel):
                 event: A double-click event object passed from the list control
         """
 
-        _file_name, _title, _id_category, _id_discipline, _id_level3 = (self.root_tab.search_results[event.GetIndex()])
+        _file_name, _title, _id_category, _id_discipline, _id_level3 = self.pnl_library.row_at(event.GetIndex())[:5]
         _category = self.root_pane.id_to_category[_id_category]
         _discipline = self.root_pane.id_to_discipline[_id_discipline]
         _level3 = self.root_pane.id_to_level3[int(_id_level3)] if _id_level3 else None  # Need to int() the key
@@ -173,10 +545,17 @@ class CompositeLibrary(wx.Panel):
                 file_paths (list: str): A list of string paths for the file(s) dropped onto this widget
         """
 
+        # Hash every document in parallel while their details are entered
         for document in file_paths:
-            _dlg = dialog.AddDocument(self, self.root_pane, document)
+            self.root_pane.hash_later(document)
+
+        # Gather the documents of every committed dialog, then queue them as one job so the drop is added all or nothing
+        ls_batch = []
+        for document in file_paths:
+            _dlg = dialog.AddDocument(self, self.root_pane, document, ls_batch)
             _dlg.ShowModal()
             #if _dlg: _dlg.DestroyLater()
+        self.root_pane.add_documents(ls_batch)
 
     def evt_resize(self, event):
         """Move the button overlay when resized
@@ -233,12 +612,17 @@ class Restrictions(wx.Panel):
         wgt_staticbox_searchin = wx.StaticBox(self, label="Search for text in:")
         self.szr_chk_searchin = wx.StaticBoxSizer(wgt_staticbox_searchin, wx.VERTICAL)
 
-        for search_field in ["File Name", "Document Title"]:
+        for search_field, is_default in [("File Name", True), ("Document Title", True), ("Document Contents", False)]:
             _new_checkbox = wx.CheckBox(self, label=search_field)
-            _new_checkbox.SetValue(True)
+            _new_checkbox.SetValue(is_default)
             self.wgt_ls_chk_searchin.append(_new_checkbox)
             self.szr_chk_searchin.Add(_new_checkbox)
 
+        # Typo tolerant matching, kept apart from the fields to search in
+        self.wgt_chk_fuzzy = wx.CheckBox(self, label="Tolerate typos")
+        self.szr_chk_searchin.AddSpacer(4)
+        self.szr_chk_searchin.Add(self.wgt_chk_fuzzy)
+
         # Subwidget for "Restrict to categories:" and its sizer
         self.wgt_ls_chk_category = []
         wgt_staticbox_category = wx.StaticBox(self, label="Restrict to categories:")
@@ -259,18 +643,32 @@ class Restrictions(wx.Panel):
             self.wgt_ls_chk_disciplines.append(_new_checkbox)
             self.szr_chk_disciplines.Add(_new_checkbox)
 
+        # Subwidget for "Restrict to tags:" and its sizer - comma separated tags, matching all or any of them
+        wgt_staticbox_tags = wx.StaticBox(self, label="Restrict to tags:")
+        self.szr_tags = wx.StaticBoxSizer(wgt_staticbox_tags, wx.VERTICAL)
+        self.wgt_tags = autocomplete.LowercaseTextCtrl(self, completer=self.tag_completer, append_mode=True)
+        self.wgt_radio_tags_all = wx.RadioButton(self, label="Match all tags", style=wx.RB_GROUP)
+        self.wgt_radio_tags_any = wx.RadioButton(self, label="Match any tag")
+        self.wgt_ls_tags = [self.wgt_tags, self.wgt_radio_tags_all, self.wgt_radio_tags_any]
+        self.szr_tags.Add(self.wgt_tags, flag=wx.EXPAND)
+        self.szr_tags.Add(self.wgt_radio_tags_all)
+        self.szr_tags.Add(self.wgt_radio_tags_any)
+
         # List of subwidget sizers to collapse
         self.wgt_ls_collapseable = []
         self.wgt_ls_collapseable.append(wgt_staticbox_searchin)
         self.wgt_ls_collapseable.append(wgt_staticbox_category)
         self.wgt_ls_collapseable.append(wgt_staticbox_disciplines)
+        self.wgt_ls_collapseable.append(wgt_staticbox_tags)
 
         # If we do not desire to show the widget initially, hide all involved
         if not self.show_restrictions:
             for to_hide in self.wgt_ls_collapseable + \
                            self.wgt_ls_chk_disciplines + \
                            self.wgt_ls_chk_category + \
-                           self.wgt_ls_chk_searchin:
+                           self.wgt_ls_chk_searchin + \
+                           self.wgt_ls_tags + \
+                           [self.wgt_chk_fuzzy]:
                 to_hide.Hide()
 
         # Main sizer
@@ -281,16 +679,43 @@ class Restrictions(wx.Panel):
         szr_main.Add(self.szr_chk_category, proportion=1, flag=wx.EXPAND)
         szr_main.AddSpacer(2)
         szr_main.Add(self.szr_chk_disciplines, proportion=1, flag=wx.EXPAND)
+        szr_main.AddSpacer(2)
+        szr_main.Add(self.szr_tags, proportion=1, flag=wx.EXPAND)
 
         self.SetSizer(szr_main)
 
+    def tag_completer(self, query):
+        """Suggest existing tags to complete the last comma separated tag being typed
+
+            Args:
+                query (str): The current value of the tag restriction box
+
+            Returns:
+                (list: str): Formatted (html) suggestions
+                (list: str): Unformatted suggestions
+        """
+
+        return autocomplete.LowercaseTextCtrl.list_completer(self.parent.ls_tags)(query.split(",")[-1].strip())
+
+    def get_tags(self):
+        """Get the tags entered to restrict the search to
+
+            Returns:
+                (list: str): List of entered tags
+                (bool): True if documents must carry all of the tags, False if any one of them
+        """
+
+        ls_tag = [tag.strip() for tag in self.wgt_tags.GetValue().split(",") if tag.strip()]
+        return ls_tag, self.wgt_radio_tags_all.GetValue()
+
     def evt_click_header(self, event):
         if event.GetPosition()[1] < 20:
             self.toggle_restrictions()
 
     def toggle_restrictions(self):
         self.show_restrictions = not self.show_restrictions
-        for each in self.wgt_ls_chk_searchin + self.wgt_ls_chk_disciplines + self.wgt_ls_chk_category + self.wgt_ls_collapseable:
+        for each in self.wgt_ls_chk_searchin + self.wgt_ls_chk_disciplines + self.wgt_ls_chk_category + \
+                self.wgt_ls_tags + [self.wgt_chk_fuzzy] + self.wgt_ls_collapseable:
             each.Show() if self.show_restrictions else each.Hide()
         self.parent.Layout()
 